@@ -0,0 +1,279 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+import json
+import zlib
+import base64
+from network import get_beautiful_base_image_map
+from trip_store import get_frame_step
+from branca.element import MacroElement, Template
+
+
+def pack_array(values):
+    """ Pack an array of non-negative integers or of floats in the smallest typed array of the
+        browsers, compressed with zlib and encoded in base64 """
+    
+    # Find the smallest type which can hold the values
+    values = np.asarray(values)
+    if values.dtype.kind == 'f' :
+        dtype, name = '<f4', 'Float32Array'
+    elif len(values) == 0 or values.max() < 2**8 :
+        dtype, name = '<u1', 'Uint8Array'
+    elif values.max() < 2**16 :
+        dtype, name = '<u2', 'Uint16Array'
+    else :
+        dtype, name = '<u4', 'Uint32Array'
+    
+    # Compress the bytes of the array
+    data = zlib.compress(values.astype(dtype).tobytes())
+    
+    return {'type' : name, 'data' : base64.b64encode(data).decode('ascii')}
+
+
+def pack_trip_table(trip_store):
+    """ Pack the trips of a compact trip store (see trip_store.py) and the coordinates of its
+        cities, to be embedded in an html file. The trips are sorted by departure and route, 
+        and both are stored as differences with the previous trip, which compress well. As 
+        all the trips of a route usually have the same duration, the durations are stored per
+        route when possible """
+    
+    # Sort the trips by departure, then by route
+    order = np.lexsort((trip_store['route'], trip_store['departure']))
+    route = trip_store['route'][order].astype(np.int64)
+    departure = trip_store['departure'][order].astype(np.int64)
+    arrival = trip_store['arrival'][order].astype(np.int64)
+    
+    # Trips whose arrival overpass the time range were wrapped to its beginning
+    period = len(sgs._time_range)
+    duration = (arrival - departure) % period
+    
+    # Frames of the time range, relative to the start time of the simulation
+    first = int((sgs._time_range[0] - sgs._start_time) / get_frame_step())
+    
+    # The routes are stored as differences with the previous trip departing at the same frame
+    route_step = np.diff(route, prepend = 0)
+    same_departure = np.diff(departure, prepend = departure[0] - 1 if len(order) else 0) == 0
+    route_step[~same_departure] = route[~same_departure]
+    
+    # Store the durations per route if all the trips of each route have the same duration
+    routes = trip_store['routes']
+    route_duration = np.zeros(len(routes['from_city']), dtype = np.int64)
+    route_duration[route] = duration
+    per_route = bool(np.array_equal(route_duration[route], duration))
+    
+    # Pack the route table and the trips
+    table = {
+        'city_latitude' : pack_array(routes['city_latitude']),
+        'city_longitude' : pack_array(routes['city_longitude']),
+        'from_city' : pack_array(routes['from_city']),
+        'to_city' : pack_array(routes['to_city']),
+        'route' : pack_array(route_step),
+        'departure' : pack_array(np.diff(departure - first, prepend = 0)),
+        'duration' : pack_array(route_duration if per_route else duration),
+        'coal_type' : pack_array(trip_store['coal_type'][order]),
+        'is_naval' : pack_array(trip_store['is_naval'][order])
+    }
+    
+    # Describe the time range
+    description = {
+        'trips' : len(order),
+        'first' : first,
+        'period' : period,
+        'route_duration' : per_route,
+        'max_duration' : int(duration.max()) if len(order) else 0,
+        'start' : int(pd.Timestamp(sgs._start_time).value // 10**6),
+        'step' : int(get_frame_step().value // 10**6)
+    }
+    
+    return table, description
+
+
+def add_trip_animation(folium_map, trip_store, speed = 12):
+    """ Add to the map a canvas layer which animates the trips of the trip store in the browser,
+        with a play/pause button, a speed selector and a time slider. The speed is the number
+        of frames of the simulation played per second """
+    
+    # Pack the trips
+    table, description = pack_trip_table(trip_store)
+    
+    # Create the layer
+    animation = MacroElement()
+    animation._name = 'TripAnimation'
+    animation._template = Template(u"""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var table = {{ this.table }};
+                var info = {{ this.description }};
+                var colors = {{ this.colors }};
+                var names = Object.keys(table);
+                
+                // Decode a packed array: base64, then zlib, then typed array
+                function unpack(packed) {
+                    var bytes = Uint8Array.from(atob(packed.data), function(c) { return c.charCodeAt(0); });
+                    var stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+                    return new Response(stream).arrayBuffer().then(function(buffer) {
+                        return new window[packed.type](buffer);
+                    });
+                }
+                
+                Promise.all(names.map(function(name) { return unpack(table[name]); })).then(function(arrays) {
+                    var data = {};
+                    names.forEach(function(name, k) { data[name] = arrays[k]; });
+                    
+                    // Rebuild the departures and the routes from their differences, and the
+                    // durations of the trips if they are given per route
+                    var departure = new Int32Array(info.trips);
+                    var route = new Int32Array(info.trips);
+                    var duration = info.route_duration ? new Int32Array(info.trips) : data.duration;
+                    for (var i = 0, total = 0; i < info.trips; i++) {
+                        total += data.departure[i];
+                        departure[i] = total;
+                        route[i] = (i > 0 && data.departure[i] == 0) ? route[i-1] + data.route[i] : data.route[i];
+                        if (info.route_duration) duration[i] = data.duration[route[i]];
+                    }
+                    
+                    // Canvas covering the map, above the routes
+                    var canvas = L.DomUtil.create('canvas', 'trip-animation', map.getContainer());
+                    canvas.style.position = 'absolute';
+                    canvas.style.top = '0px';
+                    canvas.style.left = '0px';
+                    canvas.style.zIndex = 450;
+                    canvas.style.pointerEvents = 'none';
+                    var context = canvas.getContext('2d');
+                    
+                    // Position of the cities on the canvas, updated when the map moves. The trips
+                    // move in a straight line on the screen between their cities
+                    var cityX = new Float32Array(data.city_latitude.length);
+                    var cityY = new Float32Array(data.city_latitude.length);
+                    function place() {
+                        var size = map.getSize();
+                        canvas.width = size.x;
+                        canvas.height = size.y;
+                        for (var c = 0; c < cityX.length; c++) {
+                            var point = map.latLngToContainerPoint([data.city_latitude[c], data.city_longitude[c]]);
+                            cityX[c] = point.x;
+                            cityY[c] = point.y;
+                        }
+                    }
+                    map.on('move zoom resize viewreset', place);
+                    place();
+                    
+                    // First trip departing at or after the given frame
+                    function lowerBound(frame) {
+                        var low = 0, high = info.trips;
+                        while (low < high) {
+                            var middle = (low + high) >> 1;
+                            if (departure[middle] < frame) low = middle + 1; else high = middle;
+                        }
+                        return low;
+                    }
+                    
+                    // Draw the trips which are active at the given frame (relative to the first
+                    // frame of the time range)
+                    function draw(frame) {
+                        context.clearRect(0, 0, canvas.width, canvas.height);
+                        
+                        // Trips which departed during the longest travel time before the frame,
+                        // and those which departed at the end of the time range and wrapped
+                        var ranges = [[lowerBound(frame - info.max_duration), lowerBound(Math.floor(frame) + 1)]];
+                        if (frame - info.max_duration < 0)
+                            ranges.push([lowerBound(frame - info.max_duration + info.period), info.trips]);
+                        
+                        ranges.forEach(function(range) {
+                            for (var i = range[0]; i < range[1]; i++) {
+                                var elapsed = frame - departure[i];
+                                if (elapsed < 0) elapsed += info.period;
+                                if (elapsed > duration[i]) continue;
+                                
+                                // Interpolate the position between the cities of the route
+                                var progress = duration[i] > 0 ? elapsed / duration[i] : 0;
+                                var from = data.from_city[route[i]], to = data.to_city[route[i]];
+                                var x = cityX[from]*(1-progress) + cityX[to]*progress;
+                                var y = cityY[from]*(1-progress) + cityY[to]*progress;
+                                
+                                // Draw the naval trips as triangles and the land trips as circles
+                                context.fillStyle = colors[data.coal_type[i] - 1];
+                                context.beginPath();
+                                if (data.is_naval[i] == 1) {
+                                    context.moveTo(x, y - 3);
+                                    context.lineTo(x + 2.6, y + 1.5);
+                                    context.lineTo(x - 2.6, y + 1.5);
+                                } else {
+                                    context.arc(x, y, 1.5, 0, 2*Math.PI);
+                                }
+                                context.fill();
+                            }
+                        });
+                    }
+                    
+                    // Controls of the animation
+                    var control = L.control({position: 'bottomleft'});
+                    var button, selector, slider, label;
+                    control.onAdd = function() {
+                        var div = L.DomUtil.create('div', 'trip-animation-controls');
+                        div.style.cssText = 'background: rgba(0,0,0,0.7); color: white; padding: 6px; font: 14px sans-serif;';
+                        div.innerHTML = '<button>pause</button> <select>' +
+                            [1, 3, 12, 48, 144, 576].map(function(value) {
+                                return '<option value="' + value + '"' + (value == {{ this.speed }} ? ' selected' : '') +
+                                       '>' + value + ' frames/s</option>';
+                            }).join('') +
+                            '</select> <input type="range" min="0" max="' + (info.period - 1) +
+                            '" step="1" style="width: 400px; vertical-align: middle;"> <span></span>';
+                        button = div.querySelector('button');
+                        selector = div.querySelector('select');
+                        slider = div.querySelector('input');
+                        label = div.querySelector('span');
+                        L.DomEvent.disableClickPropagation(div);
+                        L.DomEvent.disableScrollPropagation(div);
+                        return div;
+                    };
+                    control.addTo(map);
+                    
+                    // State of the animation
+                    var frame = 0, playing = true, last = null;
+                    button.onclick = function() {
+                        playing = !playing;
+                        button.textContent = playing ? 'pause' : 'play';
+                    };
+                    slider.oninput = function() { frame = Number(slider.value); };
+                    
+                    // Advance the animation at each refresh of the screen
+                    function tick(now) {
+                        if (playing && last !== null)
+                            frame = (frame + (now - last) / 1000 * Number(selector.value)) % info.period;
+                        last = now;
+                        draw(frame);
+                        slider.value = Math.floor(frame);
+                        var time = new Date(info.start + (info.first + frame) * info.step);
+                        label.textContent = 'time: ' + time.toISOString().slice(0, 16).replace('T', ' ');
+                        requestAnimationFrame(tick);
+                    }
+                    requestAnimationFrame(tick);
+                });
+            })();
+        {% endmacro %}
+        """)
+    animation.table = json.dumps(table)
+    animation.description = json.dumps(description)
+    animation.colors = json.dumps(sgs._production_colors*2)
+    animation.speed = int(speed)
+    animation.add_to(folium_map)
+    
+    return folium_map
+
+
+def get_animated_map(trip_store, df_flux, speed = 12):
+    """ Return the network map with the animation of the trips of the trip store. The routes are
+        merged in a single layer, which keeps the html file small """
+    
+    return add_trip_animation(get_beautiful_base_image_map(df_flux, thin = True, merged = True), trip_store, speed)
+
+
+def save_animated_map(trip_store, df_flux, filename = 'animation.html', speed = 12):
+    """ Save in the html folder a single html file animating the trips of the trip store over
+        the network map, which replaces the rendering of the mp4 movie """
+    
+    get_animated_map(trip_store, df_flux, speed).save(sgs._html_folder + filename)
+    
+    return True
@@ -0,0 +1,219 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+import time
+import json
+import argparse
+import tracemalloc
+import dataset
+import flow_model
+
+
+def generate_synthetic_network(n_cities, n_routes, naval_share = 0.2, seed = 0):
+    """ Create random cities and routes in the same format as cities.csv and routes.csv, with
+        the number of production types of the settings. A share of the routes (naval_share)
+        carry naval flux if the naval mode is enabled """
+    
+    # Initialize the random generator
+    rng = np.random.default_rng(seed)
+    N = sgs._Ntypes_production
+    
+    # Scatter the cities around the center of the map
+    df_cities = pd.DataFrame({
+        'city_name' : ['City{}'.format(i) for i in range(n_cities)],
+        'production' : np.where(rng.random(n_cities) < 0.2, rng.integers(1, 5000, n_cities), 0),
+        'type_production' : rng.integers(1, N + 1, n_cities),
+        'consumption' : rng.integers(0, 2000, n_cities),
+        'latitude' : sgs._location_map[0] + rng.uniform(-4, 4, n_cities),
+        'longitude' : sgs._location_map[1] + rng.uniform(-8, 8, n_cities)
+    })
+    
+    # Draw the departure and arrival cities of the routes, which must be different
+    from_city = rng.integers(0, n_cities, n_routes)
+    to_city = (from_city + rng.integers(1, n_cities, n_routes)) % n_cities
+    
+    # Each route carries a single type of goods, by land or by sea
+    flux = np.zeros((n_routes, 2*N if sgs._enable_Naval else N))
+    naval = (rng.random(n_routes) < naval_share) & sgs._enable_Naval
+    flux[np.arange(n_routes), rng.integers(0, N, n_routes) + N*naval] = rng.integers(1, 3000, n_routes)
+    
+    # Store the routes
+    df_routes = pd.DataFrame(flux, columns = ['flux{}'.format(i+1) for i in range(N)] +
+                             ['fluxN{}'.format(i+1) for i in range(flux.shape[1] - N)])
+    df_routes.insert(0, 'from_city', df_cities['city_name'].to_numpy()[from_city])
+    df_routes.insert(1, 'to_city', df_cities['city_name'].to_numpy()[to_city])
+    
+    return df_cities, df_routes
+
+
+def build_city_table(df_cities, df_flux):
+    """ Add to the cities the arriving, departing and transiting flux expected by plot_cities """
+    
+    return flow_model.get_city_flows(flow_model.build_flow_model(df_flux, df_cities), df_cities)
+
+
+def measure(function, repeat = 1):
+    """ Run the function and return its best duration in seconds over repeat runs, and its 
+        peak memory in MB. The memory is traced in an additional run, as tracing slows the
+        function down """
+    
+    # Time the runs of the function
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    
+    # Trace the memory allocations during a last run
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    return min(durations), peak / 1e6
+
+
+def get_stages(df_cities, df_flux, max_routes_loop = 100):
+    """ Return the stages of the pipeline to measure, as (name, function) """
+    
+    # Import the pipeline here, as it needs the settings to be initialized
+    import travels
+    import framer
+    import network
+    import plot_cities
+    
+    # Create the timetable once for the stages which need it
+    df_trips = travels.create_timetable_batch(df_flux, seed = 0)
+    df_trips = df_trips.merge(df_flux[['from_city','to_city','from_latitude','from_longitude',
+                                       'to_latitude','to_longitude']].drop_duplicates(['from_city','to_city']),
+                              on = ['from_city','to_city'])
+    frame_time = sgs._time_range[len(sgs._time_range)//2]
+    df_cities = build_city_table(df_cities, df_flux)
+    
+    # Describe the stages
+    stages = [
+        ('flow_model.get_city_flows',
+         lambda: flow_model.get_city_flows(flow_model.build_flow_model(df_flux, df_cities), df_cities)),
+        ('travels.create_timetable_batch', lambda: travels.create_timetable_batch(df_flux, seed = 0)),
+        ('framer.get_active_trips_vectorized', lambda: framer.get_active_trips_vectorized(frame_time, df_trips)),
+        ('framer.get_image_map', lambda: framer.get_image_map(frame_time, df_trips, df_flux).get_root().render()),
+        ('network.get_beautiful_base_image_map', lambda: network.get_beautiful_base_image_map(df_flux).get_root().render()),
+        ('network.get_beautiful_base_image_map (merged)',
+         lambda: network.get_beautiful_base_image_map(df_flux, merged = True).get_root().render()),
+        ('plot_cities.plot_cities', lambda: plot_cities.plot_cities(df_cities, 'consumption').get_root().render()),
+        ('plot_cities.plot_cities_production', lambda: plot_cities.plot_cities_production(df_cities).get_root().render()),
+        ('plot_cities.plot_cities_transiting_flux',
+         lambda: plot_cities.plot_cities_transiting_flux(df_cities).get_root().render()),
+        ('plot_cities.plot_cities_import_export',
+         lambda: plot_cities.plot_cities_import_export(df_cities.copy()).get_root().render())
+    ]
+    if sgs._enable_Naval :
+        stages += [('network.get_beautiful_tricolor_base_image_map',
+                    lambda: network.get_beautiful_tricolor_base_image_map(df_flux).get_root().render())]
+    
+    # The stages which loop over every trip are only measured on small networks, to compare
+    # them with their vectorized versions
+    if len(df_flux) <= max_routes_loop :
+        stages += [('travels.create_timetable', lambda: travels.create_timetable(df_flux)),
+                   ('framer.get_active_trips', lambda: framer.get_active_trips(frame_time, df_trips))]
+    
+    return stages
+
+
+def run_benchmarks(sizes, naval_share = 0.2, repeat = 1, stages = None, max_routes_loop = 100):
+    """ Measure the duration and peak memory of the stages of the pipeline on synthetic networks
+        of the given sizes (list of (number of cities, number of routes)). Only the stages whose
+        name contains one of the given strings are measured, if stages is given. The best of
+        repeat runs is kept """
+    
+    # Initialize variable
+    results = []
+    
+    # Iterate over the sizes of networks
+    for n_cities, n_routes in sizes:
+        df_cities, df_routes = generate_synthetic_network(n_cities, n_routes, naval_share)
+        df_flux = dataset.build_flux_table(df_cities, df_routes)
+        
+        # Measure each stage
+        for name, function in get_stages(df_cities, df_flux, max_routes_loop):
+            if stages is not None and not any(stage in name for stage in stages):
+                continue
+            duration, peak = measure(function, repeat)
+            results.append({'stage' : name, 'cities' : n_cities, 'routes' : n_routes,
+                            'types' : sgs._Ntypes_production, 'naval_share' : naval_share,
+                            'seconds' : duration, 'peak_mb' : peak})
+            print('{:<50} {:>6} cities {:>7} routes {:>10.4f} s {:>10.1f} MB'.format(name, n_cities, n_routes,
+                                                                                duration, peak))
+    
+    return results
+
+
+def save_baseline(results, path):
+    """ Store the results of a benchmark as a baseline """
+    
+    with open(path, 'w') as file:
+        json.dump(results, file, indent = 1)
+    
+    return True
+
+
+def compare_to_baseline(results, path, tolerance = 1.25):
+    """ Compare the results to a stored baseline, print the ratio of durations and peak memory
+        of each stage and return the list of the stages which are slower than the baseline by
+        more than the tolerance factor """
+    
+    # Load the baseline, indexed by stage and size of the network
+    def key(result):
+        return (result['stage'], result['cities'], result['routes'], result['types'], result['naval_share'])
+    with open(path) as file:
+        baseline = {key(result) : result for result in json.load(file)}
+    
+    # Initialize variable
+    regressions = []
+    
+    # Compare each result to its baseline
+    for result in results:
+        reference = baseline.get(key(result))
+        if reference is None :
+            continue
+        time_ratio = result['seconds'] / max(reference['seconds'], 1e-9)
+        memory_ratio = result['peak_mb'] / max(reference['peak_mb'], 1e-9)
+        print('{:<50} {:>6} cities {:>7} routes  time x{:.2f}  memory x{:.2f}'.format(
+              result['stage'], result['cities'], result['routes'], time_ratio, memory_ratio))
+        if time_ratio > tolerance :
+            regressions.append(result['stage'])
+    
+    return regressions
+
+
+if __name__ == '__main__':
+    
+    # Read the arguments of the command line
+    parser = argparse.ArgumentParser(description = 'Benchmark the pipeline on synthetic networks.')
+    parser.add_argument('--sizes', nargs = '+', default = ['50x100', '200x1000', '1000x5000'],
+                        help = 'sizes of the networks, as CITIESxROUTES')
+    parser.add_argument('--types', type = int, default = None, help = 'number of production types')
+    parser.add_argument('--naval-share', type = float, default = 0.2, help = 'share of naval routes')
+    parser.add_argument('--stages', nargs = '+', default = None, help = 'only measure these stages')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'number of runs of each stage')
+    parser.add_argument('--baseline', default = None, help = 'baseline file to compare to')
+    parser.add_argument('--save-baseline', default = None, help = 'file where to store the results')
+    args = parser.parse_args()
+    
+    # Initialize the settings, with enough colors for the production types
+    sgs.init()
+    if args.types is not None :
+        sgs._Ntypes_production = args.types
+        sgs._production_colors = [sgs._production_colors[i % 10] for i in range(args.types)]
+        sgs._descr = [sgs._descr[i % 10] for i in range(args.types)]
+    
+    # Run the benchmarks
+    sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+    results = run_benchmarks(sizes, args.naval_share, args.repeat, args.stages)
+    
+    # Compare them to the baseline and store them
+    if args.baseline is not None :
+        regressions = compare_to_baseline(results, args.baseline)
+        print('regressions: {}'.format(', '.join(regressions) if regressions else 'none'))
+    if args.save_baseline is not None :
+        save_baseline(results, args.save_baseline)
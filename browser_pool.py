@@ -0,0 +1,236 @@
+import settings as sgs
+import os
+import queue
+import atexit
+import shutil
+import tempfile
+from branca.element import MacroElement, Template
+from instrumentation import stage, count
+
+
+# Browser pool of the current process, created when the first screenshot is taken
+_browser_pool = None
+
+
+def start_browser_pool(n_sessions = 1, recycle_after = 200, timeout = 6, browser = 'firefox'):
+    """ Create the pool of headless browser sessions of this process. Up to n_sessions browsers
+        are started when they are needed and kept open between the frames. A session is closed
+        and replaced after recycle_after frames, to bound the memory leaked by the browser.
+        A screenshot is taken as soon as the map is drawn, or after timeout seconds """
+    
+    global _browser_pool
+    
+    # Close the previous pool of this process
+    close_browser_pool()
+    
+    # Store the parameters of the pool. The idle sessions wait in a queue, so that several
+    # threads can share the pool
+    _browser_pool = {
+        'pid' : os.getpid(),
+        'idle' : queue.Queue(),
+        'started' : 0,
+        'n_sessions' : n_sessions,
+        'recycle_after' : recycle_after,
+        'timeout' : timeout,
+        'browser' : browser
+    }
+    
+    return _browser_pool
+
+
+def get_browser_pool():
+    """ Return the browser pool of this process, and create it with the default parameters if
+        needed. A forked process does not reuse the browsers of its parent, but starts its own
+        with the same parameters """
+    
+    if _browser_pool is None :
+        start_browser_pool()
+    elif _browser_pool['pid'] != os.getpid():
+        start_browser_pool(_browser_pool['n_sessions'], _browser_pool['recycle_after'],
+                           _browser_pool['timeout'], _browser_pool['browser'])
+    
+    return _browser_pool
+
+
+def start_session(pool):
+    """ Start a headless browser with a window of the size of the frames """
+    
+    # Import selenium only when a browser is needed
+    from selenium import webdriver
+    
+    # Start the browser
+    with stage('browser_start'):
+        if pool['browser'] == 'chrome' :
+            options = webdriver.ChromeOptions()
+            options.add_argument("--headless=new")
+            driver = webdriver.Chrome(options = options)
+        else :
+            options = webdriver.FirefoxOptions()
+            options.add_argument("--headless")
+            driver = webdriver.Firefox(options = options)
+        
+        # Resize the window so that the page has the size of the frames, as done by folium
+        window_size = driver.execute_script("""
+            return [window.outerWidth - window.innerWidth + arguments[0],
+                    window.outerHeight - window.innerHeight + arguments[1]];
+            """, *sgs._frame_size)
+        driver.set_window_size(*window_size)
+    
+    # The page of each frame is written in the same temporary folder
+    session = {'driver' : driver, 'frames' : 0, 'folder' : tempfile.mkdtemp(prefix = 'frames_')}
+    
+    return session
+
+
+def close_session(session):
+    """ Close the browser of a session and remove its temporary folder """
+    
+    try:
+        session['driver'].quit()
+    finally:
+        shutil.rmtree(session['folder'], ignore_errors = True)
+    
+    return True
+
+
+def acquire_session(pool):
+    """ Return an idle session of the pool, or start a new one if none is idle and the pool is
+        not full. Else, wait for a session to be released """
+    
+    try:
+        return pool['idle'].get_nowait()
+    except queue.Empty :
+        if pool['started'] < pool['n_sessions'] :
+            pool['started'] += 1
+            try:
+                return start_session(pool)
+            except Exception :
+                pool['started'] -= 1
+                raise
+        return pool['idle'].get()
+
+
+def release_session(pool, session, broken = False):
+    """ Give a session back to the pool, or close it if it is broken or if it has rendered
+        enough frames to be recycled """
+    
+    if broken or session['frames'] >= pool['recycle_after'] :
+        pool['started'] -= 1
+        close_session(session)
+    else :
+        pool['idle'].put(session)
+    
+    return True
+
+
+def close_browser_pool():
+    """ Close all the idle browsers of the pool of this process """
+    
+    global _browser_pool
+    
+    # The browsers of the parent of a forked process are left to their owner
+    if _browser_pool is None or _browser_pool['pid'] != os.getpid():
+        _browser_pool = None
+        return True
+    
+    # Close the idle sessions
+    while True :
+        try:
+            close_session(_browser_pool['idle'].get_nowait())
+        except queue.Empty :
+            break
+    _browser_pool = None
+    
+    return True
+
+
+# Close the browsers when the program ends
+atexit.register(close_browser_pool)
+
+
+def add_ready_signal(folium_map):
+    """ Add a script to the map which sets window.frameReady once the tiles are loaded and the
+        map has been painted, so that the screenshot does not wait longer than needed """
+    
+    signal = MacroElement()
+    signal._name = 'ReadySignal'
+    signal._template = Template(u"""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var pending = 0;
+                
+                // Wait for two animation frames after the loading, so that the map is painted
+                function ready() {
+                    requestAnimationFrame(function() {
+                        requestAnimationFrame(function() { window.frameReady = true; });
+                    });
+                }
+                
+                // Count the tile layers which are still loading
+                map.eachLayer(function(layer) {
+                    if (layer instanceof L.GridLayer && layer.isLoading()) {
+                        pending += 1;
+                        layer.once('load', function() {
+                            pending -= 1;
+                            if (pending == 0) ready();
+                        });
+                    }
+                });
+                if (pending == 0) ready();
+            })();
+        {% endmacro %}
+        """)
+    signal.add_to(folium_map)
+    
+    return folium_map
+
+
+def screenshot_map(folium_map, pool = None):
+    """ Same as folium_map._to_png, but renders the map in a browser of the pool instead of
+        starting a new browser, and takes the screenshot as soon as the map is ready instead
+        of waiting a fixed delay. Returns the png image as bytes """
+    
+    # Import selenium only when a browser is needed
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.common.exceptions import TimeoutException
+    
+    # Use the pool of this process by default
+    if pool is None : pool = get_browser_pool()
+    
+    # Render the html page, which signals when it is ready
+    html = add_ready_signal(folium_map).get_root().render()
+    
+    # Take a browser of the pool
+    session = acquire_session(pool)
+    broken = True
+    
+    try:
+        
+        # Load the page from a file, to avoid the security restrictions of the browsers.
+        # The query changes for each frame, so that the page is always reloaded
+        path = os.path.join(session['folder'], 'frame.html')
+        with open(path, 'w', encoding = 'utf-8') as file:
+            file.write(html)
+        with stage('load_page'):
+            session['driver'].get('file://{}?{}'.format(os.path.abspath(path), session['frames']))
+        
+        # Wait for the ready signal. If it does not come in time, take the screenshot anyway
+        with stage('wait_ready'):
+            try:
+                WebDriverWait(session['driver'], pool['timeout'], poll_frequency = 0.05).until(
+                    lambda driver: driver.execute_script("return window.frameReady === true;"))
+            except TimeoutException :
+                count('ready_timeout', 1)
+        
+        # Take the screenshot of the map
+        with stage('screenshot'):
+            png = session['driver'].find_element("class name", "folium-map").screenshot_as_png
+        session['frames'] += 1
+        broken = False
+    
+    # Give the browser back to the pool, or close it if something went wrong
+    finally:
+        release_session(pool, session, broken)
+    
+    return png
@@ -0,0 +1,455 @@
+import os
+import sys
+import json
+import argparse
+import contextlib
+
+
+def parse_value(text):
+    """ Read the value of a setting given on the command line as JSON (numbers, booleans,
+        lists...), or as a plain string if it is not valid JSON """
+    
+    try:
+        return json.loads(text)
+    except ValueError :
+        return text
+
+
+def configure_settings(args):
+    """ Initialize the settings, then apply those of the configuration file (a JSON object
+        whose keys are the names of the settings) and those given with --set name=value """
+    
+    # Import the settings, and pandas with them, only once a command runs, so that the
+    # command line starts quickly
+    global sgs
+    import settings as sgs
+    
+    # Initialize variable
+    values = {}
+    
+    # Read the configuration file
+    if args.config is not None :
+        with open(args.config) as file:
+            values.update(json.load(file))
+    
+    # The settings of the command line come last
+    for assignment in args.set:
+        name, equal, value = assignment.partition('=')
+        if not equal :
+            raise ValueError("--set expects name=value, got: {}".format(assignment))
+        values[name] = parse_value(value)
+    
+    sgs.init()
+    sgs.configure(**values)
+    
+    return True
+
+
+def load_trips(df_flux, args):
+    """ Load the timetable given with --timetable, or create it (or load it from the cache
+        folder) with the seed given with --seed, and add the coordinates of the cities """
+    
+    import travels
+    
+    # Read or create the timetable
+    if args.timetable is not None :
+        df_trips = travels.load_timetable(args.timetable)
+    else :
+        df_trips = travels.create_timetable_cached(df_flux, args.seed)
+    
+    # Add the coordinates of the departure and arrival cities
+    df_coordinates = df_flux[['from_city','to_city','from_latitude','from_longitude',
+                              'to_latitude','to_longitude']].drop_duplicates(['from_city','to_city'])
+    
+    return df_trips.merge(df_coordinates, on = ['from_city','to_city'])
+
+
+@contextlib.contextmanager
+def use_region(args):
+    """ If a bounding box is given with --bbox, center the maps and the frames on it while the
+        command runs (see spatial_index.py). The area which is shown is stored in
+        args.region, None without bounding box """
+    
+    # Nothing to do without bounding box
+    if getattr(args, 'bbox', None) is None :
+        args.region = None
+        yield None
+        return
+    
+    import spatial_index
+    with spatial_index.use_region(args.bbox) as args.region:
+        yield args.region
+
+
+def select_region(args, df_flux, df_trips = None, df_cities = None):
+    """ Return only the routes, trips and cities which can be seen in the region of the
+        command (see use_region), or all of them without bounding box """
+    
+    # Nothing to do without bounding box
+    tables = tuple(table for table in (df_flux, df_trips, df_cities) if table is not None)
+    if args.region is None :
+        return tables
+    
+    import spatial_index
+    
+    return spatial_index.select_region(args.region, df_flux, df_trips, df_cities)
+
+
+def get_frame_range(args):
+    """ Return the first and the last (excluded) frames given with --begin and --end, by
+        default the whole simulation """
+    
+    return args.begin, sgs._simulation_duration if args.end is None else args.end
+
+
+def run_timetable(args):
+    """ Create the timetable and store it in the cache folder, and optionally in a file and
+        as a position store """
+    
+    import dataset
+    import travels
+    
+    # Create the timetable, or find it in the cache
+    df_cities, df_flux = dataset.get_dataset()
+    df_trips = travels.create_timetable_cached(df_flux, args.seed)
+    print('{} trips'.format(len(df_trips)))
+    
+    # Save it where it is asked
+    if args.output is not None :
+        travels.save_timetable(df_trips, args.output)
+    if args.positions is not None :
+        from position_store import precompute_positions
+        begin, end = get_frame_range(args)
+        precompute_positions(load_trips(df_flux, args), args.positions, begin, end)
+    
+    return True
+
+
+def run_render(args):
+    """ Create the png frames of a range of frames in the png folder """
+    
+    import dataset
+    
+    # Load the data
+    df_cities, df_flux = dataset.get_dataset()
+    df_trips = load_trips(df_flux, args)
+    df_flux, df_trips = select_region(args, df_flux, df_trips)
+    begin, end = get_frame_range(args)
+    os.makedirs(sgs._png_folder, exist_ok = True)
+    
+    # Take the screenshots of the folium maps
+    if args.renderer == 'folium' :
+        import movie_maker
+        if args.workers > 1 :
+            failed = movie_maker.parallel_coach(df_trips, df_flux, begin, end, args.workers, args.timeout, args.retries)
+            return len(failed) == 0
+        return movie_maker.coach(df_trips, df_flux, begin, end)
+    
+    # Else, draw the frames
+    import raster_framer
+    if args.workers <= 1 :
+        return raster_framer.raster_framer(df_trips, df_flux, begin, end)
+    
+    # In parallel, each worker follows the active trips with its own copy of the cursor
+    import movie_maker
+    from trip_index import new_sweep_cursor, build_trip_index
+    base = raster_framer.build_raster_base(df_flux)
+    cursor = new_sweep_cursor(build_trip_index(df_trips))
+    def render(j):
+        return raster_framer.go_raster_frame((j, sgs._time_range[j]), cursor, base)
+    failed = [j for j, success, value in movie_maker.parallel_frames(range(begin, end), render, args.workers,
+                                                                       args.timeout, args.retries) if not success]
+    if failed :
+        print('frames which could not be created: {}'.format(failed))
+    
+    return len(failed) == 0
+
+
+def run_encode(args):
+    """ Assemble the png frames of the png folder in a mp4 movie """
+    
+    import movie_maker
+    
+    begin, end = get_frame_range(args)
+    os.makedirs(sgs._mp4_folder, exist_ok = True)
+    
+    return movie_maker.movie_maker(begin, end, args.filename)
+
+
+def run_movie(args):
+    """ Render the frames directly into a mp4 movie """
+    
+    import dataset
+    import movie_maker
+    
+    # Load the data, the timetable being useless if the positions are stored
+    df_cities, df_flux = dataset.get_dataset()
+    df_trips = load_trips(df_flux, args) if args.positions is None else None
+    begin, end = get_frame_range(args)
+    os.makedirs(sgs._mp4_folder, exist_ok = True)
+    
+    # Render and encode the frames
+    failed = movie_maker.movie_streamer(df_trips, df_flux, begin, end, args.renderer, args.workers,
+                                        args.buffer_size, args.save_png, args.filename, args.fps,
+                                        args.codec, args.quality, args.threads, args.positions, args.bbox)
+    
+    return len(failed) == 0
+
+
+def run_plan_shards(args):
+    """ Split the movie in shards and write their manifest """
+    
+    import shards
+    
+    begin, end = get_frame_range(args)
+    manifest = shards.plan_shards(args.folder, begin, end, args.shard_size, args.renderer, args.seed,
+                                  args.fps, args.codec, args.quality)
+    print('{} shards'.format(len(manifest['shards'])))
+    
+    return True
+
+
+def run_render_shards(args):
+    """ Render the shards of a planned movie until none are left """
+    
+    import dataset
+    import shards
+    
+    # Load the data, with the seed of the plan
+    manifest = shards.read_manifest(args.folder)
+    args.seed = manifest['parameters']['seed']
+    df_cities, df_flux = dataset.get_dataset()
+    df_trips = load_trips(df_flux, args) if args.positions is None else None
+    
+    # Render the shards
+    shards.run_shards(args.folder, df_trips, df_flux, max_shards = args.max_shards, n_workers = args.workers,
+                      buffer_size = args.buffer_size, threads = args.threads, store_folder = args.positions,
+                      claim_timeout = args.claim_timeout)
+    
+    return True
+
+
+def run_shard_status(args):
+    """ Print the progress of a planned movie """
+    
+    import shards
+    
+    status = shards.get_shard_status(args.folder)
+    print('pending: {pending}, claimed: {claimed}, done: {done}'.format(**status))
+    if status['failed_frames'] :
+        print('frames replaced by a neighbouring frame: {}'.format(status['failed_frames']))
+    
+    return True
+
+
+def run_concat_shards(args):
+    """ Concatenate the segments of a planned movie """
+    
+    import shards
+    
+    os.makedirs(sgs._mp4_folder, exist_ok = True)
+    print(shards.concat_shards(args.folder, args.filename))
+    
+    return True
+
+
+def run_maps(args):
+    """ Save the maps of the network and of the cities in the html folder """
+    
+    import dataset
+    import flow_model
+    import network
+    import plot_cities
+    
+    # Load the data, and sum the flux of the cities. The empty cells of the cities are null
+    # production or consumption
+    df_cities, df_flux = dataset.get_dataset()
+    df_cities[['production','consumption']] = df_cities[['production','consumption']].fillna(0)
+    df_flux, df_cities = select_region(args, df_flux, df_cities = df_cities)
+    df_cities = flow_model.get_city_flows(flow_model.build_flow_model(df_flux, df_cities), df_cities)
+    os.makedirs(sgs._html_folder, exist_ok = True)
+    
+    # Functions creating the maps of the network
+    network_maps = {
+        'normal' : lambda: network.get_beautiful_base_image_map(df_flux, merged = args.merged),
+        'thin' : lambda: network.get_beautiful_base_image_map(df_flux, thin = True, merged = args.merged),
+        'tricolor' : lambda: network.get_beautiful_tricolor_base_image_map(df_flux, merged = args.merged),
+        'land' : lambda: network.get_beautiful_base_image_map_by_route_category(df_flux, 'land', args.merged),
+        'naval' : lambda: network.get_beautiful_base_image_map_by_route_category(df_flux, 'naval', args.merged)
+    }
+    
+    # Functions creating the maps of the cities
+    city_maps = {
+        'production' : lambda: plot_cities.plot_cities_production(df_cities, args.mode),
+        'transiting_flux' : lambda: plot_cities.plot_cities_transiting_flux(df_cities, args.mode),
+        'import_export' : lambda: plot_cities.plot_cities_import_export(df_cities.copy(), args.mode)
+    }
+    for arg in ['consumption', 'arriving_flux', 'departing_flux']:
+        city_maps[arg] = lambda arg = arg: plot_cities.plot_cities(df_cities, arg, args.mode)
+    
+    # With --lod, the maps have a level of detail per zoom level (see lod.py), and are saved
+    # with the _lod suffix. The other network maps have no such version
+    suffix = ''
+    if args.lod is not None :
+        import lod
+        zoom_levels, suffix = args.lod or None, '_lod'
+        network_maps = {
+            'normal' : lambda: lod.get_lod_base_image_map(df_flux, zoom_levels),
+            'thin' : lambda: lod.get_lod_base_image_map(df_flux, zoom_levels, thin = True)
+        }
+        city_maps = {arg : lambda arg = arg: lod.plot_cities_lod(df_cities, arg, zoom_levels) for arg in city_maps}
+        skipped = [name for name in args.network if name not in network_maps]
+        if skipped :
+            print('no level of detail for the network maps: {}'.format(', '.join(skipped)))
+        args.network = [name for name in args.network if name in network_maps]
+    
+    # Save the maps which are asked
+    for name in args.network:
+        network_maps[name]().save(sgs._html_folder + 'network_{}{}.html'.format(name, suffix))
+        print(sgs._html_folder + 'network_{}{}.html'.format(name, suffix))
+    for name in args.cities:
+        city_maps[name]().save(sgs._html_folder + 'cities_{}{}.html'.format(name, suffix))
+        print(sgs._html_folder + 'cities_{}{}.html'.format(name, suffix))
+    
+    return True
+
+
+def get_parser():
+    """ Describe the arguments of the command line """
+    
+    # Options shared by all the commands
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--config', default = None, help = 'JSON file of settings, e.g. {"zoom_map": 7}')
+    common.add_argument('--set', action = 'append', default = [], metavar = 'NAME=VALUE',
+                        help = 'change a setting of settings.py, e.g. --set hourly_rate=4 (repeatable)')
+    common.add_argument('--record', default = None, metavar = 'LOG',
+                        help = 'record the duration of the stages in a JSONL log (see instrumentation.py)')
+    
+    # Options of the commands which need the trips
+    trips = argparse.ArgumentParser(add_help = False)
+    trips.add_argument('--seed', type = int, default = 0, help = 'seed of the timetable')
+    trips.add_argument('--timetable', default = None, help = 'timetable file saved by the timetable command')
+    
+    # Options of the commands which work on a range of frames
+    frames = argparse.ArgumentParser(add_help = False)
+    frames.add_argument('--begin', type = int, default = 0, help = 'first frame')
+    frames.add_argument('--end', type = int, default = None, help = 'last frame (excluded), by default the last one')
+    
+    # Option of the commands which can show a region
+    region = argparse.ArgumentParser(add_help = False)
+    region.add_argument('--bbox', type = float, nargs = 4, default = None, metavar = ('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                        help = 'show only this region, e.g. --bbox 50.8 6.3 51.8 7.9 for the Ruhr')
+    
+    # Options of the commands which render frames
+    render = argparse.ArgumentParser(add_help = False)
+    render.add_argument('--renderer', choices = ['raster', 'folium'], default = 'raster')
+    render.add_argument('--workers', type = int, default = 1, help = 'number of worker processes')
+    render.add_argument('--timeout', type = float, default = 30, help = 'seconds after which a frame is retried')
+    render.add_argument('--retries', type = int, default = 2, help = 'attempts of a frame before giving up')
+    
+    parser = argparse.ArgumentParser(prog = 'python -m cli', description = 'Run the steps of the simulation.')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    
+    command = commands.add_parser('timetable', parents = [common, frames],
+                                  help = 'create the timetable (stored in the cache folder)')
+    command.add_argument('--seed', type = int, default = 0, help = 'seed of the timetable')
+    command.add_argument('--output', default = None, help = 'also save the timetable in this npz file')
+    command.add_argument('--positions', default = None, metavar = 'FOLDER',
+                         help = 'also store the positions of the trips of the frame range in this folder')
+    command.set_defaults(run = run_timetable, timetable = None)
+    
+    command = commands.add_parser('render', parents = [common, trips, frames, render, region],
+                                  help = 'create the png frames of a range of frames')
+    command.set_defaults(run = run_render)
+    
+    command = commands.add_parser('encode', parents = [common, frames],
+                                  help = 'assemble the png frames in a mp4 movie')
+    command.add_argument('--filename', default = 'movie.mp4')
+    command.set_defaults(run = run_encode)
+    
+    command = commands.add_parser('movie', parents = [common, trips, frames, render, region],
+                                  help = 'render the frames directly into a mp4 movie')
+    command.add_argument('--positions', default = None, metavar = 'FOLDER', help = 'position store to read')
+    command.add_argument('--buffer-size', type = int, default = 16)
+    command.add_argument('--save-png', action = 'store_true')
+    command.add_argument('--filename', default = 'movie.mp4')
+    command.add_argument('--fps', type = int, default = 10)
+    command.add_argument('--codec', default = 'libx264')
+    command.add_argument('--quality', type = float, default = 5)
+    command.add_argument('--threads', type = int, default = None)
+    command.set_defaults(run = run_movie)
+    
+    # Options of the sharded movies
+    folder = argparse.ArgumentParser(add_help = False)
+    folder.add_argument('folder', help = 'folder of the shards and of their manifest, shared by the jobs')
+    
+    command = commands.add_parser('plan-shards', parents = [common, folder, frames],
+                                  help = 'split the movie in shards rendered in separate segments')
+    command.add_argument('--shard-size', type = int, default = 2016, help = 'number of frames of each shard')
+    command.add_argument('--renderer', choices = ['raster', 'folium'], default = 'raster')
+    command.add_argument('--seed', type = int, default = 0, help = 'seed of the timetable')
+    command.add_argument('--fps', type = int, default = 10)
+    command.add_argument('--codec', default = 'libx264')
+    command.add_argument('--quality', type = float, default = 5)
+    command.set_defaults(run = run_plan_shards)
+    
+    command = commands.add_parser('render-shards', parents = [common, folder],
+                                  help = 'render the shards of a planned movie until none are left')
+    command.add_argument('--timetable', default = None, help = 'timetable file saved by the timetable command')
+    command.add_argument('--positions', default = None, metavar = 'FOLDER', help = 'position store to read')
+    command.add_argument('--max-shards', type = int, default = None, help = 'stop after this number of shards')
+    command.add_argument('--workers', type = int, default = 1, help = 'number of worker processes')
+    command.add_argument('--buffer-size', type = int, default = 16)
+    command.add_argument('--threads', type = int, default = None)
+    command.add_argument('--claim-timeout', type = float, default = 600,
+                         help = 'seconds after which the shard of a silent job is rendered again')
+    command.set_defaults(run = run_render_shards)
+    
+    command = commands.add_parser('shard-status', parents = [common, folder], help = 'print the progress of the shards')
+    command.set_defaults(run = run_shard_status)
+    
+    command = commands.add_parser('concat-shards', parents = [common, folder],
+                                  help = 'concatenate the segments of the shards without encoding them again')
+    command.add_argument('--filename', default = 'movie.mp4')
+    command.set_defaults(run = run_concat_shards)
+    
+    command = commands.add_parser('maps', parents = [common, region], help = 'save the static maps in the html folder')
+    command.add_argument('--network', nargs = '*', default = ['normal', 'tricolor', 'land', 'naval'],
+                         choices = ['normal', 'thin', 'tricolor', 'land', 'naval'])
+    command.add_argument('--cities', nargs = '*', default = ['consumption', 'production', 'transiting_flux', 'import_export'],
+                         choices = ['consumption', 'production', 'arriving_flux', 'departing_flux',
+                                    'transiting_flux', 'import_export'])
+    command.add_argument('--merged', action = 'store_true', help = 'draw the routes with a single GeoJSON layer')
+    command.add_argument('--mode', choices = ['markers', 'geojson'], default = 'markers')
+    command.add_argument('--lod', type = int, nargs = '*', default = None, metavar = 'ZOOM',
+                         help = 'draw a level of detail per zoom level, by default around the zoom of the map '
+                                '(only the normal and thin network maps)')
+    command.set_defaults(run = run_maps)
+    
+    return parser
+
+
+def main(argv = None):
+    """ Run the command of the command line """
+    
+    # Read the arguments and the settings
+    args = get_parser().parse_args(argv)
+    configure_settings(args)
+    
+    # Record the stages if asked
+    if args.record is not None :
+        from instrumentation import start_recording, stop_recording
+        start_recording(args.record)
+    
+    try:
+        with use_region(args):
+            success = args.run(args)
+    finally:
+        if args.record is not None :
+            stop_recording()
+    
+    return 0 if success is not False else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+import os
+import glob
+import json
+import shutil
+import hashlib
+
+
+# Types of the columns of cities.csv. Empty cells of the numbers are read as NaN
+_cities_schema = {
+    'city_name' : str,
+    'production' : np.float64,
+    'type_production' : np.float64,
+    'consumption' : np.float64,
+    'latitude' : np.float64,
+    'longitude' : np.float64
+}
+
+# Columns of the routes which are not flux columns, in the order of df_flux
+_route_columns = ['from_city', 'from_latitude', 'from_longitude', 'to_city', 'to_latitude', 'to_longitude']
+
+# Type of the flux columns. Empty cells are read as null flux
+_flux_dtype = np.float32
+
+# Version of the cached datasets, to change when their format changes
+_dataset_cache_version = 1
+
+
+def get_flux_columns(df, mode = None):
+    """ Return the flux columns of a table of routes (routes.csv or df_flux): all the columns
+        but the cities, their coordinates and the total flux, in their order. The first
+        _Ntypes_production are the land flux of each type and, if the naval mode is enabled,
+        the next ones are the naval flux. Their names do not matter. Only the columns of a mode
+        ('land' or 'naval') are returned if it is given """
+    
+    # Find the flux columns
+    columns = [column for column in df.columns if column not in _route_columns + ['flux']]
+    
+    # Check their number against the settings
+    N = sgs._Ntypes_production
+    expected = 2*N if sgs._enable_Naval else N
+    if len(columns) != expected :
+        raise ValueError("the routes have {} flux columns ({}), but {} are expected with _Ntypes_production = {} "
+                         "and _enable_Naval = {}".format(len(columns), ', '.join(map(str, columns)), expected,
+                                                         N, sgs._enable_Naval))
+    
+    if mode == 'land' :
+        return columns[:N]
+    if mode == 'naval' :
+        return columns[N:]
+    
+    return columns
+
+
+def check_columns(df, columns, path):
+    """ Raise an error if some columns are missing in a table read from path """
+    
+    missing = [column for column in columns if column not in df.columns]
+    if missing :
+        raise ValueError("{} misses the columns: {}".format(path, ', '.join(missing)))
+    
+    return True
+
+
+def read_cities(path = None):
+    """ Read the cities file (by default cities.csv in the data folder) with the types of the
+        schema. The names of the cities must be unique """
+    
+    if path is None : path = sgs._data_folder + 'cities.csv'
+    
+    # Read the file with explicit types, instead of guessing them
+    df_cities = pd.read_csv(path, sep = ';', dtype = _cities_schema)
+    check_columns(df_cities, list(_cities_schema), path)
+    
+    # Check the names of the cities, which identify them in the routes
+    duplicated = df_cities['city_name'][df_cities['city_name'].duplicated()]
+    if df_cities['city_name'].isna().any() or len(duplicated) :
+        raise ValueError("{} has empty or duplicated city names: {}".format(path, ', '.join(duplicated.astype(str))))
+    
+    return df_cities[list(_cities_schema)]
+
+
+def read_routes(path = None):
+    """ Read the routes file (by default routes.csv in the data folder): the departure and
+        arrival cities, then the flux columns (see get_flux_columns), stored as float32 with
+        null flux in the empty cells """
+    
+    if path is None : path = sgs._data_folder + 'routes.csv'
+    
+    # Read the header first, to give the types of the flux columns
+    header = pd.read_csv(path, sep = ';', nrows = 0)
+    check_columns(header, ['from_city', 'to_city'], path)
+    flux_columns = get_flux_columns(header)
+    
+    # Read the routes
+    dtype = dict({'from_city' : str, 'to_city' : str}, **{column : _flux_dtype for column in flux_columns})
+    df_routes = pd.read_csv(path, sep = ';', dtype = dtype)
+    df_routes[flux_columns] = df_routes[flux_columns].fillna(0)
+    
+    return df_routes[['from_city', 'to_city'] + flux_columns]
+
+
+def build_flux_table(df_cities, df_routes):
+    """ Create df_flux from the cities and the routes: the routes with the coordinates of their
+        cities, their flux columns and their total flux. All the cities of the routes must be
+        in the cities table """
+    
+    # Find the cities of the routes
+    cities = pd.Index(df_cities['city_name'])
+    from_city = cities.get_indexer(df_routes['from_city'])
+    to_city = cities.get_indexer(df_routes['to_city'])
+    unknown = pd.unique(np.concatenate([df_routes['from_city'].to_numpy()[from_city < 0],
+                                        df_routes['to_city'].to_numpy()[to_city < 0]]))
+    if len(unknown) :
+        raise ValueError("unknown cities in the routes: {}".format(', '.join(map(str, unknown))))
+    
+    # Resolve the coordinates once for all routes
+    latitude, longitude = df_cities['latitude'].to_numpy(), df_cities['longitude'].to_numpy()
+    flux_columns = get_flux_columns(df_routes)
+    df_flux = df_routes[flux_columns].astype(_flux_dtype).reset_index(drop = True)
+    for k, (column, values) in enumerate([('from_city', df_routes['from_city'].to_numpy()),
+                                          ('from_latitude', latitude[from_city]),
+                                          ('from_longitude', longitude[from_city]),
+                                          ('to_city', df_routes['to_city'].to_numpy()),
+                                          ('to_latitude', latitude[to_city]),
+                                          ('to_longitude', longitude[to_city])]):
+        df_flux.insert(k, column, values)
+    
+    # Sum the flux of all types
+    df_flux['flux'] = df_flux[flux_columns].sum(axis = 1).astype(np.float64)
+    
+    return df_flux
+
+
+def get_dataset_key(paths):
+    """ Return a hash identifying the dataset created from the given files with the settings """
+    
+    # Hash the content of the files
+    key = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b''):
+                key.update(block)
+    
+    # Add the settings which the dataset depends on
+    key.update(repr((sgs._Ntypes_production, sgs._enable_Naval, _dataset_cache_version)).encode())
+    
+    return key.hexdigest()
+
+
+def save_dataset(df_cities, df_flux, folder):
+    """ Save the cities and df_flux in a folder of npy files, which can be memory-mapped.
+        The cities of the routes are stored as their index in the cities """
+    
+    # Write the files in a temporary folder first, so that an interrupted save leaves no
+    # broken dataset
+    shutil.rmtree(folder + '.tmp', ignore_errors = True)
+    os.makedirs(folder + '.tmp')
+    
+    # Store the columns of the cities, the names as fixed-size strings
+    for column in _cities_schema:
+        values = df_cities[column].to_numpy(dtype = str if column == 'city_name' else np.float64)
+        np.save(os.path.join(folder + '.tmp', 'city_' + column + '.npy'), values)
+    
+    # Store the routes as city indices, and the flux columns in a single matrix
+    cities = pd.Index(df_cities['city_name'])
+    flux_columns = get_flux_columns(df_flux)
+    np.save(os.path.join(folder + '.tmp', 'from_city.npy'), cities.get_indexer(df_flux['from_city']).astype(np.int32))
+    np.save(os.path.join(folder + '.tmp', 'to_city.npy'), cities.get_indexer(df_flux['to_city']).astype(np.int32))
+    np.save(os.path.join(folder + '.tmp', 'flux.npy'), df_flux[flux_columns].to_numpy(dtype = _flux_dtype))
+    with open(os.path.join(folder + '.tmp', 'columns.json'), 'w') as file:
+        json.dump({'flux_columns' : flux_columns}, file)
+    
+    # Replace the former dataset
+    shutil.rmtree(folder, ignore_errors = True)
+    os.replace(folder + '.tmp', folder)
+    
+    return True
+
+
+def load_dataset(folder, mmap = True):
+    """ Load the cities and df_flux saved by save_dataset. With mmap, the flux columns are
+        memory-mapped (copy on write) instead of being read, so that they are only loaded
+        in memory when they are used """
+    
+    # Read the arrays of the folder
+    mmap_mode = 'c' if mmap else None
+    def read(name):
+        return np.load(os.path.join(folder, name + '.npy'), mmap_mode = mmap_mode)
+    with open(os.path.join(folder, 'columns.json')) as file:
+        flux_columns = json.load(file)['flux_columns']
+    
+    # Rebuild the cities
+    df_cities = pd.DataFrame({column : read('city_' + column) for column in _cities_schema})
+    df_cities['city_name'] = df_cities['city_name'].astype(object)
+    
+    # Rebuild df_flux around the flux matrix, without copying it
+    names = df_cities['city_name'].to_numpy()
+    latitude, longitude = df_cities['latitude'].to_numpy(), df_cities['longitude'].to_numpy()
+    from_city, to_city = np.asarray(read('from_city')), np.asarray(read('to_city'))
+    df_flux = pd.DataFrame(read('flux'), columns = flux_columns, copy = False)
+    for k, (column, values) in enumerate([('from_city', names[from_city]),
+                                          ('from_latitude', latitude[from_city]),
+                                          ('from_longitude', longitude[from_city]),
+                                          ('to_city', names[to_city]),
+                                          ('to_latitude', latitude[to_city]),
+                                          ('to_longitude', longitude[to_city])]):
+        df_flux.insert(k, column, values)
+    df_flux['flux'] = df_flux[flux_columns].sum(axis = 1).astype(np.float64)
+    
+    return df_cities, df_flux
+
+
+def get_dataset(cities_path = None, routes_path = None, use_cache = True, mmap = True, max_entries = 4):
+    """ Return the cities and df_flux of the dataset (by default cities.csv and routes.csv in
+        the data folder). The first time, the csv files are read and the dataset is stored in
+        the cache folder; then, as long as the files and the settings do not change, it is
+        loaded from the cache (see load_dataset). Only the max_entries most recently used
+        datasets are kept """
+    
+    if cities_path is None : cities_path = sgs._data_folder + 'cities.csv'
+    if routes_path is None : routes_path = sgs._data_folder + 'routes.csv'
+    
+    # Without cache, read the csv files
+    if not use_cache :
+        df_cities = read_cities(cities_path)
+        return df_cities, build_flux_table(df_cities, read_routes(routes_path))
+    
+    # Find the cache entry of this dataset
+    os.makedirs(sgs._cache_folder, exist_ok = True)
+    folder = os.path.join(sgs._cache_folder, 'dataset_' + get_dataset_key([cities_path, routes_path]))
+    
+    # Load the dataset if it is in the cache, and mark it as recently used
+    if os.path.exists(folder):
+        os.utime(folder)
+        return load_dataset(folder, mmap)
+    
+    # Else, read the csv files and store the dataset
+    df_cities = read_cities(cities_path)
+    df_flux = build_flux_table(df_cities, read_routes(routes_path))
+    save_dataset(df_cities, df_flux, folder)
+    
+    # Remove the least recently used datasets if there are too many of them
+    entries = sorted([entry for entry in glob.glob(os.path.join(sgs._cache_folder, 'dataset_*'))
+                      if not entry.endswith('.tmp')], key = os.path.getmtime)
+    for entry in entries[:max(0, len(entries) - max_entries)]:
+        shutil.rmtree(entry, ignore_errors = True)
+    
+    return load_dataset(folder, mmap)
@@ -0,0 +1,182 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from dataset import get_flux_columns, read_routes
+
+
+# Classes of the routes, as numbered by the colors of the network maps
+_route_modes = {'none' : -1, 'land' : 0, 'naval' : 1, 'both' : 2}
+
+
+def load_routes(path = None):
+    """ Read the routes file (by default routes.csv in the data folder) """
+    
+    return read_routes(path)
+
+
+def build_flow_model(df_routes, df_cities = None):
+    """ Build the flow model of a table of routes (routes.csv, or df_flux, see get_flux_columns
+        in dataset.py). The cities are numbered in the order of df_cities, followed by the
+        cities of the routes which are not in df_cities. The model holds:
+        - flux : sparse matrix of the flux of each route (rows) for each column of get_flux_columns
+        - from_city, to_city : index of the departure and arrival cities of each route
+        - departures, arrivals : sparse incidence matrices (cities x routes)
+        - od : origin-destination sparse matrices (cities x cities) per mode and per goods type """
+    
+    # Number the cities
+    cities = pd.Index(df_cities['city_name'] if df_cities is not None else [], dtype = object)
+    missing = pd.unique(np.concatenate([df_routes['from_city'].to_numpy(), df_routes['to_city'].to_numpy()]))
+    cities = cities.append(pd.Index(missing, dtype = object).difference(cities, sort = False))
+    from_city = cities.get_indexer(df_routes['from_city'])
+    to_city = cities.get_indexer(df_routes['to_city'])
+    n_cities, n_routes = len(cities), len(df_routes)
+    
+    # Gather the flux of the routes, empty cells being null flux
+    columns = get_flux_columns(df_routes)
+    flux = df_routes[columns].fillna(0).to_numpy(dtype = np.float64)
+    flux = scipy.sparse.csr_matrix(flux)
+    
+    # Incidence matrices linking each city to the routes departing from or arriving to it
+    routes = np.arange(n_routes)
+    departures = scipy.sparse.csr_matrix((np.ones(n_routes), (from_city, routes)), shape = (n_cities, n_routes))
+    arrivals = scipy.sparse.csr_matrix((np.ones(n_routes), (to_city, routes)), shape = (n_cities, n_routes))
+    
+    # Origin-destination matrices of each goods type, per mode. Routes between the same cities
+    # are summed
+    flux_csc = flux.tocsc()
+    od = {}
+    for k in range(len(columns)):
+        mode = 'naval' if k >= sgs._Ntypes_production else 'land'
+        values = flux_csc[:, k]
+        od.setdefault(mode, []).append(scipy.sparse.csr_matrix(
+            (values.data, (from_city[values.indices], to_city[values.indices])), shape = (n_cities, n_cities)))
+    
+    # Store the model
+    model = {
+        'cities' : cities,
+        'columns' : columns,
+        'flux' : flux,
+        'from_city' : from_city,
+        'to_city' : to_city,
+        'departures' : departures,
+        'arrivals' : arrivals,
+        'od' : od
+    }
+    
+    return model
+
+
+def load_flow_model(df_cities = None, path = None):
+    """ Read the routes file once and build its flow model """
+    
+    return build_flow_model(load_routes(path), df_cities)
+
+
+def get_column_indices(model, mode = None, types = None):
+    """ Return the indices of the flux columns of the model of a mode and of some goods types
+        (numbered from 1 as type_production), by default all of them """
+    
+    # Initialize variables
+    indices = []
+    
+    # The naval flux columns come after the land flux columns
+    for k in range(len(model['columns'])):
+        is_naval = k >= sgs._Ntypes_production
+        goods_type = k % sgs._Ntypes_production + 1
+        if mode is not None and mode != ('naval' if is_naval else 'land') :
+            continue
+        if types is not None and goods_type not in types :
+            continue
+        indices.append(k)
+    
+    return indices
+
+
+def get_route_flux(model, mode = None, types = None):
+    """ Return the flux of each route, summed over the goods types and the modes selected """
+    
+    indices = get_column_indices(model, mode, types)
+    
+    return np.asarray(model['flux'][:, indices].sum(axis = 1)).ravel()
+
+
+def get_od_matrix(model, mode = None, types = None):
+    """ Return the origin-destination sparse matrix (cities x cities) of the flux of a mode and
+        of some goods types, by default all of them """
+    
+    # Initialize variable
+    od = scipy.sparse.csr_matrix((len(model['cities']), len(model['cities'])))
+    
+    for current_mode, matrices in model['od'].items():
+        if mode is None or mode == current_mode :
+            for goods_type, matrix in enumerate(matrices, 1):
+                if types is None or goods_type in types :
+                    od = od + matrix
+    
+    return od
+
+
+def get_route_modes(model):
+    """ Return the class of each route: 0 if it only carries land flux, 1 if it only carries
+        naval flux, 2 if it carries both and -1 if it carries nothing """
+    
+    land = get_route_flux(model, 'land') > 0
+    naval = get_route_flux(model, 'naval') > 0
+    
+    return np.where(land, np.where(naval, _route_modes['both'], _route_modes['land']),
+                    np.where(naval, _route_modes['naval'], _route_modes['none']))
+
+
+def get_city_flux(model, direction, mode = None, types = None):
+    """ Return the flux departing from ('departing'), arriving to ('arriving') or transiting by
+        ('transiting', both directions) each city, for a mode and some goods types """
+    
+    # Sum the flux of the routes of each city, with a sparse product
+    flux = get_route_flux(model, mode, types)
+    if direction == 'departing' :
+        return model['departures'] @ flux
+    if direction == 'arriving' :
+        return model['arrivals'] @ flux
+    if direction == 'transiting' :
+        return (model['departures'] + model['arrivals']) @ flux
+    
+    raise ValueError("direction should be 'departing', 'arriving' or 'transiting'")
+
+
+def get_city_flows(model, df_cities):
+    """ Add to the cities the columns expected by plot_cities: arriving_flux, departing_flux,
+        transiting_flux and import_export (net export: production - consumption, empty cells
+        being null). Land and naval flux are also given separately """
+    
+    # Find the cities in the model
+    df_cities = df_cities.copy()
+    index = model['cities'].get_indexer(df_cities['city_name'])
+    
+    # Sum the flux of every route at once for each city, direction and mode
+    for direction in ['arriving', 'departing', 'transiting']:
+        df_cities[direction + '_flux'] = get_city_flux(model, direction)[index]
+        if sgs._enable_Naval :
+            for mode in ['land', 'naval']:
+                df_cities['{}_{}_flux'.format(direction, mode)] = get_city_flux(model, direction, mode)[index]
+    
+    # Net export of each city
+    df_cities['import_export'] = df_cities['production'].fillna(0) - df_cities['consumption'].fillna(0)
+    
+    return df_cities
+
+
+def get_route_flows(model):
+    """ Return a table of the routes with their total, land and naval flux and their class (see
+        get_route_modes) """
+    
+    df_routes = pd.DataFrame({
+        'from_city' : model['cities'][model['from_city']],
+        'to_city' : model['cities'][model['to_city']],
+        'flux' : get_route_flux(model),
+        'land_flux' : get_route_flux(model, 'land'),
+        'naval_flux' : get_route_flux(model, 'naval'),
+        'mode' : get_route_modes(model)
+    })
+    
+    return df_routes
@@ -1,6 +1,10 @@
 import settings as sgs
 import numpy as np
+import pandas as pd
 from network import *
+from trip_index import *
+from instrumentation import stage, count
+from browser_pool import screenshot_map
 import folium
 import signal
 import io
@@ -76,18 +80,77 @@ def get_active_trips(image_time, df_trips):
     else :
         return current_latitude, current_longitude, coal_type
 
+
+def get_active_trips_vectorized(image_time, df_trips):
+    """ Same as get_active_trips, but computes the progress and the current position of all 
+        the active trips in a single numpy pass. Returns arrays instead of lists """
+    
+    # Convert the frame time to the numpy time format of the dataframe
+    image_time = np.datetime64(pd.Timestamp(image_time), 'ns')
+    departure_time = df_trips["departure_time"].to_numpy(dtype = 'datetime64[ns]')
+    arrival_time = df_trips["arrival_time"].to_numpy(dtype = 'datetime64[ns]')
+    
+    # Active trips are those whose departure time is already passed but whose arrival
+    # time has not yet passed
+    active = np.flatnonzero((departure_time <= image_time) & (arrival_time >= image_time))
     
-def get_image_map(frame_time, df_trips, df_flux):
-    """Create the folium map for the given time """
+    # Compute the percentage of completion of all active trips at once. Trips without 
+    # duration are considered as just departed
+    duration = (arrival_time[active] - departure_time[active]).astype(np.float64)
+    time_from_departure = (image_time - departure_time[active]).astype(np.float64)
+    progress = np.divide(time_from_departure, duration,
+                         out = np.zeros(len(active)), where = duration > 0)
     
-    # Establish a base map depicting the network of trade routes
-    folium_map = get_beautiful_base_image_map(df_flux, True)
+    # Match this percentage of completion to extrapolate the current positions
+    current_latitude = df_trips["from_latitude"].to_numpy()[active]*(1-progress) + \
+                       df_trips["to_latitude"].to_numpy()[active]*progress
+    current_longitude = df_trips["from_longitude"].to_numpy()[active]*(1-progress) + \
+                        df_trips["to_longitude"].to_numpy()[active]*progress
+    
+    # Extract the type of coal which is transported
+    coal_type = df_trips["coal_type"].to_numpy()[active]
+    
+    # Return all the information about the active trips
+    if (sgs._enable_Naval):
+        return current_latitude, current_longitude, coal_type, df_trips["is_naval"].to_numpy()[active]
+    else :
+        return current_latitude, current_longitude, coal_type
+
+    
+def crop_positions(bbox, current_latitude, current_longitude, *columns):
+    """ Keep the positions of the active trips (and the other columns given about them) which 
+        are in the bounding box (south, west, north, east) """
+    
+    # Test all positions at once
+    south, west, north, east = bbox
+    inside = (current_latitude >= south) & (current_latitude <= north) & \
+             (current_longitude >= west) & (current_longitude <= east)
+    
+    return tuple(np.asarray(column)[inside] for column in (current_latitude, current_longitude) + columns)
+
+
+def get_image_map(frame_time, df_trips, df_flux, cursor = None, bbox = None):
+    """Create the folium map for the given time. If a sweep cursor is given (see trip_index.py),
+       it is used to find the active trips instead of scanning the whole timetable. If a 
+       bounding box (south, west, north, east) is given, only the trips inside it are placed """
+    
+    # Establish a base map depicting the network of trade routes, which is built only once
+    # for all the frames
+    folium_map = get_cached_base_image_map(df_flux, 'thin')
     
     # If the naval mode is enabled
     if (sgs._enable_Naval):
         
         # Extract the information about the active trips, including if the trip is a land trip or a naval one
-        current_latitude, current_longitude, coal_type, isnaval = get_active_trips(frame_time, df_trips)
+        if cursor is None :
+            current_latitude, current_longitude, coal_type, isnaval = get_active_trips_vectorized(frame_time, df_trips)
+        else :
+            current_latitude, current_longitude, coal_type, isnaval = advance_sweep_cursor(cursor, frame_time)
+        
+        # Leave out the trips outside the bounding box
+        if bbox is not None :
+            current_latitude, current_longitude, coal_type, isnaval = crop_positions(
+                bbox, current_latitude, current_longitude, coal_type, isnaval)
         
         # Iterate on all active trips
         for i in range(len(current_longitude)):
@@ -114,7 +177,15 @@ def get_image_map(frame_time, df_trips, df_flux):
     else:
         
         # Extract the information about the active trips
-        current_latitude, current_longitude, coal_type = get_active_trips(frame_time, df_trips)
+        if cursor is None :
+            current_latitude, current_longitude, coal_type = get_active_trips_vectorized(frame_time, df_trips)
+        else :
+            current_latitude, current_longitude, coal_type = advance_sweep_cursor(cursor, frame_time)
+        
+        # Leave out the trips outside the bounding box
+        if bbox is not None :
+            current_latitude, current_longitude, coal_type = crop_positions(
+                bbox, current_latitude, current_longitude, coal_type)
         
         # Iterate on all active trips
         for i in range(len(current_longitude)):
@@ -125,36 +196,52 @@ def get_image_map(frame_time, df_trips, df_flux):
                                 color=sgs._production_colors[coal_type[i]-1],
                                 fill=True).add_to(folium_map)
     
+    # Record the number of active trips, if the pipeline is instrumented
+    count('active_trips', len(current_longitude))
+    
     return folium_map
 
-def go_frame(params, df_trips, df_flux):
-    """ Generate the image frame from html, add annotations, and save image file in png """
-    
-    # Unpack parameters
-    i, frame_time = params
+def render_frame(frame_time, df_trips, df_flux, cursor = None, bbox = None):
+    """ Generate the image frame from html and add annotations, without saving it """
     
     # Create the html map at the frame time, given the trips and flux data
-    my_frame = get_image_map(frame_time, df_trips, df_flux)
+    with stage('folium_map'):
+        my_frame = get_image_map(frame_time, df_trips, df_flux, cursor, bbox)
     
-    # Convert the html folium map to a png image
-    png = my_frame._to_png(delay=6)
+    # Convert the html folium map to a png image, with a browser which stays open between the
+    # frames (see browser_pool.py)
+    with stage('to_png'):
+        png = screenshot_map(my_frame)
     
     # Load the png image in order to be able to modify it
-    stream = io.BytesIO(png)
-    image = Image.open(stream)
-    draw = ImageDraw.Draw(image)
+    with stage('annotate'):
+        stream = io.BytesIO(png)
+        image = Image.open(stream)
+        draw = ImageDraw.Draw(image)
+        
+        # Load the font
+        font = ImageFont.truetype(sgs._data_folder+"LibreBaskerville-Regular.otf", 30)
+        
+        # Add date and time of day text on the png image
+        draw.text((20,image.height - 50), 
+                  "time: {}".format(frame_time),
+                  fill=(255, 255, 255), 
+                  font=font)
+    
+    return image
+
+
+def go_frame(params, df_trips, df_flux, cursor = None):
+    """ Generate the image frame from html, add annotations, and save image file in png """
     
-    # Load the font
-    font = ImageFont.truetype(sgs._data_folder+"LibreBaskerville-Regular.otf", 30)
+    # Unpack parameters
+    i, frame_time = params
     
-    # Add date and time of day text on the png image
-    draw.text((20,image.height - 50), 
-              "time: {}".format(frame_time),
-              fill=(255, 255, 255), 
-              font=font)
+    # Create the annotated image at the frame time
+    image = render_frame(frame_time, df_trips, df_flux, cursor)
     
     # Save the png image
-    draw = ImageDraw.Draw(image)
-    image.save(sgs._png_folder + "frame_{:0>5}.png".format(i))
+    with stage('save'):
+        image.save(sgs._png_folder + "frame_{:0>5}.png".format(i))
     
     return True
@@ -0,0 +1,281 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import time
+import json
+import argparse
+import cProfile
+import contextlib
+import tracemalloc
+
+# The resource module only exists on POSIX systems
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Recorder of the current process, None when nothing is recorded
+_recorder = None
+
+
+def get_peak_rss_mb():
+    """ Return the peak resident memory of the process in MB, or None if it is unknown """
+    
+    if resource is None :
+        return None
+    
+    # The peak is given in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def start_recording(path, profile_every = 0, profile_folder = None):
+    """ Start recording the duration of the stages of the pipeline in the given JSONL file,
+        one line per frame or event. If profile_every is given, one frame out of profile_every
+        is also profiled with cProfile (saved as frame_{:0>5}.prof in profile_folder) and its
+        peak of python memory is traced with tracemalloc """
+    
+    global _recorder
+    
+    # Stop the previous recording
+    stop_recording()
+    
+    # Prepare the profiles folder
+    if profile_every and profile_folder is None :
+        profile_folder = os.path.join(os.path.dirname(path) or '.', 'profiles')
+    if profile_every :
+        os.makedirs(profile_folder, exist_ok = True)
+    
+    # Open the log in append mode, line by line, so that several processes can share it
+    _recorder = {
+        'file' : open(path, 'a', buffering = 1),
+        'profile_every' : profile_every,
+        'profile_folder' : profile_folder,
+        'frame' : None,
+        'failures' : {}
+    }
+    
+    return True
+
+
+def stop_recording():
+    """ Stop the current recording """
+    
+    global _recorder
+    
+    if _recorder is not None :
+        _recorder['file'].close()
+        _recorder = None
+    
+    return True
+
+
+def write_record(record):
+    """ Write a record in the log, with the time and the process """
+    
+    record = dict(record, timestamp = time.time(), pid = os.getpid(), peak_rss_mb = get_peak_rss_mb())
+    _recorder['file'].write(json.dumps(record) + '\n')
+    
+    return True
+
+
+def start_frame(j):
+    """ Start recording the stages of frame j, and profile it if it is sampled """
+    
+    # Nothing to do if nothing is recorded
+    if _recorder is None :
+        return False
+    
+    # Initialize the record of the frame
+    frame = {'frame' : int(j), 'stages' : {}, 'start' : time.perf_counter()}
+    
+    # Profile one frame out of profile_every
+    if _recorder['profile_every'] and j % _recorder['profile_every'] == 0 :
+        frame['profiler'] = cProfile.Profile()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            frame['tracing'] = True
+        tracemalloc.reset_peak()
+        frame['profiler'].enable()
+    
+    _recorder['frame'] = frame
+    
+    return True
+
+
+def end_frame(j, status = 'ok', error = None):
+    """ Stop recording frame j and write its record, with the number of failed attempts to
+        create it before (retries) """
+    
+    # Nothing to do if nothing is recorded
+    if _recorder is None or _recorder['frame'] is None :
+        return False
+    
+    # Gather the information about the frame
+    frame = _recorder['frame']
+    _recorder['frame'] = None
+    record = {'event' : 'frame', 'frame' : frame['frame'], 'status' : status,
+              'retries' : _recorder['failures'].get(frame['frame'], 0),
+              'seconds' : time.perf_counter() - frame['start'], 'stages' : frame['stages']}
+    record.update(frame.get('counts', {}))
+    if error is not None :
+        record['error'] = str(error)
+    
+    # Save the profile of a sampled frame
+    if 'profiler' in frame :
+        frame['profiler'].disable()
+        frame['profiler'].dump_stats(os.path.join(_recorder['profile_folder'], "frame_{:0>5}.prof".format(j)))
+        record['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        if frame.get('tracing'):
+            tracemalloc.stop()
+    
+    return write_record(record)
+
+
+def fail_frame(j, error):
+    """ Record a failed attempt to create frame j. The frame is closed if it is being recorded
+        in this process, else (for example when a stuck worker was killed) only the failure is
+        written """
+    
+    # Nothing to do if nothing is recorded
+    if _recorder is None :
+        return False
+    
+    # Write the failure
+    if _recorder['frame'] is not None and _recorder['frame']['frame'] == j :
+        end_frame(j, 'failed', error)
+    else :
+        write_record({'event' : 'frame', 'frame' : int(j), 'status' : 'failed', 'error' : str(error),
+                      'retries' : _recorder['failures'].get(j, 0), 'stages' : {}})
+    
+    # Count the failures of the frame, which are the retries of its next attempt
+    _recorder['failures'][j] = _recorder['failures'].get(j, 0) + 1
+    
+    return True
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Measure the duration of a stage. Within a frame, it is added to the record of the frame,
+        else it is written as a separate event. It can be used as a context manager or as a
+        function decorator """
+    
+    # Nothing to do if nothing is recorded
+    if _recorder is None :
+        yield
+        return
+    
+    # Measure the duration of the stage
+    start = time.perf_counter()
+    yield
+    duration = time.perf_counter() - start
+    
+    # Store it in the current frame, or as an event
+    frame = _recorder['frame']
+    if frame is not None :
+        frame['stages'][name] = frame['stages'].get(name, 0) + duration
+    else :
+        write_record({'event' : name, 'seconds' : duration})
+
+
+def count(name, value):
+    """ Record a count (for example the number of active trips) in the current frame """
+    
+    # Nothing to do if nothing is recorded
+    if _recorder is None or _recorder['frame'] is None :
+        return False
+    
+    _recorder['frame'].setdefault('counts', {})[name] = int(value)
+    
+    return True
+
+
+def record_event(name, **values):
+    """ Write an event which is not part of a frame """
+    
+    if _recorder is None :
+        return False
+    
+    return write_record(dict(values, event = name))
+
+
+def load_log(path):
+    """ Load a log as a dataframe of frames, with a column per stage """
+    
+    # Read the records
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    
+    # Expand the stages of the frames in columns
+    df_log = pd.json_normalize(records)
+    df_log.columns = [column.replace('stages.', 'stage_') for column in df_log.columns]
+    
+    return df_log
+
+
+def export_log(path, csv_path):
+    """ Convert a log to a csv file, with a line per frame or event and a column per stage """
+    
+    load_log(path).to_csv(csv_path, index = False)
+    
+    return True
+
+
+def summarize_log(path, percentiles = (50, 90, 99)):
+    """ Return a table of the percentiles of the duration of the created frames, of each of
+        their stages and of the other events of the log, and print the number of failed 
+        attempts, the active trips and the peak memory """
+    
+    # Load the log
+    df_log = load_log(path)
+    if 'status' not in df_log : df_log['status'] = None
+    df_frames = df_log[df_log['event'] == 'frame']
+    
+    # Describe the distribution of each duration
+    rows = {}
+    columns = ['seconds'] + [column for column in df_log.columns if column.startswith('stage_')]
+    for column in columns:
+        values = df_frames.loc[df_frames['status'] == 'ok', column].dropna().to_numpy()
+        if len(values) :
+            rows['frame' if column == 'seconds' else column[6:]] = values
+    for name, df_event in df_log[df_log['event'] != 'frame'].groupby('event'):
+        if 'seconds' in df_event and df_event['seconds'].notna().any():
+            rows[name] = df_event['seconds'].dropna().to_numpy()
+    
+    # Gather the statistics of each duration
+    report = pd.DataFrame.from_dict({name : dict([('count', len(values)), ('total', values.sum()),
+                                                  ('mean', values.mean())] +
+                                                 [('p{}'.format(p), np.percentile(values, p)) for p in percentiles] +
+                                                 [('max', values.max())])
+                                     for name, values in rows.items()}, orient = 'index')
+    
+    # Print the other information
+    if len(df_frames):
+        created = df_frames.loc[df_frames['status'] == 'ok', 'frame']
+        lost = set(df_frames['frame']) - set(created)
+        print('frames: {}, failed attempts: {}, lost frames: {}'.format(
+              len(created), int((df_frames['status'] != 'ok').sum()), len(lost)))
+        if 'active_trips' in df_frames :
+            print('active trips: mean {:.0f}, max {:.0f}'.format(df_frames['active_trips'].mean(),
+                                                                df_frames['active_trips'].max()))
+    if 'peak_rss_mb' in df_log and df_log['peak_rss_mb'].notna().any():
+        print('peak memory: {:.0f} MB'.format(df_log['peak_rss_mb'].max()))
+    
+    return report
+
+
+if __name__ == '__main__':
+    
+    # Read the arguments of the command line
+    parser = argparse.ArgumentParser(description = 'Summarize the log of an instrumented run.')
+    parser.add_argument('log', help = 'JSONL log written by start_recording')
+    parser.add_argument('--csv', default = None, help = 'csv file where to export the log')
+    args = parser.parse_args()
+    
+    # Print the summary and export the log
+    print(summarize_log(args.log).to_string(float_format = '{:.4f}'.format))
+    if args.csv is not None :
+        export_log(args.log, args.csv)
@@ -0,0 +1,257 @@
+import folium
+import settings as sgs
+import numpy as np
+import pandas as pd
+from folium import plugins
+from branca.element import MacroElement, Template
+from projection import lonlat_to_world_pixels, world_pixels_to_lonlat
+from network import get_glow_style, add_merged_routes
+from plot_cities import dict_plot_cities, format_popups, add_city_markers
+
+
+def get_zoom_levels(zoom_levels = None):
+    """ Return the sorted zoom levels, by default around the zoom of the map in the settings """
+    
+    if zoom_levels is None :
+        zoom_levels = range(max(sgs._zoom_map - 2, 0), sgs._zoom_map + 4)
+    
+    return sorted(zoom_levels)
+
+
+def cluster_points(latitude, longitude, zoom, cell_pixels, weights = None):
+    """ Group the points which fall in the same square cell of cell_pixels pixels at the given
+        zoom. Returns the cluster of each point, and the latitude and longitude of each cluster
+        (the weighted mean of its points) """
+    
+    # Project the points and find their cells
+    x, y = lonlat_to_world_pixels(longitude, latitude, zoom)
+    cells = np.stack([np.floor(x / cell_pixels), np.floor(y / cell_pixels)], axis = 1)
+    cells, cluster = np.unique(cells, axis = 0, return_inverse = True)
+    cluster = cluster.ravel()
+    
+    # Compute the weighted mean position of each cluster
+    if weights is None : weights = np.ones(len(x))
+    weights = np.asarray(weights, dtype = np.float64) + 1e-9
+    total = np.bincount(cluster, weights, len(cells))
+    cluster_x = np.bincount(cluster, weights * x, len(cells)) / total
+    cluster_y = np.bincount(cluster, weights * y, len(cells)) / total
+    cluster_longitude, cluster_latitude = world_pixels_to_lonlat(cluster_x, cluster_y, zoom)
+    
+    return cluster, cluster_latitude, cluster_longitude
+
+
+def get_cluster_names(names, cluster, weights):
+    """ Name each cluster after its most important member, followed by the number of the 
+        other members """
+    
+    # Sort the members of each cluster by decreasing weight
+    df_members = pd.DataFrame({'name' : names, 'cluster' : cluster, 'weight' : weights})
+    df_members = df_members.sort_values(['cluster', 'weight'], ascending = [True, False])
+    
+    # Catch the main member and the number of members
+    df_clusters = df_members.groupby('cluster').agg(name = ('name', 'first'), size = ('name', 'size'))
+    others = np.where(df_clusters['size'] > 1,
+                      ' (+' + (df_clusters['size'] - 1).astype(str) + ')', '')
+    
+    return (df_clusters['name'] + others).to_numpy()
+
+
+def simplify_network(df_flux, zoom, thin = False, cell_pixels = 12, min_pixels = 4, min_weight = 0.5):
+    """ Return a simplified version of df_flux, as seen at the given zoom: the cities which
+        are closer than cell_pixels are clustered, the routes between the same clusters are 
+        bundled into a single route carrying their summed flux, and the routes shorter than 
+        min_pixels or whose outer line is thinner than min_weight pixels are dropped """
+    
+    # Gather the cities of all routes, with the flux passing through them
+    df_cities = pd.concat([
+        df_flux[['from_city','from_latitude','from_longitude','flux']].set_axis(['city','latitude','longitude','flux'], axis = 1),
+        df_flux[['to_city','to_latitude','to_longitude','flux']].set_axis(['city','latitude','longitude','flux'], axis = 1)
+    ]).groupby('city', as_index = False).agg(latitude = ('latitude','first'), longitude = ('longitude','first'),
+                                             flux = ('flux','sum'))
+    
+    # Cluster the cities
+    cluster, latitude, longitude = cluster_points(df_cities['latitude'], df_cities['longitude'], zoom,
+                                                  cell_pixels, df_cities['flux'])
+    names = get_cluster_names(df_cities['city'], cluster, df_cities['flux'])
+    cluster_of_city = dict(zip(df_cities['city'], cluster))
+    
+    # Move the routes to the clusters, with their cities in alphabetical order
+    from_cluster = df_flux['from_city'].map(cluster_of_city).to_numpy()
+    to_cluster = df_flux['to_city'].map(cluster_of_city).to_numpy()
+    first, second = np.minimum(from_cluster, to_cluster), np.maximum(from_cluster, to_cluster)
+    
+    # Bundle the routes between the same clusters, except those within a single cluster
+    flux_columns = list(df_flux.columns[6:])
+    df_routes = df_flux[flux_columns].copy()
+    df_routes['first'], df_routes['second'] = first, second
+    df_routes = df_routes[first != second].groupby(['first','second'], as_index = False)[flux_columns].sum()
+    
+    # Describe the bundled routes in the same format as df_flux
+    first, second = df_routes['first'].to_numpy(), df_routes['second'].to_numpy()
+    df_simplified = pd.DataFrame({
+        'from_city' : names[first], 'from_latitude' : latitude[first], 'from_longitude' : longitude[first],
+        'to_city' : names[second], 'to_latitude' : latitude[second], 'to_longitude' : longitude[second]
+    })
+    df_simplified[flux_columns] = df_routes[flux_columns].to_numpy()
+    
+    # Drop the routes which would not be visible at this zoom
+    colors, opacities, weight = get_glow_style(thin)
+    from_x, from_y = lonlat_to_world_pixels(df_simplified['from_longitude'], df_simplified['from_latitude'], zoom)
+    to_x, to_y = lonlat_to_world_pixels(df_simplified['to_longitude'], df_simplified['to_latitude'], zoom)
+    length = np.hypot(to_x - from_x, to_y - from_y)
+    outer_weight = np.log2(df_simplified['flux'].to_numpy()) * len(colors) * weight
+    
+    return df_simplified[(length >= min_pixels) & (outer_weight >= min_weight)].reset_index(drop = True)
+
+
+def cluster_cities(df, arg, zoom, cell_pixels = 24, columns = []):
+    """ Return a version of the cities dataframe as seen at the given zoom, in which the cities
+        closer than cell_pixels are merged and their values of the arg column, and of the
+        other given columns, are summed """
+    
+    # Cluster the cities, weighted by the displayed value
+    weights = df[arg].abs().to_numpy()
+    cluster, latitude, longitude = cluster_points(df['latitude'], df['longitude'], zoom, cell_pixels, weights)
+    
+    # Describe the clusters in the same format as the cities dataframe
+    df_clusters = pd.DataFrame({
+        'city_name' : get_cluster_names(df['city_name'], cluster, weights),
+        'latitude' : latitude,
+        'longitude' : longitude
+    })
+    for column in [arg] + columns:
+        df_clusters[column] = np.bincount(cluster, df[column].to_numpy(dtype = np.float64), len(latitude))
+    
+    return df_clusters
+
+
+def get_city_style(df_, arg):
+    """ Return the popup messages and the colours of the cities, as drawn by plot_cities,
+        plot_cities_import_export and plot_cities_transiting_flux """
+    
+    # Net exporters are displayed in green, net importers in red
+    if arg == 'import_export' :
+        is_exporter = (df_[arg] > 0).to_numpy()
+        popup = format_popups("{}<br> Net coal {}: {} thousands tons", df_["city_name"],
+                              np.where(is_exporter, "export", "import"),
+                              (df_[arg].abs()*sgs._ktons_per_unit).astype(int))
+        return popup, np.where(is_exporter, "#309632", "#BA160C")
+    
+    # The transit is displayed in violet, with the arriving and departing flux
+    if arg == 'transiting_flux' :
+        popup = "{}<br> Arriving coal: {} thousands tons<br>"
+        popup += "Departing coal: {} thousands tons<br> Total coal transit: {} thousands tons"
+        popup = format_popups(popup, df_["city_name"],
+                              (df_['arriving_flux'].abs()*sgs._ktons_per_unit).astype(int),
+                              (df_['departing_flux'].abs()*sgs._ktons_per_unit).astype(int),
+                              (df_['transiting_flux'].abs()*sgs._ktons_per_unit).astype(int))
+        return popup, ['#A85CE8'] * len(df_)
+    
+    # Else, catch the popup messages and the colour matching the data which is plotted
+    popup = format_popups(dict_plot_cities[arg][0], df_["city_name"],
+                          (df_[arg].abs()*sgs._ktons_per_unit).astype(int))
+    
+    return popup, [dict_plot_cities[arg][1]] * len(df_)
+
+
+def add_zoom_switch(folium_map, layers):
+    """ Add to the map the script which only displays, at each zoom, the layer of the highest 
+        zoom level which is not above it. layers is a list of (zoom level, layer) """
+    
+    # Describe the layers in javascript
+    switch = MacroElement()
+    switch._name = 'ZoomSwitch'
+    switch._template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = [
+                {%- for zoom, layer in this.layers %}
+                [{{ zoom }}, {{ layer.get_name() }}],
+                {%- endfor %}
+            ];
+            function {{ this.get_name() }}_update() {
+                var zoom = {{ this._parent.get_name() }}.getZoom();
+                var shown = {{ this.get_name() }}[0][0];
+                {{ this.get_name() }}.forEach(function(level) { if (level[0] <= zoom) { shown = level[0]; } });
+                {{ this.get_name() }}.forEach(function(level) {
+                    if (level[0] == shown) { {{ this._parent.get_name() }}.addLayer(level[1]); }
+                    else { {{ this._parent.get_name() }}.removeLayer(level[1]); }
+                });
+            }
+            {{ this._parent.get_name() }}.on('zoomend', {{ this.get_name() }}_update);
+            {{ this.get_name() }}_update();
+        {% endmacro %}
+        """)
+    switch.layers = layers
+    switch.add_to(folium_map)
+    
+    return folium_map
+
+
+def get_lod_base_image_map(df_flux, zoom_levels = None, thin = False):
+    """ Create the beautiful folium map of the routes with a level of detail per zoom level: 
+        each level is a simplified network (see simplify_network) drawn with merged routes,
+        and the map displays the level matching its current zoom """
+    
+    # Initialize folium map parameters
+    folium_map = folium.Map(location = sgs._location_map,
+                            zoom_start = sgs._zoom_map,
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
+    
+    # Establish the shading of colors and opacities of the lightning effect
+    colors, opacities, weight = get_glow_style(thin)
+    
+    # Draw the simplified network of each zoom level in its own layer
+    layers = []
+    for zoom in get_zoom_levels(zoom_levels):
+        df_simplified = simplify_network(df_flux, zoom, thin)
+        layer = folium.FeatureGroup(name = 'zoom {}'.format(zoom), control = False).add_to(folium_map)
+        add_merged_routes(layer, df_simplified, np.zeros(len(df_simplified), dtype = int), [colors], opacities, weight)
+        layers.append((zoom, layer))
+    
+    return add_zoom_switch(folium_map, layers)
+
+
+def plot_cities_lod(df, arg, zoom_levels = None):
+    """ Same as plot_cities, with a level of detail per zoom level: at each level, the cities
+        which would overlap are merged (see cluster_cities), and the map displays the level
+        matching its current zoom. arg can also be 'import_export' or 'transiting_flux', 
+        drawn as by plot_cities_import_export and plot_cities_transiting_flux """
+    
+    # Calculate net export, and sum the arriving and departing flux of the merged cities
+    # for the popups of the transit
+    if arg == 'import_export' :
+        df = df.assign(import_export = df['production'] - df['consumption'])
+    columns = ['arriving_flux', 'departing_flux'] if arg == 'transiting_flux' else []
+    
+    # Remove the cities whose net value is null
+    df_ = df[df[arg]!=0]
+    
+    # Specify parameters of the folium map
+    folium_map = folium.Map(location = sgs._location_map,
+                            zoom_start = sgs._zoom_map,
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
+    
+    # Draw the clustered cities of each zoom level in its own layer
+    layers = []
+    for zoom in get_zoom_levels(zoom_levels):
+        df_clusters = cluster_cities(df_, arg, zoom, columns = columns)
+        
+        # Catch the popup messages and the colour matching the data which is plotted
+        popup, color = get_city_style(df_clusters, arg)
+        
+        # Define the radius of the circles so that their surface is proportional the the scalar
+        radius = np.sqrt((df_clusters[arg].abs()).to_numpy())/np.pi
+        
+        # Add the markers in a single GeoJSON layer
+        layer = folium.FeatureGroup(name = 'zoom {}'.format(zoom), control = False).add_to(folium_map)
+        add_city_markers(layer, df_clusters, radius, color, popup, 'geojson')
+        layers.append((zoom, layer))
+    
+    # Enable folium measure tool and fullscreen plugin
+    plugins.MeasureControl(primary_length_unit='kilometers',
+                           primary_area_unit='sqkilometers').add_to(folium_map)
+    plugins.Fullscreen().add_to(folium_map)
+    
+    return add_zoom_switch(folium_map, layers)
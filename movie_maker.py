@@ -1,9 +1,21 @@
 import settings as sgs
 from framer import *
+from raster_framer import *
+from position_store import *
+from instrumentation import stage, start_frame, end_frame, fail_frame
+from browser_pool import close_browser_pool
+from spatial_index import use_region, select_region
 import datetime
 import imageio
 import signal
 import numpy as np
+import os
+import time
+import queue
+import functools
+import contextlib
+import multiprocessing
+import multiprocessing.connection
 
 
 def handler(signum, frame):
@@ -13,20 +25,77 @@ def handler(signum, frame):
     raise Exception("| end of time")
     
     
-def screenshot(j, df_trips, df_flux):
+def screenshot(j, df_trips, df_flux, cursor = None):
     """ Returns a screenshot in png format of the desired frame """
     
     # Compute absolute time
     current_time = sgs._start_time + datetime.timedelta(minutes=(np.around(60/sgs._hourly_rate))*j)
     
     # Using the go_frame function, create a png image representing the simulation at the given time
-    go_frame((j, current_time), df_trips, df_flux)
+    start_frame(j)
+    go_frame((j, current_time), df_trips, df_flux, cursor)
+    end_frame(j)
     print('·',end='')
     
     return True
 
 
-def serial_framer(begin, end, df_trips, df_flux):
+def screenshot_image(j, df_trips, df_flux, cursor = None, save_png = False, bbox = None):
+    """ Returns the image of the desired frame as an array, optionally saving it in png. Only
+        the trips inside the bounding box are placed, if it is given """
+    
+    # Compute absolute time
+    current_time = sgs._start_time + datetime.timedelta(minutes=(np.around(60/sgs._hourly_rate))*j)
+    
+    # Using the render_frame function, create an image representing the simulation at the given time
+    start_frame(j)
+    image = render_frame(current_time, df_trips, df_flux, cursor, bbox).convert('RGB')
+    if save_png :
+        with stage('save'):
+            image.save(sgs._png_folder + "frame_{:0>5}.png".format(j))
+    end_frame(j)
+    
+    return np.asarray(image)
+
+
+def raster_image(j, cursor, base, save_png = False):
+    """ Same as screenshot_image, but draws the frame with raster_framer """
+    
+    # Compute absolute time
+    current_time = sgs._start_time + datetime.timedelta(minutes=(np.around(60/sgs._hourly_rate))*j)
+    
+    # Draw an image representing the simulation at the given time
+    start_frame(j)
+    image = render_raster_frame(current_time, cursor, base)
+    if save_png :
+        with stage('save'):
+            image.save(sgs._png_folder + "frame_{:0>5}.png".format(j))
+    end_frame(j)
+    
+    return np.asarray(image)
+
+
+def stored_image(j, store, base, save_png = False):
+    """ Same as raster_image, but reads the positions of the trips from a position store (see 
+        position_store.py) instead of computing them """
+    
+    # Compute absolute time
+    current_time = sgs._start_time + datetime.timedelta(minutes=(np.around(60/sgs._hourly_rate))*j)
+    
+    # Draw an image representing the simulation at the given time
+    start_frame(j)
+    with stage('positions'):
+        positions = get_stored_positions(store, j)
+    image = draw_raster_frame(current_time, positions, base)
+    if save_png :
+        with stage('save'):
+            image.save(sgs._png_folder + "frame_{:0>5}.png".format(j))
+    end_frame(j)
+    
+    return np.asarray(image)
+
+
+def serial_framer(begin, end, df_trips, df_flux, cursor = None):
     """ This function will automatically create snapshots until it fails """
     
     # Initialize variable
@@ -42,13 +111,14 @@ def serial_framer(begin, end, df_trips, df_flux):
         # Try to create a png snapshot of the simulation at the given time
         try:
             print(j,end='')
-            screenshot(j, df_trips, df_flux)
+            screenshot(j, df_trips, df_flux, cursor)
             
         # If the time of computation exceeds 30 seconds, we assume that the operation is somehow blocked
         except Exception as e :
             
             # Print the exception handling message
             print(e)
+            fail_frame(j, e)
             
             # Store carefully the frame which couldn't be created and return it
             failed_at = j
@@ -60,6 +130,10 @@ def serial_framer(begin, end, df_trips, df_flux):
 def coach(df_trips, df_flux, begin = 0, end = sgs._simulation_duration):
     """ Calls the serial framer each time he fails until the work is done """
     
+    # As the frames are created in increasing time order, a sweep cursor follows the
+    # active trips from one frame to the next
+    cursor = new_sweep_cursor(build_trip_index(df_trips))
+    
     # First initialisation of the maximal time of computation to 30 seconds
     signal.signal(signal.SIGALRM, handler)
     signal.alarm(30)
@@ -70,7 +144,7 @@ def coach(df_trips, df_flux, begin = 0, end = sgs._simulation_duration):
         # Create frames until the serial framer fails. Then store the last frame which the
         # serial framer attempted to create and fix it as the next first frame to be created
         # in the next iteration
-        last = serial_framer(begin, end, df_trips, df_flux)
+        last = serial_framer(begin, end, df_trips, df_flux, cursor)
         begin = last
     
     print(end)
@@ -78,21 +152,298 @@ def coach(df_trips, df_flux, begin = 0, end = sgs._simulation_duration):
     return True
 
 
-def movie_maker(begin = 0, end = sgs._simulation_duration):
-    """ Creates a mp4 movie from the png frames of the simulation """
+def frame_worker(render, tasks, results):
+    """ Render the frames received from the tasks queue until None is received, and send the
+        results through the results connection, which belongs to this worker only """
+    
+    # Wait for the next frame to render
+    for j in iter(tasks.get, None):
+        
+        # Send back the result of the rendering, or the error if it failed
+        try:
+            result = (os.getpid(), j, True, render(j))
+        except Exception as e :
+            fail_frame(j, repr(e))
+            result = (os.getpid(), j, False, repr(e))
+        results.send(result)
+    
+    # Close the browsers of the worker, as the processes do not run the exit functions
+    close_browser_pool()
+    
+    return True
+
+
+def parallel_frames(frames, render, n_workers = None, timeout = 30, retries = 2, max_pending = None):
+    """ Render the frames in several processes and yield (frame, success, result) as soon as
+        each frame is done, so possibly out of order. A frame which raises an error or which
+        takes more than timeout seconds is retried, and its worker is killed and replaced if
+        it is stuck. When a frame fails more than retries times, it is yielded as a failure
+        with the error message as result, without stopping the other frames. If max_pending 
+        is given, no frame is sent more than max_pending frames ahead of the oldest frame 
+        which is not done yet """
+    
+    # Initialize variables
+    frames = list(frames)
+    if n_workers is None : n_workers = os.cpu_count()
+    if max_pending is None : max_pending = len(frames)
+    position = {j: k for k, j in enumerate(frames)}
+    todo, done, attempts = list(frames), set(), {j: 0 for j in frames}
+    oldest = 0
+    
+    # Processes are forked when possible, so that they share the data and the settings
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else :
+        context = multiprocessing.get_context()
+    
+    def start_worker():
+        """ Start a new worker process with its own queue of tasks and its own connection for
+            the results, so that killing a worker cannot break what the others send """
+        tasks = context.Queue()
+        results, sender = context.Pipe(duplex = False)
+        process = context.Process(target = frame_worker, args = (render, tasks, sender), daemon = True)
+        process.start()
+        sender.close()
+        return {'process' : process, 'tasks' : tasks, 'results' : results, 'frame' : None, 'started' : None}
+    
+    def stop_worker(worker, timeout):
+        """ Ask a worker to stop once its frame is done, and kill it if it does not stop in
+            time. As nothing else uses its queue and its connection, they are simply closed """
+        if worker['process'].is_alive():
+            worker['tasks'].put(None)
+            worker['process'].join(timeout = timeout)
+        if worker['process'].is_alive():
+            worker['process'].terminate()
+            worker['process'].join()
+        worker['tasks'].cancel_join_thread()
+        worker['results'].close()
+    
+    def failure(j, error):
+        """ Put the frame back in the list if it can be retried, else report the failure """
+        attempts[j] += 1
+        if attempts[j] <= retries :
+            todo.insert(0, j)
+            return None
+        done.add(j)
+        return (j, False, error)
+    
+    # Start the workers
+    workers = {}
+    for k in range(min(n_workers, len(frames))):
+        worker = start_worker()
+        workers[worker['process'].pid] = worker
+    
+    try:
+        
+        # Iterate until all frames are done
+        while len(done) < len(frames):
+            
+            # Send frames to the idle workers, without going too far ahead of the oldest frame
+            while oldest < len(frames) and frames[oldest] in done :
+                oldest += 1
+            for worker in workers.values():
+                if worker['frame'] is None and todo and position[todo[0]] < oldest + max_pending :
+                    worker['frame'], worker['started'] = todo.pop(0), time.time()
+                    worker['tasks'].put(worker['frame'])
+            
+            # Collect the results of the frames
+            reports = []
+            ready = multiprocessing.connection.wait([worker['results'] for worker in workers.values()], timeout = 0.1)
+            for worker in workers.values():
+                if worker['results'] not in ready : continue
+                try:
+                    pid, j, success, value = worker['results'].recv()
+                except EOFError :
+                    continue
+                if worker['frame'] == j :
+                    worker['frame'] = None
+                    if success :
+                        done.add(j)
+                        reports.append((j, True, value))
+                    else :
+                        reports.append(failure(j, value))
+            
+            # Replace the workers which died, and those which are stuck on a frame
+            for pid in list(workers):
+                worker = workers[pid]
+                if not worker['process'].is_alive():
+                    error = "| worker died"
+                elif worker['frame'] is not None and time.time() - worker['started'] > timeout :
+                    error = "| end of time"
+                else : continue
+                stop_worker(worker, 0)
+                del workers[pid]
+                if worker['frame'] is not None :
+                    fail_frame(worker['frame'], error)
+                    reports.append(failure(worker['frame'], error))
+                worker = start_worker()
+                workers[worker['process'].pid] = worker
+            
+            # Report the frames which are done
+            for report in reports:
+                if report is not None :
+                    yield report
+    
+    # Stop the workers, even if the iteration was interrupted
+    finally:
+        for worker in workers.values():
+            stop_worker(worker, 1)
+
+
+def parallel_coach(df_trips, df_flux, begin = 0, end = sgs._simulation_duration, n_workers = None,
+                   timeout = 30, retries = 2):
+    """ Same as coach, but spreads the frames over several worker processes. Returns the list
+        of the frames which could not be created """
+    
+    # Each worker follows the active trips of its frames with its own sweep cursor
+    render = functools.partial(screenshot, df_trips = df_trips, df_flux = df_flux,
+                               cursor = new_sweep_cursor(build_trip_index(df_trips)))
+    
+    # Initialize variable
+    failed = []
+    
+    # Create the frames and store carefully the ones which couldn't be created
+    for j, success, value in parallel_frames(range(begin, end), render, n_workers, timeout, retries):
+        if not success :
+            print(j, value)
+            failed.append(j)
+    
+    print(end)
+    
+    return failed
+
+
+def movie_maker(begin = 0, end = sgs._simulation_duration, filename = 'movie.mp4'):
+    """ Creates a mp4 movie from the png frames of the simulation between the begin and end
+        frames, numbered as in screenshot """
     
     # Initialize variable
     filenames = []
     
     # Load all png images of the simulation
-    for i in range(end - begin):
+    for i in range(begin, end):
         filenames.append(sgs._png_folder + "frame_{:0>5}.png".format(i))
     
     # Create a mp4 movie from all snapshots
-    with imageio.get_writer(sgs._mp4_folder + 'movie.mp4', mode='I') as writer:
+    with imageio.get_writer(os.path.join(sgs._mp4_folder, filename), mode='I') as writer:
         for filename in filenames:
             image = imageio.imread(filename)
             writer.append_data(image)
     
     return True
 
+
+
+def get_movie_writer(filename = 'movie.mp4', fps = 10, codec = 'libx264', quality = 5, threads = None):
+    """ Open a mp4 writer in the mp4 folder (or at the given path if it is absolute). A higher
+        quality (from 0 to 10) gives a bigger file, and the number of threads of the encoder 
+        can be limited """
+    
+    # Additional parameters given to ffmpeg
+    ffmpeg_params = None
+    if threads is not None :
+        ffmpeg_params = ['-threads', str(threads)]
+    
+    return imageio.get_writer(os.path.join(sgs._mp4_folder, filename), mode='I', fps = fps, codec = codec,
+                              quality = quality, ffmpeg_params = ffmpeg_params)
+
+
+def stream_frames(writer, frames, render, n_workers = 1, buffer_size = 16, timeout = 30, retries = 2):
+    """ Render the frames and append them to the writer in the order of the frames, without
+        intermediate files. With several workers, the frames which are done ahead of their
+        turn wait in a buffer, and no frame is rendered more than buffer_size frames ahead of
+        the next frame to write. A frame which could not be rendered is replaced by the 
+        previous one, or by the first rendered frame if there is no previous one, so that 
+        the movie always has all its frames. Returns the list of the frames which could not
+        be rendered, and raises an error if none could be """
+    
+    # Initialize variables
+    frames = list(frames)
+    buffer, failed, previous, missing = {}, [], None, 0
+    
+    # With a single worker, the frames are simply rendered in order
+    if n_workers <= 1 :
+        results = ((j, True, render(j)) for j in frames)
+    else :
+        results = parallel_frames(frames, render, n_workers, timeout, retries, max_pending = buffer_size)
+    
+    # Store the frames as they arrive
+    k = 0
+    for j, success, image in results:
+        buffer[j] = image if success else None
+        if not success :
+            print(j, image)
+            failed.append(j)
+        
+        # Write all the frames whose turn has come
+        while k < len(frames) and frames[k] in buffer :
+            image = buffer.pop(frames[k])
+            if image is None : image = previous
+            
+            # The failed frames before the first rendered frame wait for it
+            if image is None :
+                missing += 1
+            else :
+                with stage('encode'):
+                    for copy in range(missing + 1):
+                        writer.append_data(image)
+                missing = 0
+            previous = image
+            k += 1
+    
+    if missing :
+        raise ValueError("none of the frames {} to {} could be rendered".format(frames[0], frames[-1]))
+    
+    return failed
+
+
+def movie_streamer(df_trips, df_flux, begin = 0, end = sgs._simulation_duration, renderer = 'raster',
+                   n_workers = 1, buffer_size = 16, save_png = False, filename = 'movie.mp4',
+                   fps = 10, codec = 'libx264', quality = 5, threads = None, store_folder = None, bbox = None):
+    """ Creates the mp4 movie of the simulation directly from the rendered frames, with the 
+        'raster' renderer of raster_framer.py or with the 'folium' screenshots. Writing the 
+        png frames is optional. If the folder of a position store is given, the raster
+        renderer reads the positions from it instead of simulating the trips. If a bounding
+        box (south, west, north, east) is given, the movie shows this region (see 
+        spatial_index.py), and only the routes and the trips which can be seen are drawn.
+        Returns the list of the frames which could not be rendered """
+    
+    # The folium maps are drawn from the trips, not from the stored positions
+    if renderer == 'folium' and store_folder is not None :
+        raise ValueError("the position store can only be read by the 'raster' renderer.")
+    
+    # Center the frames on the region while they are rendered, the settings being put back
+    # afterwards, and leave out what cannot be seen
+    with use_region(bbox) if bbox is not None else contextlib.nullcontext() as bbox:
+        if bbox is not None and store_folder is None :
+            df_flux, df_trips = select_region(bbox, df_flux, df_trips)
+        elif bbox is not None :
+            df_flux, = select_region(bbox, df_flux)
+        
+        # As the frames are created in increasing time order, a sweep cursor follows the
+        # active trips from one frame to the next
+        if store_folder is None :
+            cursor = new_sweep_cursor(build_trip_index(df_trips))
+        
+        # Prepare the function rendering a frame
+        if renderer == 'raster' :
+            with stage('build_raster_base'):
+                base = build_raster_base(df_flux)
+        if renderer == 'raster' and store_folder is not None :
+            render = functools.partial(stored_image, store = load_position_store(store_folder),
+                                       base = base, save_png = save_png)
+        elif renderer == 'raster' :
+            render = functools.partial(raster_image, cursor = cursor, base = base, save_png = save_png)
+        elif renderer == 'folium' :
+            render = functools.partial(screenshot_image, df_trips = df_trips, df_flux = df_flux,
+                                       cursor = cursor, save_png = save_png, bbox = bbox)
+        else :
+            raise ValueError("renderer should be either 'raster' or 'folium'.")
+        
+        # Render the frames directly into the mp4 movie
+        with get_movie_writer(filename, fps, codec, quality, threads) as writer:
+            failed = stream_frames(writer, range(begin, end), render, n_workers, buffer_size)
+    
+    print(end)
+    
+    return failed
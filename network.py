@@ -1,15 +1,23 @@
 import folium
 import settings as sgs
 import numpy as np
+import pandas as pd
+import hashlib
+from collections import OrderedDict
+from branca.element import MacroElement, Template
+from flow_model import build_flow_model, get_route_flux
 
 
-def get_beautiful_base_image_map(df_flux, thin=False):
-    """ Create the beautiful folium map containing routes, with blur effect """
-    
-    # Initialize folium map parameters
-    folium_map = folium.Map(location = sgs._location_map,
-                            zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+# Cache of the rendered route layers, from the least to the most recently used
+_base_layer_cache = OrderedDict()
+
+# Maximal number of route layers kept in the cache
+_base_layer_cache_size = 8
+
+
+def get_glow_style(thin=False):
+    """ Return the colors, opacities and weight factor of the successive layers which create
+        the lightning effect of the routes """
     
     # From outer to inner, establish a beautiful shading of colors and opacities in order
     # to create a lightning effect
@@ -24,6 +32,83 @@ def get_beautiful_base_image_map(df_flux, thin=False):
     else :
         opacities = [.18, .23, .8]
         weight = 1/5
+    
+    return colors, opacities, weight
+
+
+def get_route_categories(df_flux):
+    """ Return two boolean arrays telling if each route carries land flux and naval flux """
+    
+    # Sum the land flux types and the naval flux types of every route
+    model = build_flow_model(df_flux)
+    land = get_route_flux(model, 'land') > 0
+    naval = get_route_flux(model, 'naval') > 0
+    
+    return land, naval
+
+
+def add_merged_routes(folium_map, df_flux, bands, colors, opacities, weight, weight_step = 0.5):
+    """ Draw the routes with a single GeoJSON layer, in which each layer of the lightning effect
+        and each color band is one multi-line feature per line weight. bands gives the index
+        of the color band of each route in colors, or -1 if the route is not displayed. Routes 
+        of the same band between the same cities in opposite directions are merged, and their
+        weights are rounded to weight_step, so that the size of the map depends on the number 
+        of styles rather than on the number of routes """
+    
+    # Gather the displayed routes, with their cities in alphabetical order
+    df_routes = df_flux[['from_city','from_latitude','from_longitude',
+                         'to_city','to_latitude','to_longitude','flux']][bands >= 0].copy()
+    df_routes['band'] = bands[bands >= 0]
+    reverse = (df_routes['from_city'] > df_routes['to_city']).to_numpy()
+    for a, b in [('from_city','to_city'), ('from_latitude','to_latitude'), ('from_longitude','to_longitude')]:
+        df_routes.loc[reverse, [a, b]] = df_routes.loc[reverse, [b, a]].to_numpy()
+    
+    # Merge the routes of the same band between the same cities, and round their weights
+    df_routes = df_routes.groupby(['band','from_city','to_city'], as_index = False).agg(
+        from_latitude = ('from_latitude', 'first'), from_longitude = ('from_longitude', 'first'),
+        to_latitude = ('to_latitude', 'first'), to_longitude = ('to_longitude', 'first'),
+        flux = ('flux', 'sum'))
+    df_routes['log_flux'] = np.around(np.log2(df_routes['flux']) / weight_step) * weight_step
+    
+    # Create a multi-line feature per layer of the lightning effect, band and weight
+    features = []
+    for i in range(len(opacities)):
+        for (band, log_flux), df_group in df_routes.groupby(['band','log_flux']):
+            features.append({
+                'type' : 'Feature',
+                'geometry' : {'type' : 'MultiLineString',
+                              'coordinates' : df_group[['to_longitude','to_latitude',
+                                                        'from_longitude','from_latitude']].to_numpy().reshape(-1, 2, 2).tolist()},
+                'properties' : {'style' : {'color' : colors[band][i],
+                                           'opacity' : float(opacities[i]),
+                                           'weight' : float(log_flux*(len(opacities)-i)*weight)}}
+            })
+    
+    # Add the features on the folium map. Leaflet does not read the style of the properties
+    # by itself, so the style function gives it for each feature
+    folium.GeoJson({'type' : 'FeatureCollection', 'features' : features},
+                   style_function = lambda feature: feature['properties']['style']).add_to(folium_map)
+    
+    return folium_map
+
+
+def get_beautiful_base_image_map(df_flux, thin=False, merged=False):
+    """ Create the beautiful folium map containing routes, with blur effect. In the merged mode,
+        the routes are drawn by a few GeoJSON features (see add_merged_routes) """
+    
+    # Initialize folium map parameters
+    folium_map = folium.Map(location = sgs._location_map,
+                            zoom_start = sgs._zoom_map,
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
+    
+    # Establish the shading of colors and opacities of the lightning effect
+    colors, opacities, weight = get_glow_style(thin)
+    
+    # In the merged mode, all routes are in the same color band
+    if merged :
+        return add_merged_routes(folium_map, df_flux, np.zeros(len(df_flux), dtype = int),
+                                 [colors], opacities, weight)
         
     # The process is doubled because of a bug from folium which sometimes doesn't draw the line    
     for j in range(2):
@@ -44,10 +129,10 @@ def get_beautiful_base_image_map(df_flux, thin=False):
     return folium_map
 
 
-def get_beautiful_tricolor_base_image_map(df_flux):
+def get_beautiful_tricolor_base_image_map(df_flux, merged=False):
     """ Create the beautiful folium map containing routes, with blur effect. In this variant,
         the naval trade routes will be displayed in blue. Land+naval routes will be displayed
-        in green """
+        in green. In the merged mode, the routes are drawn by a few GeoJSON features """
     
     # This tricolor representation only make sense if the naval mode is enabled
     if sgs._enable_Naval :
@@ -55,7 +140,8 @@ def get_beautiful_tricolor_base_image_map(df_flux):
         # Initialize folium map parameters
         folium_map = folium.Map(location = sgs._location_map,
                                 zoom_start = sgs._zoom_map,
-                                tiles = "CartoDB dark_matter")
+                                tiles = sgs._tiles,
+                                attr = sgs._tiles_attr)
     
         # From outer to inner, establish a beautiful shading of colors and opacities in order
         # to create a lightning effect
@@ -64,17 +150,19 @@ def get_beautiful_tricolor_base_image_map(df_flux):
                   ['#00CE18','#25CE39','#B4E1B9']] # green for land+naval routes
         opacities = [.18, .23, .8]
         
+        # Select land flux, naval flux or heterogenous flux for all routes at once
+        land, naval = get_route_categories(df_flux)
+        bands = np.where(land, np.where(naval, 2, 0), 1)
+        
+        # In the merged mode, draw the color bands of all routes at once
+        if merged :
+            return add_merged_routes(folium_map, df_flux, bands, colors, opacities, 1/5)
+        
         # The process is doubled because of a bug from folium which sometimes doesn't draw the line    
         for j in range(2):
             
             # Iterate on all routes to draw
-            for ind_, row in df_flux.iterrows():
-            
-                # Select land flux, naval flux or heterogenous flux
-                if sum(row[6:6+sgs._Ntypes_production]) > 0 :
-                    if sum(row[16:16+sgs._Ntypes_production]) > 0: I = 2
-                    else : I = 0
-                else : I = 1
+            for (ind_, row), I in zip(df_flux.iterrows(), bands):
                     
                 # Iterate over the successive layers of colors/weights/opacities which result in the lightning effect    
                 for i in range(len(colors[I])):
@@ -93,14 +181,16 @@ def get_beautiful_tricolor_base_image_map(df_flux):
     return folium_map
 
 
-def get_beautiful_base_image_map_by_route_category(df_flux, mode):
+def get_beautiful_base_image_map_by_route_category(df_flux, mode, merged=False):
     """ Create the beautiful folium map containing routes, with blur effect. In this variant,
-        depending on the mode ('naval' or 'land'), only land or naval routes will be displayed """
+        depending on the mode ('naval' or 'land'), only land or naval routes will be displayed.
+        In the merged mode, the routes are drawn by a few GeoJSON features """
     
     # Initialize folium map parameters
     folium_map = folium.Map(location = sgs._location_map,
                             zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
         
     # This tricolor representation only make sense if the naval mode is enabled
     if sgs._enable_Naval :
@@ -120,22 +210,20 @@ def get_beautiful_base_image_map_by_route_category(df_flux, mode):
         
         opacities = [.18, .23, .8]
         
+        # Select the routes of the wished category at once
+        land, naval = get_route_categories(df_flux)
+        is_of_category = {'land' : land, 'naval' : naval}.get(mode, np.zeros(len(df_flux), dtype = bool))
+        
+        # In the merged mode, draw them all at once
+        if merged and mode in ['land', 'naval'] :
+            bands = np.where(is_of_category, 0, -1)
+            return add_merged_routes(folium_map, df_flux, bands, [colors], opacities, 1/5)
+        
         # The process is doubled because of a bug from folium which sometimes doesn't draw the line    
         for j in range(2):
             
             # Iterate on all routes to draw
-            for ind_, row in df_flux.iterrows():
-                
-                # Initialize variable
-                is_of_route_category = False
-                
-                # Test if the route is a land route 
-                if (sum(row[6:6+sgs._Ntypes_production]) > 0) & (mode == 'land') :
-                    is_of_route_category = True
-                    
-                # Test if the route is a naval route
-                elif (sum(row[16:16+sgs._Ntypes_production]) > 0) & (mode == 'naval') :
-                    is_of_route_category = True
+            for (ind_, row), is_of_route_category in zip(df_flux.iterrows(), is_of_category):
                 
                 # Route is only plotted if it is of the wished category
                 if is_of_route_category:
@@ -157,3 +245,86 @@ def get_beautiful_base_image_map_by_route_category(df_flux, mode):
     
     return folium_map
 
+
+
+def get_flux_fingerprint(df_flux):
+    """ Return a hash of the content of the flux dataframe """
+    
+    # Hash the values of every row, as well as the names of the columns
+    hashed_rows = pd.util.hash_pandas_object(df_flux, index = True).to_numpy()
+    fingerprint = hashlib.sha1(hashed_rows.tobytes())
+    fingerprint.update(repr(list(df_flux.columns)).encode())
+    
+    return fingerprint.hexdigest()
+
+
+def build_base_layer(df_flux, variant):
+    """ Build the base map of the given variant ('normal', 'thin', 'tricolor', 'land' or 'naval')
+        and return the javascript code drawing its routes, where the name of the map is 
+        replaced by __MAP__ """
+    
+    # Build the base map of the requested variant
+    if variant == 'normal' : folium_map = get_beautiful_base_image_map(df_flux)
+    elif variant == 'thin' : folium_map = get_beautiful_base_image_map(df_flux, True)
+    elif variant == 'tricolor' : folium_map = get_beautiful_tricolor_base_image_map(df_flux)
+    elif variant in ['land', 'naval'] :
+        folium_map = get_beautiful_base_image_map_by_route_category(df_flux, variant)
+    else :
+        raise ValueError("variant should be 'normal', 'thin', 'tricolor', 'land' or 'naval'.")
+    
+    # Render the map, which writes the javascript code of every element in the figure
+    figure = folium_map.get_root()
+    figure.render()
+    
+    # Gather the code of the routes, but not the one of the tiles which every map already has
+    scripts = [figure.script._children[name].render() for name, child in folium_map._children.items()
+               if not isinstance(child, folium.TileLayer)]
+    
+    return '\n'.join(scripts).replace(folium_map.get_name(), '__MAP__')
+
+
+def get_cached_base_image_map(df_flux, variant = 'normal'):
+    """ Return a new folium map containing the routes of the given variant ('normal', 'thin',
+        'tricolor', 'land' or 'naval'). The routes are built and rendered only once per flux
+        dataframe and variant, so the map is cheap to create and to render """
+    
+    # Identify the route layer by the content of the flux dataframe and the variant
+    key = (get_flux_fingerprint(df_flux), variant)
+    
+    # Build the route layer if it is not in the cache yet, and remove the least recently 
+    # used one if the cache is full
+    if key not in _base_layer_cache :
+        _base_layer_cache[key] = build_base_layer(df_flux, variant)
+        while len(_base_layer_cache) > _base_layer_cache_size :
+            _base_layer_cache.popitem(last = False)
+    
+    # Else, mark it as the most recently used
+    else :
+        _base_layer_cache.move_to_end(key)
+    
+    # Initialize folium map parameters
+    folium_map = folium.Map(location = sgs._location_map,
+                            zoom_start = sgs._zoom_map,
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
+    
+    # Add the prerendered routes, drawn on this map
+    layer = MacroElement()
+    layer._name = 'BaseLayer'
+    layer._template = Template(u"""
+        {% macro script(this, kwargs) %}
+            {{ this.script.replace('__MAP__', this._parent.get_name()) }}
+        {% endmacro %}
+        """)
+    layer.script = _base_layer_cache[key]
+    layer.add_to(folium_map)
+    
+    return folium_map
+
+
+def clear_base_layer_cache():
+    """ Empty the cache of the route layers """
+    
+    _base_layer_cache.clear()
+    
+    return True
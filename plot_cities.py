@@ -4,8 +4,62 @@ import numpy as np
 from folium import plugins
 
 
-def plot_cities_import_export(df):
-    """ Function specialized in the creation of interactive map representing import/export """
+# Store the different messages and colours corresponding to the various data
+# which could be plotted by plot_cities
+dict_plot_cities = {
+    'consumption' : ["{}<br> Coal consumption: {} thousands tons",'#E37222'],
+    'production' : ["{}<br> Coal production: {} thousands tons",'#E8DC5C'],
+    'arriving_flux' : ["{}<br> Arriving coal: {} thousands tons",'#5CE8C2'],
+    'departing_flux' : ["{}<br> Departing coal: {} thousands tons",'#3893E8']
+}
+
+
+def format_popups(template, *columns):
+    """ Format the popup message of every row, given the columns to insert in the template """
+    
+    return [template.format(*values) for values in zip(*columns)]
+
+
+def add_city_markers(folium_map, df_, radius, color, popup, mode = 'markers'):
+    """ Add a circle marker on each city of the dataframe, given the columns of radius, colour
+        and popup message. In the 'markers' mode, each city is a separate folium marker. In the
+        'geojson' mode, all cities are a single GeoJSON feature collection, which gives a much
+        lighter html file for large datasets """
+    
+    # Add one circle marker per city
+    if mode == 'markers' :
+        for latitude, longitude, radius_, color_, popup_ in zip(df_["latitude"], df_["longitude"],
+                                                                radius, color, popup):
+            folium.CircleMarker(location = (latitude, longitude),
+                                radius = radius_,
+                                color = color_,
+                                popup = popup_,
+                                fill = True).add_to(folium_map)
+    
+    # Add a single feature collection, whose features carry their style (radius and colour)
+    # and popup. Leaflet does not read the style of the properties by itself, so the style
+    # function gives it for each feature, and it is merged in the options of its circle marker
+    elif mode == 'geojson' :
+        features = [{'type' : 'Feature',
+                     'geometry' : {'type' : 'Point', 'coordinates' : [float(longitude), float(latitude)]},
+                     'properties' : {'style' : {'radius' : float(radius_), 'color' : color_, 'fillColor' : color_},
+                                     'popup' : popup_}}
+                    for latitude, longitude, radius_, color_, popup_ in zip(df_["latitude"], df_["longitude"],
+                                                                            radius, color, popup)]
+        folium.GeoJson({'type' : 'FeatureCollection', 'features' : features},
+                       marker = folium.CircleMarker(fill = True),
+                       style_function = lambda feature: feature['properties']['style'],
+                       popup = folium.GeoJsonPopup(fields = ['popup'], labels = False)).add_to(folium_map)
+    
+    else :
+        raise ValueError("mode should be either 'markers' or 'geojson'.")
+    
+    return folium_map
+
+
+def plot_cities_import_export(df, mode = 'markers'):
+    """ Function specialized in the creation of interactive map representing import/export.
+        The mode can be 'markers' or 'geojson' (see add_city_markers) """
     
     # Initialize parameters
     color = ''
@@ -21,37 +75,24 @@ def plot_cities_import_export(df):
     # Specify parameters of the folium map
     folium_map = folium.Map(location = sgs._location_map,
                             zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
 
+    # Net exporters are displayed in green, net importers in red
+    is_exporter = (df_[arg] > 0).to_numpy()
+    color = np.where(is_exporter, "#309632", "#BA160C")
+    
+    # Generate the popup messages that are shown on click
+    popup = format_popups("{}<br> Net coal {}: {} thousands tons", df_["city_name"],
+                          np.where(is_exporter, "export", "import"),
+                          (df_[arg].abs()*sgs._ktons_per_unit).astype(int))
+    
+    # Define the radius of the circles so that their surface is proportional the the 
+    # scalar (import/export tons)
+    radius = np.sqrt((df_[arg].abs()).to_numpy())/np.pi
+    
     # For each row in the data, add a circle marker
-    for index, row in df_.iterrows():
-                
-        # If city is a net exporter
-        if row[arg] > 0:
-            
-            # Generate a popup message that is shown on click
-            popup = "{}<br> Net coal export: {} thousands tons"
-            color = "#309632" # green (net exporter)
-            
-        # If city is a net importer
-        else:
-            # Generate a popup message that is shown on click
-            popup = "{}<br> Net coal import: {} thousands tons"
-            color = "#BA160C" # red (net importer)
-        
-        # Display the popup message
-        popup = popup.format(row["city_name"],int(abs(row[arg])*sgs._ktons_per_unit))
-        
-        # Define the radius of the circle so that its surface is proportional the the 
-        # scalar (import/export tons)
-        radius = np.sqrt((abs(row[arg])))/np.pi
-        
-        # Add circle marker to the map
-        folium.CircleMarker(location = (row["latitude"],row["longitude"]),
-                            radius = radius,
-                            color = color,
-                            popup = popup,
-                            fill = True).add_to(folium_map)
+    add_city_markers(folium_map, df_, radius, color, popup, mode)
     
     # Enable folium measure tool
     measure_control = plugins.MeasureControl(primary_length_unit='kilometers',
@@ -67,8 +108,9 @@ def plot_cities_import_export(df):
     return folium_map
 
 
-def plot_cities_transiting_flux(df):
-    """ Function specialized in the creation of interactive maps representing goods transit """
+def plot_cities_transiting_flux(df, mode = 'markers'):
+    """ Function specialized in the creation of interactive maps representing goods transit.
+        The mode can be 'markers' or 'geojson' (see add_city_markers) """
     
     # Initialize parameters
     color = ''
@@ -81,32 +123,26 @@ def plot_cities_transiting_flux(df):
     # Specify parameters of the folium map
     folium_map = folium.Map(location = sgs._location_map,
                             zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
 
+    # Generate the popup messages that are shown on click
+    popup = "{}<br> Arriving coal: {} thousands tons<br>"
+    popup += "Departing coal: {} thousands tons<br> Total coal transit: {} thousands tons"
+    popup = format_popups(popup, df_["city_name"],
+                          (df_['arriving_flux'].abs()*sgs._ktons_per_unit).astype(int),
+                          (df_['departing_flux'].abs()*sgs._ktons_per_unit).astype(int),
+                          (df_['transiting_flux'].abs()*sgs._ktons_per_unit).astype(int))
+    
+    # Set colour to violet
+    color = ['#A85CE8'] * len(df_) # violet
+    
+    # Define the radius of the circles so that their surface is proportional the the 
+    # scalar (transit)        
+    radius = np.sqrt((df_[arg].abs()).to_numpy())/np.pi
+    
     # For each row in the data, add a cicle marker
-    for index, row in df_.iterrows():
-        
-        # Generate a popup message that is shown on click and display it
-        popup = "{}<br> Arriving coal: {} thousands tons<br>"
-        popup += "Departing coal: {} thousands tons<br> Total coal transit: {} thousands tons"
-        popup = popup.format(row["city_name"],
-                             int(abs(row['arriving_flux'])*sgs._ktons_per_unit),
-                             int(abs(row['departing_flux'])*sgs._ktons_per_unit),
-                             int(abs(row['transiting_flux'])*sgs._ktons_per_unit))
-        
-        # Set colour to violet
-        color = '#A85CE8' # violet
-        
-        # Define the radius of the circle so that its surface is proportional the the 
-        # scalar (transit)        
-        radius = np.sqrt((abs(row[arg])))/np.pi
-        
-        # Add circle marker to the map
-        folium.CircleMarker(location = (row["latitude"],row["longitude"]),
-                            radius = radius,
-                            color = color,
-                            popup = popup,
-                            fill = True).add_to(folium_map)
+    add_city_markers(folium_map, df_, radius, color, popup, mode)
         
     # Enable folium measure tool
     measure_control = plugins.MeasureControl(primary_length_unit='kilometers',
@@ -122,8 +158,9 @@ def plot_cities_transiting_flux(df):
     return folium_map
 
 
-def plot_cities_production(df):
-    """ Function specialized in the creation of interactive maps representing production centers """
+def plot_cities_production(df, mode = 'markers'):
+    """ Function specialized in the creation of interactive maps representing production centers.
+        The mode can be 'markers' or 'geojson' (see add_city_markers) """
 
     # Initialize parameters
     arg = 'production'
@@ -135,30 +172,23 @@ def plot_cities_production(df):
     # Specify parameters of the folium map
     folium_map = folium.Map(location = sgs._location_map,
                             zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
 
+    # Set the colours to the ones which are specified in the settings folder
+    type_production = df_['type_production'].to_numpy().astype(int) - 1
+    color = np.array(sgs._production_colors)[type_production]
+    
+    # Generate the popup messages that are shown on click
+    popup = format_popups("{}<br> {}<br>Coal production: {} thousands tons", df_["city_name"],
+                          np.array(sgs._descr)[type_production],
+                          (df_[arg].abs()*sgs._ktons_per_unit).astype(int))
+    
+    # Define the radius of the circles so that their surface is proportional the the scalar (production)
+    radius = np.sqrt((df_[arg].abs()).to_numpy())/np.pi
+    
     # For each row in the data, add a cicle marker
-    for index, row in df_.iterrows():
-        
-        # Generate a popup message that is shown on click.
-        popup = "{}<br> {}<br>Coal production: {} thousands tons"
-        
-        # Set the colour to the one which is specified in the settings folder
-        color = sgs._production_colors[int(row['type_production'])-1]
-        
-        # Display the popup message
-        popup = popup.format(row["city_name"],sgs._descr[int(row['type_production'])-1],
-                                                        int(abs(row[arg])*sgs._ktons_per_unit))
-        
-        # Define the radius of the circle so that its surface is proportional the the scalar (production)
-        radius = np.sqrt((abs(row[arg])))/np.pi
-        
-        # Add circle marker to the map
-        folium.CircleMarker(location = (row["latitude"],row["longitude"]),
-                            radius = radius,
-                            color = color,
-                            popup = popup,
-                            fill = True).add_to(folium_map)
+    add_city_markers(folium_map, df_, radius, color, popup, mode)
         
     # Enable folium measure tool
     measure_control = plugins.MeasureControl(primary_length_unit='kilometers',
@@ -174,17 +204,9 @@ def plot_cities_production(df):
     return folium_map
 
 
-def plot_cities(df, arg):
-    """ Generalist function for creating interactive folium maps """
-    
-    # Store the different messages and colours corresponding to the various data
-    # which could be plotted
-    dict_plot_cities = {
-        'consumption' : ["{}<br> Coal consumption: {} thousands tons",'#E37222'],
-        'production' : ["{}<br> Coal production: {} thousands tons",'#E8DC5C'],
-        'arriving_flux' : ["{}<br> Arriving coal: {} thousands tons",'#5CE8C2'],
-        'departing_flux' : ["{}<br> Departing coal: {} thousands tons",'#3893E8']
-    }
+def plot_cities(df, arg, mode = 'markers'):
+    """ Generalist function for creating interactive folium maps. The mode can be 'markers' or
+        'geojson' (see add_city_markers) """
     
     # Initialize parameters
     color = ''
@@ -196,27 +218,19 @@ def plot_cities(df, arg):
     # Specify parameters of the folium map
     folium_map = folium.Map(location = sgs._location_map,
                             zoom_start = sgs._zoom_map,
-                            tiles = "CartoDB dark_matter")
+                            tiles = sgs._tiles,
+                            attr = sgs._tiles_attr)
 
+    # Catch the popup messages and the colour matching the data which is plotted
+    popup = format_popups(dict_plot_cities[arg][0], df_["city_name"],
+                          (df_[arg].abs()*sgs._ktons_per_unit).astype(int))
+    color = [dict_plot_cities[arg][1]] * len(df_)
+    
+    # Define the radius of the circles so that their surface is proportional the the scalar
+    radius = np.sqrt((df_[arg].abs()).to_numpy())/np.pi
+    
     # For each row in the data, add a cicle marker
-    for index, row in df_.iterrows():
-        
-        # Catch the popup message matching the data which is plotted
-        popup = dict_plot_cities[arg][0]
-        color = dict_plot_cities[arg][1]
-        
-        # Display the popup message
-        popup = popup.format(row["city_name"],int(abs(row[arg])*sgs._ktons_per_unit))
-        
-        # Define the radius of the circle so that its surface is proportional the the scalar
-        radius = np.sqrt((abs(row[arg])))/np.pi
-        
-        # Add circle marker to the map
-        folium.CircleMarker(location = (row["latitude"],row["longitude"]),
-                            radius = radius,
-                            color = color,
-                            popup = popup,
-                            fill = True).add_to(folium_map)
+    add_city_markers(folium_map, df_, radius, color, popup, mode)
         
     # Enable folium measure tool
     measure_control = plugins.MeasureControl(primary_length_unit='kilometers',
@@ -0,0 +1,100 @@
+import settings as sgs
+import numpy as np
+import os
+import json
+from trip_index import *
+
+
+# Arrays of a position store, with their type
+_store_arrays = {
+    'latitude' : np.float32,
+    'longitude' : np.float32,
+    'coal_type' : np.int8,
+    'is_naval' : np.int8
+}
+
+
+def precompute_positions(df_trips, folder, begin = 0, end = None, chunk_size = 1000):
+    """ Run the simulation once and store the positions of the active trips of every frame
+        between begin and end in the given folder. The positions of all frames are packed one
+        after the other in a file per column (latitude, longitude, coal_type and is_naval),
+        and offsets.npy gives the position of the first trip of each frame, so that frame j
+        spans offsets[j-begin] to offsets[j-begin+1] """
+    
+    # By default, store the frames until the end of the simulation
+    if end is None : end = sgs._simulation_duration
+    os.makedirs(folder, exist_ok = True)
+    
+    # As the frames are computed in increasing time order, a sweep cursor follows the
+    # active trips from one frame to the next
+    cursor = new_sweep_cursor(build_trip_index(df_trips))
+    
+    # Initialize variables
+    offsets = np.zeros(end - begin + 1, dtype = np.int64)
+    files = {name: open(os.path.join(folder, name + '.bin'), 'wb') for name in _store_arrays}
+    
+    try:
+        
+        # Iterate over the frames, writing the columns chunk by chunk to bound the memory
+        chunk = {name: [] for name in _store_arrays}
+        for j in range(begin, end):
+            positions = advance_sweep_cursor(cursor, sgs._time_range[j])
+            if not sgs._enable_Naval :
+                positions = positions + (np.zeros(len(positions[0])),)
+            for name, values in zip(_store_arrays, positions):
+                chunk[name].append(np.asarray(values, dtype = _store_arrays[name]))
+            offsets[j - begin + 1] = offsets[j - begin] + len(positions[0])
+            
+            # Write the chunk when it is full or when the last frame is reached
+            if (j - begin + 1) % chunk_size == 0 or j == end - 1 :
+                for name in _store_arrays:
+                    if chunk[name] :
+                        np.concatenate(chunk[name]).tofile(files[name])
+                chunk = {name: [] for name in _store_arrays}
+    
+    finally:
+        for file in files.values():
+            file.close()
+    
+    # Save the offsets and the description of the store
+    np.save(os.path.join(folder, 'offsets.npy'), offsets)
+    with open(os.path.join(folder, 'store.json'), 'w') as file:
+        json.dump({'begin' : begin, 'end' : end, 'length' : int(offsets[-1])}, file)
+    
+    return True
+
+
+def load_position_store(folder):
+    """ Open a position store created by precompute_positions. The arrays are memory-mapped,
+        so only the frames which are read are loaded from the disk """
+    
+    # Load the description of the store
+    with open(os.path.join(folder, 'store.json')) as file:
+        store = json.load(file)
+    
+    # Memory-map the offsets and the columns
+    store['offsets'] = np.load(os.path.join(folder, 'offsets.npy'), mmap_mode = 'r')
+    for name, dtype in _store_arrays.items():
+        if store['length'] > 0 :
+            store[name] = np.memmap(os.path.join(folder, name + '.bin'), dtype = dtype, mode = 'r',
+                                    shape = (store['length'],))
+        else :
+            store[name] = np.zeros(0, dtype = dtype)
+    
+    return store
+
+
+def get_stored_positions(store, j):
+    """ Return the active trips of frame j in the same format as get_active_trips_vectorized.
+        The arrays are views of the store, which are not copied """
+    
+    # Find the slice of the frame
+    if not store['begin'] <= j < store['end'] :
+        raise IndexError("frame {} is not in the store ({} to {})".format(j, store['begin'], store['end']))
+    first, last = store['offsets'][j - store['begin']], store['offsets'][j - store['begin'] + 1]
+    
+    # Return all the information about the active trips
+    if (sgs._enable_Naval):
+        return tuple(store[name][first:last] for name in _store_arrays)
+    else :
+        return tuple(store[name][first:last] for name in ['latitude', 'longitude', 'coal_type'])
@@ -0,0 +1,65 @@
+import settings as sgs
+import numpy as np
+
+
+def lonlat_to_world_pixels(longitude, latitude, zoom):
+    """ Project longitudes and latitudes to Web Mercator pixel coordinates of the whole 
+        world at the given zoom, as done by the tiles of the folium maps """
+    
+    # Size of the world in pixels at this zoom (tiles are 256 pixels wide)
+    world_size = 256 * 2**zoom
+    
+    # Web Mercator is undefined at the poles, so the latitudes are clipped
+    latitude = np.clip(np.asarray(latitude, dtype = np.float64), -85.05112878, 85.05112878)
+    longitude = np.asarray(longitude, dtype = np.float64)
+    
+    # Compute the horizontal and vertical coordinates
+    x = (longitude + 180) / 360 * world_size
+    y = (1 - np.log(np.tan(np.radians(latitude)) + 1/np.cos(np.radians(latitude))) / np.pi) / 2 * world_size
+    
+    return x, y
+
+
+def world_pixels_to_lonlat(x, y, zoom):
+    """ Inverse of lonlat_to_world_pixels """
+    
+    # Size of the world in pixels at this zoom
+    world_size = 256 * 2**zoom
+    
+    # Compute the longitude and latitude
+    longitude = np.asarray(x, dtype = np.float64) / world_size * 360 - 180
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype = np.float64) / world_size))))
+    
+    return longitude, latitude
+
+
+def get_viewport(location = None, zoom = None, size = None):
+    """ Describe the rectangle of the world which is displayed on a frame, by default the
+        one centered on the location of the map in the settings """
+    
+    # Use the parameters of the settings by default
+    if location is None : location = sgs._location_map
+    if zoom is None : zoom = sgs._zoom_map
+    if size is None : size = sgs._frame_size
+    
+    # Find the world coordinates of the center of the map
+    center_x, center_y = lonlat_to_world_pixels(location[1], location[0], zoom)
+    
+    # Store the zoom, the size and the world coordinates of the upper left corner
+    viewport = {
+        'zoom' : zoom,
+        'size' : (int(size[0]), int(size[1])),
+        'origin' : (float(center_x) - size[0]/2, float(center_y) - size[1]/2)
+    }
+    
+    return viewport
+
+
+def project_to_viewport(latitude, longitude, viewport):
+    """ Return the pixel coordinates, on the frame described by the viewport, of the given 
+        latitudes and longitudes """
+    
+    # Project on the world, then translate to the upper left corner of the frame
+    x, y = lonlat_to_world_pixels(longitude, latitude, viewport['zoom'])
+    
+    return x - viewport['origin'][0], y - viewport['origin'][1]
@@ -0,0 +1,346 @@
+import settings as sgs
+import numpy as np
+import os
+from projection import *
+from trip_index import *
+from spatial_index import use_region, select_region
+from instrumentation import stage, count, start_frame, end_frame
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+
+
+def get_tile_background(viewport):
+    """ Assemble the background of the frame from the map tiles which are stored locally in
+        the tiles folder ({zoom}/{x}/{y}.png). Missing tiles are left dark """
+    
+    # Initialize the image with the color of the dark map
+    width, height = viewport['size']
+    background = Image.new('RGBA', (width, height), (14, 14, 14, 255))
+    
+    # Find the range of tiles covering the frame
+    zoom, (origin_x, origin_y) = viewport['zoom'], viewport['origin']
+    first_x, last_x = int(np.floor(origin_x/256)), int(np.floor((origin_x + width - 1)/256))
+    first_y, last_y = int(np.floor(origin_y/256)), int(np.floor((origin_y + height - 1)/256))
+    
+    # Iterate over the tiles
+    for tile_x in range(first_x, last_x + 1):
+        for tile_y in range(max(first_y, 0), min(last_y, 2**zoom - 1) + 1):
+            
+            # Tiles are repeated horizontally around the world
+            path = os.path.join(sgs._tiles_folder, str(zoom), str(tile_x % 2**zoom), str(tile_y) + '.png')
+            
+            # Paste the tile at its position on the frame
+            if os.path.exists(path):
+                tile = Image.open(path).convert('RGBA')
+                background.paste(tile, (int(round(tile_x*256 - origin_x)), int(round(tile_y*256 - origin_y))))
+    
+    return background
+
+
+def draw_network(image, df_flux, viewport, thin = True, supersampling = 2):
+    """ Draw the glowing network of routes of get_beautiful_base_image_map on the image. Each
+        layer of the lightning effect is drawn at a higher resolution and downsampled, in order
+        to smooth the lines """
+    
+    # Import the network maps only here, as folium is slow to import and is not needed to
+    # draw the frames
+    from network import get_glow_style
+    
+    # Establish the shading of colors and opacities of the lightning effect
+    colors, opacities, weight = get_glow_style(thin)
+    
+    # Project the routes on the frame, at the supersampled resolution
+    from_x, from_y = project_to_viewport(df_flux['from_latitude'].to_numpy(),
+                                         df_flux['from_longitude'].to_numpy(), viewport)
+    to_x, to_y = project_to_viewport(df_flux['to_latitude'].to_numpy(),
+                                     df_flux['to_longitude'].to_numpy(), viewport)
+    from_x, from_y, to_x, to_y = [a*supersampling for a in (from_x, from_y, to_x, to_y)]
+    log_flux = np.log2(df_flux['flux'].to_numpy(dtype = float))
+    
+    # Iterate over the successive layers of colors/weights/opacities
+    size = (image.width*supersampling, image.height*supersampling)
+    for i in range(len(colors)):
+        
+        # Draw all the routes of this layer on a transparent image
+        layer = Image.new('RGBA', size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        widths = log_flux*(len(colors)-i)*weight*supersampling
+        for k in np.flatnonzero(widths > 0):
+            draw.line([(from_x[k], from_y[k]), (to_x[k], to_y[k])],
+                      fill = ImageColor.getrgb(colors[i]) + (255,),
+                      width = max(1, int(round(widths[k]))))
+        
+        # The folium maps draw every line twice, which strengthens the opacity
+        opacity = 1 - (1 - opacities[i])**2
+        layer.putalpha(layer.getchannel('A').point(lambda a: int(a*opacity)))
+        
+        # Downsample the layer and add it on the image
+        image.alpha_composite(layer.resize(image.size, Image.LANCZOS))
+    
+    return image
+
+
+def build_raster_base(df_flux, viewport = None, thin = True, differential = True, tile_size = 32):
+    """ Rasterize once the background tiles and the network, which do not change during the
+        simulation. If differential is True, each frame only redraws the tiles of tile_size
+        pixels where the trips moved since the previous frame (see draw_differential_trips) """
+    
+    # Describe the frame displayed with the settings by default
+    if viewport is None : viewport = get_viewport()
+    
+    # Draw the network over the tiles
+    image = draw_network(get_tile_background(viewport), df_flux, viewport, thin)
+    
+    # Store everything that is needed to draw the frames
+    base = {
+        'viewport' : viewport,
+        'image' : image.convert('RGB'),
+        'font' : ImageFont.truetype(sgs._data_folder+"LibreBaskerville-Regular.otf", 30),
+        'differential' : differential,
+        'tile_size' : tile_size,
+        'markers' : None,
+        'canvas' : None
+    }
+    
+    return base
+
+
+def draw_active_trips(image, viewport, current_latitude, current_longitude, coal_type, isnaval = None):
+    """ Draw the land trips as circles and the naval trips as triangles on the image """
+    
+    # Project the current positions on the frame
+    x, y = project_to_viewport(current_latitude, current_longitude, viewport)
+    
+    # As the naval mode may be enabled, we extend the colour palette
+    production_colors = [ImageColor.getrgb(color) for color in sgs._production_colors*2]
+    if isnaval is None : isnaval = np.zeros(len(x), dtype = int)
+    
+    # Iterate on all active trips
+    draw = ImageDraw.Draw(image)
+    for i in range(len(x)):
+        
+        # Plot each naval trip as a triangle
+        if (isnaval[i] == 1):
+            draw.regular_polygon((x[i], y[i], 3.5), 3, fill = production_colors[coal_type[i]-1])
+        
+        # Plot each land trip as a circle
+        else:
+            draw.ellipse([x[i]-2.5, y[i]-2.5, x[i]+2.5, y[i]+2.5], fill = production_colors[coal_type[i]-1])
+    
+    return image
+
+
+def get_marker_state(viewport, current_latitude, current_longitude, coal_type, isnaval = None):
+    """ Return the markers drawn on the frame, each coded as a single integer giving the pixel
+        where it is centered, its type and its naval flag. Trips which are drawn on the same
+        pixel with the same marker are only kept once, the markers out of the frame are left
+        out, and the codes are sorted, so that two frames which would be drawn identically 
+        have the same state """
+    
+    # Project the current positions on the frame, to the nearest pixel
+    x, y = project_to_viewport(current_latitude, current_longitude, viewport)
+    x, y = np.around(x).astype(np.int64), np.around(y).astype(np.int64)
+    if isnaval is None : isnaval = np.zeros(len(x), dtype = int)
+    
+    # Keep the markers which are at least partly on the frame (they are at most 4 pixels wide)
+    width, height = viewport['size']
+    visible = (x > -8) & (x < width + 8) & (y > -8) & (y < height + 8)
+    
+    # Code each marker, in the order of the rows, then of the columns, then of the types
+    codes = ((y[visible] + 8)*(width + 16) + x[visible] + 8)*2048 + \
+            np.asarray(coal_type)[visible].astype(np.int64)*2 + np.asarray(isnaval)[visible]
+    
+    return np.unique(codes)
+
+
+def decode_markers(viewport, markers):
+    """ Return the horizontal and vertical pixels, the types and the naval flags of the markers
+        coded by get_marker_state """
+    
+    # Split the codes
+    width = viewport['size'][0]
+    position, kind = np.divmod(markers, 2048)
+    y, x = np.divmod(position, width + 16)
+    
+    return x - 8, y - 8, kind // 2, kind % 2
+
+
+def draw_markers(image, viewport, markers, offset = (0, 0)):
+    """ Draw the markers of get_marker_state on the image, shifted by the given offset. Land
+        trips are drawn as circles and naval trips as triangles, as in draw_active_trips """
+    
+    # As the naval mode may be enabled, we extend the colour palette
+    production_colors = [ImageColor.getrgb(color) for color in sgs._production_colors*2]
+    
+    # Iterate on the markers
+    draw = ImageDraw.Draw(image)
+    x, y, coal_type, isnaval = decode_markers(viewport, markers)
+    for x, y, coal_type, isnaval in zip((x - offset[0]).tolist(), (y - offset[1]).tolist(),
+                                        coal_type.tolist(), isnaval.tolist()):
+        if isnaval == 1 :
+            draw.regular_polygon((x, y, 3.5), 3, fill = production_colors[coal_type-1])
+        else :
+            draw.ellipse([x-2.5, y-2.5, x+2.5, y+2.5], fill = production_colors[coal_type-1])
+    
+    return image
+
+
+def get_marker_tiles(viewport, markers, tile_size):
+    """ Return, for each marker, the tiles of the frame that it overlaps, as two arrays (tile
+        number, marker number) sorted by tile. A marker overlaps at most four tiles """
+    
+    # Number of tiles of the frame
+    width, height = viewport['size']
+    n_columns, n_rows = -(-width // tile_size), -(-height // tile_size)
+    
+    # Tiles of the corners of each marker, which are at most 4 pixels from its center
+    x, y = decode_markers(viewport, markers)[:2]
+    tiles = []
+    for dx in (-4, 4):
+        for dy in (-4, 4):
+            column, row = (x + dx) // tile_size, (y + dy) // tile_size
+            inside = (column >= 0) & (column < n_columns) & (row >= 0) & (row < n_rows)
+            tiles.append((row*n_columns + column)[inside]*len(markers) + np.flatnonzero(inside))
+    
+    # Remove the tiles counted twice for the same marker
+    tiles = np.unique(np.concatenate(tiles))
+    
+    return tiles // max(len(markers), 1), tiles % max(len(markers), 1)
+
+
+def draw_differential_trips(base, markers):
+    """ Draw the markers over the base image, by updating the image of the previous frame: 
+        only the tiles which contain a marker that appeared or disappeared are restored from 
+        the base image and redrawn. If no marker changed, the previous image is reused as it 
+        is. The image is the same as if all the markers were drawn over the base image """
+    
+    # Reuse the previous image if the markers did not change
+    viewport, previous = base['viewport'], base['markers']
+    if previous is not None and np.array_equal(previous, markers):
+        count('duplicate_frame', 1)
+        return base['canvas']
+    
+    # Find the tiles which contain a marker which appeared or disappeared
+    tile_size, (width, height) = base['tile_size'], base['image'].size
+    n_columns = -(-width // tile_size)
+    if previous is not None :
+        changed = np.setxor1d(previous, markers, assume_unique = True)
+        dirty = np.unique(get_marker_tiles(viewport, changed, tile_size)[0])
+        tiles, owners = get_marker_tiles(viewport, markers, tile_size)
+        redrawn = np.isin(tiles, dirty).sum()
+        count('dirty_tiles', len(dirty))
+    
+    # Draw all the markers on the first frame, or when redrawing the tiles would be slower.
+    # Restoring a tile costs about as much as drawing ten markers, and copying the base
+    # image as much as drawing four hundred
+    if previous is None or redrawn + 10*len(dirty) > len(markers) + 400 :
+        canvas = draw_markers(base['image'].copy(), viewport, markers)
+        base['markers'], base['canvas'] = markers, canvas
+        return canvas
+    
+    # Restore each dirty tile from the base image and redraw the markers which overlap it.
+    # They are drawn on a larger crop, as the markers cut by the border of an image are not
+    # drawn the same, except at the border of the frame
+    canvas = base['canvas']
+    for tile in dirty.tolist():
+        left, top = (tile % n_columns)*tile_size, (tile // n_columns)*tile_size
+        box = (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        padded = (max(left - 8, 0), max(top - 8, 0), min(box[2] + 8, width), min(box[3] + 8, height))
+        first, last = np.searchsorted(tiles, [tile, tile + 1])
+        crop = draw_markers(base['image'].crop(padded), viewport, markers[owners[first:last]], padded[:2])
+        canvas.paste(crop.crop((left - padded[0], top - padded[1], box[2] - padded[0], box[3] - padded[1])), box)
+    base['markers'] = markers
+    
+    return canvas
+
+
+def render_raster_frame(frame_time, cursor, base):
+    """ Draw the frame at the given time over a copy of the base image, using the sweep cursor
+        (see trip_index.py) to find the active trips """
+    
+    # Find the positions of the active trips
+    with stage('positions'):
+        positions = advance_sweep_cursor(cursor, frame_time)
+    
+    return draw_raster_frame(frame_time, positions, base)
+
+
+def draw_raster_frame(frame_time, positions, base):
+    """ Draw the frame at the given time over a copy of the base image, given the positions
+        of the active trips in the format of get_active_trips_vectorized """
+    
+    # Unpack the information about the active trips
+    if (sgs._enable_Naval):
+        current_latitude, current_longitude, coal_type, isnaval = positions
+    else :
+        current_latitude, current_longitude, coal_type = positions
+        isnaval = None
+    
+    # Draw the trips over the base image, or update the previous frame
+    count('active_trips', len(current_latitude))
+    with stage('draw_trips'):
+        if base.get('differential'):
+            markers = get_marker_state(base['viewport'], current_latitude, current_longitude, coal_type, isnaval)
+            image = draw_differential_trips(base, markers).copy()
+        else :
+            image = draw_active_trips(base['image'].copy(), base['viewport'],
+                                      current_latitude, current_longitude, coal_type, isnaval)
+    
+    # Add date and time of day text on the image
+    with stage('annotate'):
+        draw = ImageDraw.Draw(image)
+        draw.text((20,image.height - 50),
+                  "time: {}".format(frame_time),
+                  fill=(255, 255, 255),
+                  font=base['font'])
+    
+    return image
+
+
+def go_raster_frame(params, cursor, base):
+    """ Same as go_frame, but draws the frame directly instead of taking a screenshot of the
+        folium map """
+    
+    # Unpack parameters
+    i, frame_time = params
+    
+    # Draw and save the png image
+    start_frame(i)
+    image = render_raster_frame(frame_time, cursor, base)
+    with stage('save'):
+        image.save(sgs._png_folder + "frame_{:0>5}.png".format(i))
+    end_frame(i)
+    
+    return True
+
+
+def raster_framer(df_trips, df_flux, begin = 0, end = None, bbox = None):
+    """ Create the png frames of the simulation between the begin and end frames, without
+        folium and without browser. If a bounding box (south, west, north, east) is given,
+        the frames show this region, and only the routes and the trips which can be seen
+        are drawn """
+    
+    # By default, create the frames until the end of the simulation
+    if end is None : end = sgs._simulation_duration
+    
+    # Center the frames on the region, and put the settings back afterwards
+    if bbox is not None :
+        with use_region(bbox) as shown:
+            df_flux, df_trips = select_region(shown, df_flux, df_trips)
+            return raster_framer(df_trips, df_flux, begin, end)
+    
+    # Rasterize once the background and the network
+    with stage('build_raster_base'):
+        base = build_raster_base(df_flux)
+    
+    # As the frames are created in increasing time order, a sweep cursor follows the
+    # active trips from one frame to the next
+    cursor = new_sweep_cursor(build_trip_index(df_trips))
+    
+    # Create the frames, numbered as in screenshot
+    for j in range(begin, end):
+        go_raster_frame((j, sgs._time_range[j]), cursor, base)
+        print('·',end='')
+    
+    print(end)
+    
+    return True
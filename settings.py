@@ -7,12 +7,16 @@ def init() :
     global _html_folder
     global _png_folder
     global _mp4_folder
+    global _tiles_folder
+    global _cache_folder
     
     # Include the names of the repositories if necessary
     _data_folder = r'./data/'
     _html_folder = r'./html/'
     _png_folder = r'./png/'
     _mp4_folder = r'./mp4/'
+    _tiles_folder = r'./tiles/'
+    _cache_folder = r'./cache/'
     
     # Initialize global variables
     global _Ntypes_production
@@ -28,6 +32,9 @@ def init() :
     global _time_range
     global _location_map
     global _zoom_map
+    global _tiles
+    global _tiles_attr
+    global _frame_size
     
     '''
     ###########################################################################################
@@ -79,9 +86,52 @@ def init() :
     # Original zoom or dezoom of the map
     _zoom_map = 6
     
+    # Background tiles of the maps, given by their folium name or by their url with their
+    # attribution (see tile_cache.py to use the tiles stored in the tiles folder instead)
+    _tiles = "CartoDB dark_matter"
+    _tiles_attr = None
+    
+    # Width and height, in pixels, of the frames of the mp4 simulation
+    _frame_size = [1920, 1080]
+    
     '''
     ###########################################################################################
     '''
     
     return True
 
+
+def configure(**values):
+    """ Change some settings after init, given by their name with or without the leading
+        underscore (for example configure(zoom_map = 7)). When the hourly rate changes
+        without the simulation duration, the duration is computed again so that the same
+        number of days is simulated. The time range is computed again from the start time,
+        the hourly rate and the simulation duration when one of them changes, unless the
+        time range is given too """
+    
+    # Initialize variables
+    names = set()
+    hourly_rate = _hourly_rate
+    
+    # Replace the settings
+    for name, value in values.items():
+        name = '_' + name.lstrip('_')
+        if name not in globals() :
+            raise ValueError("unknown setting: {}".format(name))
+        if name == '_start_time' :
+            value = pd.to_datetime(value)
+        if name == '_time_range' :
+            value = pd.DatetimeIndex(value)
+        globals()[name] = value
+        names.add(name)
+    
+    # Keep the number of simulated days when only the rate changes
+    if '_hourly_rate' in names and '_simulation_duration' not in names :
+        globals()['_simulation_duration'] = int(round(_simulation_duration*_hourly_rate/hourly_rate))
+    
+    # Keep the time range consistent with the other time settings
+    if names & {'_start_time', '_hourly_rate', '_simulation_duration'} and '_time_range' not in names :
+        globals()['_time_range'] = pd.date_range(_start_time, periods = _simulation_duration,
+                                                 freq = pd.Timedelta(hours = 1)/_hourly_rate)
+    
+    return True
@@ -0,0 +1,355 @@
+import settings as sgs
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+import subprocess
+import contextlib
+
+
+# Name of the manifest in the folder of a sharded movie
+_manifest_name = 'manifest.json'
+
+
+def get_owner():
+    """ Return the name identifying this process in the manifest """
+    
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_settings_fingerprint():
+    """ Return the settings which must be the same for all the shards of a movie, so that the
+        segments can be concatenated """
+    
+    return {
+        'start_time' : str(sgs._time_range[0]),
+        'frame_step' : str(sgs._time_range[1] - sgs._time_range[0]) if len(sgs._time_range) > 1 else None,
+        'frame_size' : list(sgs._frame_size),
+        'location_map' : list(sgs._location_map),
+        'zoom_map' : sgs._zoom_map,
+        'tiles' : str(sgs._tiles)
+    }
+
+
+@contextlib.contextmanager
+def manifest_lock(folder, timeout = 60):
+    """ Hold the lock of the manifest of a folder, which may be shared by several machines. The
+        lock is a file created exclusively, which is removed if it is older than timeout
+        seconds, as its owner probably crashed. It must therefore only be held to read and
+        write the manifest, never during long computations such as checksums """
+    
+    path = os.path.join(folder, _manifest_name + '.lock')
+    
+    # Wait until the lock file can be created
+    while True :
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError :
+            try:
+                if time.time() - os.path.getmtime(path) > timeout :
+                    os.remove(path)
+            except FileNotFoundError :
+                pass
+            time.sleep(0.05)
+    os.close(descriptor)
+    
+    try:
+        yield
+    finally:
+        os.remove(path)
+
+
+def read_manifest(folder):
+    """ Read the manifest of a folder """
+    
+    with open(os.path.join(folder, _manifest_name)) as file:
+        return json.load(file)
+
+
+def write_manifest(folder, manifest):
+    """ Replace the manifest of a folder, through a temporary file so that it is never read
+        half written """
+    
+    path = os.path.join(folder, _manifest_name)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent = 1)
+    os.replace(path + '.tmp', path)
+    
+    return True
+
+
+def get_checksum(path):
+    """ Return the sha256 of a file """
+    
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            checksum.update(block)
+    
+    return checksum.hexdigest()
+
+
+def plan_shards(folder, begin = 0, end = None, shard_size = 2016, renderer = 'raster', seed = 0,
+                fps = 10, codec = 'libx264', quality = 5):
+    """ Split the frames between begin and end (by default the whole simulation) in shards of
+        shard_size frames (by default a week of 5-minute frames), each rendered in its own
+        mp4 segment, and write the manifest of the movie in the folder. The parameters of
+        the rendering and of the encoding are stored in the manifest, so that all the
+        segments are alike. If the folder already has the same plan, it is kept as it is,
+        so that every job can call plan_shards before run_shards """
+    
+    # By default, render the whole simulation
+    if end is None : end = sgs._simulation_duration
+    os.makedirs(folder, exist_ok = True)
+    
+    # Describe the plan
+    plan = {
+        'begin' : begin,
+        'end' : end,
+        'shard_size' : shard_size,
+        'parameters' : {'renderer' : renderer, 'seed' : seed, 'fps' : fps, 'codec' : codec, 'quality' : quality},
+        'settings' : get_settings_fingerprint()
+    }
+    
+    with manifest_lock(folder):
+        
+        # Keep the manifest of the same plan, with the progress of its shards
+        if os.path.exists(os.path.join(folder, _manifest_name)):
+            manifest = read_manifest(folder)
+            if {key : manifest[key] for key in plan} != plan :
+                raise ValueError("{} already holds another plan".format(folder))
+            return manifest
+        
+        # Else, create the shards
+        manifest = dict(plan, shards = [{'index' : k, 'begin' : first, 'end' : min(first + shard_size, end),
+                                         'status' : 'pending', 'attempts' : 0}
+                                        for k, first in enumerate(range(begin, end, shard_size))])
+        write_manifest(folder, manifest)
+    
+    return manifest
+
+
+def claim_shard(folder, owner = None, claim_timeout = 600):
+    """ Claim the first shard which is pending, or whose owner has not refreshed its claim for
+        claim_timeout seconds (see refresh_claim) as it probably crashed. Returns the shard,
+        or None if there is nothing left to render """
+    
+    if owner is None : owner = get_owner()
+    
+    with manifest_lock(folder):
+        manifest = read_manifest(folder)
+        
+        # The settings must be those of the plan, else the segments would not match
+        if manifest['settings'] != get_settings_fingerprint() :
+            raise ValueError("the settings differ from those of the plan of {}".format(folder))
+        
+        # Find a shard to render
+        for shard in manifest['shards']:
+            if shard['status'] == 'pending' or (shard['status'] == 'claimed' and
+                                                time.time() - shard['claimed_at'] > claim_timeout):
+                
+                # Remove the segment left by the former owner
+                if 'owner' in shard :
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(folder, 'segment_{:0>5}.{}.part.mp4'.format(shard['index'], shard['owner'])))
+                
+                shard.update(status = 'claimed', owner = owner, claimed_at = time.time())
+                shard['attempts'] += 1
+                write_manifest(folder, manifest)
+                return shard
+    
+    return None
+
+
+def refresh_claim(folder, index, owner):
+    """ Tell that the owner of a shard is still rendering it. Returns False if the shard was
+        taken over by another owner """
+    
+    with manifest_lock(folder):
+        manifest = read_manifest(folder)
+        shard = manifest['shards'][index]
+        if shard['status'] != 'claimed' or shard['owner'] != owner :
+            return False
+        shard['claimed_at'] = time.time()
+        write_manifest(folder, manifest)
+    
+    return True
+
+
+def release_shard(folder, index, owner, error):
+    """ Give back a shard which could not be rendered, so that it is rendered again """
+    
+    with manifest_lock(folder):
+        manifest = read_manifest(folder)
+        shard = manifest['shards'][index]
+        if shard['status'] == 'claimed' and shard['owner'] == owner :
+            shard.update(status = 'pending', error = str(error))
+            write_manifest(folder, manifest)
+    
+    return True
+
+
+def complete_shard(folder, index, owner, path, failed):
+    """ Move the segment rendered by the owner of a shard to its final place, and record its
+        checksum and the frames which could not be rendered in the manifest. Returns False,
+        and removes the segment, if the shard is not claimed by the owner anymore """
+    
+    # Compute the checksum before taking the lock, as it takes some time
+    checksum, size = get_checksum(path), os.path.getsize(path)
+    segment = 'segment_{:0>5}.mp4'.format(index)
+    
+    with manifest_lock(folder):
+        manifest = read_manifest(folder)
+        shard = manifest['shards'][index]
+        
+        # A shard which was taken over by another owner in the meantime is left to it
+        if shard['status'] != 'claimed' or shard['owner'] != owner :
+            os.remove(path)
+            return False
+        
+        os.replace(path, os.path.join(folder, segment))
+        shard.update(status = 'done', owner = owner, segment = segment, sha256 = checksum, size = size,
+                     failed = failed, completed_at = time.time())
+        write_manifest(folder, manifest)
+    
+    return True
+
+
+def verify_shards(folder):
+    """ Check the segments of the shards which are done against their checksum, and put back
+        the missing or corrupted ones to be rendered again. Returns the indices of these shards """
+    
+    # Check the segments without holding the lock, as it takes some time
+    invalid = []
+    for shard in read_manifest(folder)['shards']:
+        if shard['status'] != 'done' :
+            continue
+        path = os.path.join(folder, shard['segment'])
+        if not os.path.exists(path) or os.path.getsize(path) != shard['size'] or get_checksum(path) != shard['sha256'] :
+            invalid.append(shard)
+    if not invalid :
+        return []
+    
+    # Put back the invalid shards, unless their segment was replaced in the meantime
+    with manifest_lock(folder):
+        manifest = read_manifest(folder)
+        for checked in invalid:
+            shard = manifest['shards'][checked['index']]
+            if shard['status'] == 'done' and shard['completed_at'] == checked['completed_at'] :
+                shard.update(status = 'pending', error = 'missing or corrupted segment')
+        write_manifest(folder, manifest)
+    
+    return [shard['index'] for shard in invalid]
+
+
+def render_shard(folder, shard, manifest, df_trips, df_flux, owner, n_workers = 1, buffer_size = 16,
+                 threads = None, store_folder = None):
+    """ Render the frames of a shard in a temporary mp4 segment, with the parameters of the
+        manifest. Returns the path of the segment and the frames which could not be rendered """
+    
+    # Import the pipeline only when a shard is rendered
+    import movie_maker
+    
+    # Each owner writes its own temporary segment
+    path = os.path.abspath(os.path.join(folder, 'segment_{:0>5}.{}.part.mp4'.format(shard['index'], owner)))
+    parameters = manifest['parameters']
+    failed = movie_maker.movie_streamer(df_trips, df_flux, shard['begin'], shard['end'], parameters['renderer'],
+                                        n_workers, buffer_size, False, path, parameters['fps'],
+                                        parameters['codec'], parameters['quality'], threads, store_folder)
+    
+    return path, failed
+
+
+def run_shards(folder, df_trips, df_flux, owner = None, max_shards = None, n_workers = 1, buffer_size = 16,
+               threads = None, store_folder = None, claim_timeout = 600):
+    """ Claim and render the shards of a planned movie until there are none left (or until
+        max_shards shards are rendered). Several jobs, on the same machine or on machines
+        sharing the folder, can run it at once. While a shard is rendered, its claim is
+        refreshed in the background, so that a crashed job is detected after claim_timeout
+        seconds and its shard is rendered again by another job. Returns the number of shards
+        rendered """
+    
+    # Initialize variables
+    if owner is None : owner = get_owner()
+    manifest = read_manifest(folder)
+    rendered = 0
+    
+    while max_shards is None or rendered < max_shards :
+        
+        # Take the next shard
+        shard = claim_shard(folder, owner, claim_timeout)
+        if shard is None :
+            break
+        
+        # Refresh the claim in the background while the shard is rendered
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(claim_timeout/4):
+                refresh_claim(folder, shard['index'], owner)
+        thread = threading.Thread(target = heartbeat, daemon = True)
+        thread.start()
+        
+        # Render the shard, and give it back if it fails
+        try:
+            path, failed = render_shard(folder, shard, manifest, df_trips, df_flux, owner, n_workers,
+                                        buffer_size, threads, store_folder)
+        except BaseException as e :
+            release_shard(folder, shard['index'], owner, repr(e))
+            raise
+        finally:
+            stop.set()
+            thread.join()
+        
+        complete_shard(folder, shard['index'], owner, path, failed)
+        print('shard {} done ({} to {})'.format(shard['index'], shard['begin'], shard['end']))
+        rendered += 1
+    
+    return rendered
+
+
+def get_shard_status(folder):
+    """ Return the number of shards of each status (pending, claimed, done) and the frames
+        which could not be rendered in the shards which are done """
+    
+    # Read the manifest
+    manifest = read_manifest(folder)
+    
+    # Count the shards
+    status = {'pending' : 0, 'claimed' : 0, 'done' : 0}
+    for shard in manifest['shards']:
+        status[shard['status']] += 1
+    status['failed_frames'] = [j for shard in manifest['shards'] for j in shard.get('failed', [])]
+    
+    return status
+
+
+def concat_shards(folder, filename = 'movie.mp4'):
+    """ Concatenate the segments of all the shards in a mp4 movie in the mp4 folder, without
+        encoding the frames again (with the concat demuxer of ffmpeg). The segments are first
+        checked against their checksum """
+    
+    # Import the ffmpeg binary used by imageio
+    import imageio_ffmpeg
+    
+    # All the shards must be done, with valid segments
+    invalid = verify_shards(folder)
+    manifest = read_manifest(folder)
+    missing = [shard['index'] for shard in manifest['shards'] if shard['status'] != 'done']
+    if missing :
+        raise ValueError("the shards {} are not rendered (corrupted: {})".format(missing, invalid))
+    
+    # List the segments in order
+    path = os.path.join(folder, 'segments.txt')
+    with open(path, 'w') as file:
+        for shard in manifest['shards']:
+            file.write("file '{}'\n".format(os.path.abspath(os.path.join(folder, shard['segment']))))
+    
+    # Copy the streams of the segments one after the other
+    output = os.path.join(sgs._mp4_folder, filename)
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                    '-i', path, '-c', 'copy', output], check = True)
+    
+    return output
@@ -0,0 +1,254 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+import contextlib
+from projection import *
+
+
+def get_bbox(latitude, longitude, margin = 0):
+    """ Return the bounding box (south, west, north, east) of the given points, enlarged by
+        margin degrees on each side """
+    
+    return (float(np.min(latitude)) - margin, float(np.min(longitude)) - margin,
+            float(np.max(latitude)) + margin, float(np.max(longitude)) + margin)
+
+
+def build_grid_index(south, west, north, east, cell_degrees = None):
+    """ Create a uniform grid index of rectangles given by their bounds in degrees. Each
+        rectangle is registered in every cell it overlaps, and the items of each cell are
+        stored one after the other, cell by cell, so that offsets[c] to offsets[c+1] are the
+        positions of the items of cell c. By default, the cells are as large as the typical
+        rectangle, or hold about one item if the rectangles are small """
+    
+    # Bounds of the items
+    south, west = np.asarray(south, dtype = np.float64), np.asarray(west, dtype = np.float64)
+    north, east = np.asarray(north, dtype = np.float64), np.asarray(east, dtype = np.float64)
+    
+    # Choose the size of the cells
+    if cell_degrees is None and len(south) :
+        span = max(east.max() - west.min(), north.max() - south.min())
+        cell_degrees = max(np.median(np.maximum(east - west, north - south)), span/np.sqrt(len(south)), 1e-6)
+    elif cell_degrees is None :
+        cell_degrees = 1.
+    
+    # Cover all the items with the grid
+    origin = (float(west.min()), float(south.min())) if len(south) else (0., 0.)
+    shape = (int((east.max() - origin[0]) // cell_degrees) + 1 if len(south) else 1,
+             int((north.max() - origin[1]) // cell_degrees) + 1 if len(south) else 1)
+    
+    # Range of cells overlapped by each item
+    first_x = ((west - origin[0]) // cell_degrees).astype(np.int64)
+    last_x = ((east - origin[0]) // cell_degrees).astype(np.int64)
+    first_y = ((south - origin[1]) // cell_degrees).astype(np.int64)
+    last_y = ((north - origin[1]) // cell_degrees).astype(np.int64)
+    
+    # List the cells of all items at once: repeat each item once per cell it overlaps, then
+    # find the position of each repetition in the range of cells of its item
+    width, height = last_x - first_x + 1, last_y - first_y + 1
+    items = np.repeat(np.arange(len(south)), width*height)
+    rank = np.arange(len(items)) - np.repeat(np.cumsum(width*height) - width*height, width*height)
+    cells = (first_y[items] + rank // width[items])*shape[0] + first_x[items] + rank % width[items]
+    
+    # Sort the items by cell
+    order = np.argsort(cells, kind = 'stable')
+    offsets = np.zeros(shape[0]*shape[1] + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cells, minlength = shape[0]*shape[1]))
+    
+    # Store the index
+    index = {
+        'cell_degrees' : cell_degrees,
+        'origin' : origin,
+        'shape' : shape,
+        'offsets' : offsets,
+        'items' : items[order],
+        'bounds' : (south, west, north, east)
+    }
+    
+    return index
+
+
+def query_grid_index(index, bbox):
+    """ Return the items of a grid index whose rectangle overlaps the bounding box
+        (south, west, north, east), in increasing order """
+    
+    # Find the cells overlapped by the bounding box, within the grid
+    south, west, north, east = bbox
+    (origin_x, origin_y), (nx, ny), cell = index['origin'], index['shape'], index['cell_degrees']
+    first_x, last_x = max(int((west - origin_x) // cell), 0), min(int((east - origin_x) // cell), nx - 1)
+    first_y, last_y = max(int((south - origin_y) // cell), 0), min(int((north - origin_y) // cell), ny - 1)
+    if first_x > last_x or first_y > last_y :
+        return np.zeros(0, dtype = np.int64)
+    
+    # Gather the items of these cells, row by row of cells
+    offsets = index['offsets']
+    items = np.concatenate([index['items'][offsets[y*nx + first_x]:offsets[y*nx + last_x + 1]]
+                            for y in range(first_y, last_y + 1)])
+    items = np.unique(items)
+    
+    # Keep the items which really overlap the bounding box
+    item_south, item_west, item_north, item_east = (bound[items] for bound in index['bounds'])
+    overlap = (item_south <= north) & (item_north >= south) & (item_west <= east) & (item_east >= west)
+    
+    return items[overlap]
+
+
+def build_point_index(latitude, longitude, cell_degrees = None):
+    """ Create a grid index of points, such as cities """
+    
+    return build_grid_index(latitude, longitude, latitude, longitude, cell_degrees)
+
+
+def build_segment_index(from_latitude, from_longitude, to_latitude, to_longitude, cell_degrees = None):
+    """ Create a grid index of segments, such as routes, by their bounding rectangles. The
+        segments are stored as well, to be tested exactly by query_segments """
+    
+    index = build_grid_index(np.minimum(from_latitude, to_latitude), np.minimum(from_longitude, to_longitude),
+                             np.maximum(from_latitude, to_latitude), np.maximum(from_longitude, to_longitude),
+                             cell_degrees)
+    index['segments'] = tuple(np.asarray(values, dtype = np.float64)
+                              for values in (from_latitude, from_longitude, to_latitude, to_longitude))
+    
+    return index
+
+
+def query_points(index, bbox):
+    """ Return the points of a point index which are in the bounding box """
+    
+    return query_grid_index(index, bbox)
+
+
+def query_segments(index, bbox):
+    """ Return the segments of a segment index which cross the bounding box. The segments are
+        straight lines in latitude and longitude, as the trips move along them (see framer.py) """
+    
+    # The segments whose bounding rectangle overlaps the bounding box are candidates
+    candidates = query_grid_index(index, bbox)
+    from_latitude, from_longitude, to_latitude, to_longitude = (values[candidates] for values in index['segments'])
+    south, west, north, east = bbox
+    
+    # Clip the candidates to the bounding box (Liang-Barsky): the part of the segment inside
+    # the box goes from enter to leave, in fraction of the segment
+    enter, leave = np.zeros(len(candidates)), np.ones(len(candidates))
+    for start, step, low, high in [(from_longitude, to_longitude - from_longitude, west, east),
+                                   (from_latitude, to_latitude - from_latitude, south, north)]:
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            to_low, to_high = (low - start)/step, (high - start)/step
+        moving = step != 0
+        enter = np.where(moving, np.maximum(enter, np.minimum(to_low, to_high)), enter)
+        leave = np.where(moving, np.minimum(leave, np.maximum(to_low, to_high)), leave)
+        
+        # A segment parallel to the side of the box must be between its sides
+        leave = np.where(~moving & ((start < low) | (start > high)), -1, leave)
+    
+    return candidates[enter <= leave]
+
+
+def build_route_index(df_flux, cell_degrees = None):
+    """ Create the segment index of the routes of df_flux """
+    
+    return build_segment_index(df_flux['from_latitude'].to_numpy(), df_flux['from_longitude'].to_numpy(),
+                               df_flux['to_latitude'].to_numpy(), df_flux['to_longitude'].to_numpy(),
+                               cell_degrees)
+
+
+def select_routes(df_flux, bbox, index = None):
+    """ Return the routes of df_flux which cross the bounding box. The index of the routes
+        (build_route_index) can be given if it is used several times """
+    
+    if index is None : index = build_route_index(df_flux)
+    
+    return df_flux.iloc[query_segments(index, bbox)]
+
+
+def select_cities(df_cities, bbox):
+    """ Return the cities which are in the bounding box """
+    
+    index = build_point_index(df_cities['latitude'].to_numpy(), df_cities['longitude'].to_numpy())
+    
+    return df_cities.iloc[query_points(index, bbox)]
+
+
+def select_trips(df_trips, df_flux, bbox, index = None):
+    """ Return the trips of df_trips which run on the routes of df_flux crossing the bounding
+        box, which are the only ones that can be seen in it """
+    
+    # Find the routes crossing the bounding box
+    df_routes = select_routes(df_flux, bbox, index)
+    
+    # Keep the trips of these routes
+    routes = pd.MultiIndex.from_frame(df_routes[['from_city','to_city']])
+    is_visible = pd.MultiIndex.from_frame(df_trips[['from_city','to_city']]).isin(routes)
+    
+    return df_trips[is_visible]
+
+
+def get_bbox_view(bbox, size = None, max_zoom = 18):
+    """ Return the location and the largest zoom at which the bounding box fits in a frame of
+        the given size (by default the size of the frames) """
+    
+    if size is None : size = sgs._frame_size
+    
+    # Size of the bounding box in pixels at zoom 0
+    south, west, north, east = bbox
+    x, y = lonlat_to_world_pixels([west, east], [north, south], 0)
+    width, height = max(x[1] - x[0], 1e-9), max(y[1] - y[0], 1e-9)
+    
+    # Each zoom level doubles the size
+    zoom = int(np.clip(np.floor(np.log2(min(size[0]/width, size[1]/height))), 0, max_zoom))
+    
+    # Center of the bounding box
+    longitude, latitude = world_pixels_to_lonlat((x[0] + x[1])/2, (y[0] + y[1])/2, 0)
+    
+    return [float(latitude), float(longitude)], zoom
+
+
+def get_bbox_viewport(bbox, size = None, max_zoom = 18):
+    """ Return the viewport (see projection.py) of a frame showing the bounding box """
+    
+    location, zoom = get_bbox_view(bbox, size, max_zoom)
+    
+    return get_viewport(location, zoom, size)
+
+
+def get_viewport_bbox(viewport):
+    """ Return the bounding box (south, west, north, east) of the area shown by a viewport """
+    
+    (origin_x, origin_y), (width, height) = viewport['origin'], viewport['size']
+    longitude, latitude = world_pixels_to_lonlat([origin_x, origin_x + width], [origin_y + height, origin_y],
+                                                 viewport['zoom'])
+    
+    return (float(latitude[0]), float(longitude[0]), float(latitude[1]), float(longitude[1]))
+
+
+@contextlib.contextmanager
+def use_region(bbox, size = None, max_zoom = 18):
+    """ Center all the maps and the frames on the bounding box, at the largest zoom at which
+        it fits in the frames, while the context is open. The location and the zoom of the
+        map in the settings are changed, and put back when the context closes. Gives the
+        bounding box of the area which is shown, which is larger than the given one if their
+        shapes differ """
+    
+    # Save the view of the settings
+    location, zoom = get_bbox_view(bbox, size, max_zoom)
+    former = {'location_map' : sgs._location_map, 'zoom_map' : sgs._zoom_map}
+    
+    sgs.configure(location_map = location, zoom_map = zoom)
+    try:
+        yield get_viewport_bbox(get_viewport(location, zoom, size))
+    finally:
+        sgs.configure(**former)
+
+
+def select_region(bbox, df_flux, df_trips = None, df_cities = None):
+    """ Return the routes, the trips and the cities (the last two if they are given) which can
+        be seen in the bounding box, so that drawing a region only costs what is visible """
+    
+    # The routes are indexed once for the routes and the trips
+    index = build_route_index(df_flux)
+    selection = [select_routes(df_flux, bbox, index)]
+    if df_trips is not None :
+        selection.append(select_trips(df_trips, df_flux, bbox, index))
+    if df_cities is not None :
+        selection.append(select_cities(df_cities, bbox))
+    
+    return tuple(selection)
@@ -0,0 +1,164 @@
+import settings as sgs
+import numpy as np
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import functools
+import urllib.request
+import concurrent.futures
+import http.server
+from projection import *
+
+
+# Url of the tiles of the "CartoDB dark_matter" maps, which are downloaded in the tiles folder
+_tiles_source = 'https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}.png'
+
+# Attribution of these tiles
+_tiles_source_attr = ('&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> '
+                      'contributors &copy; <a href="https://carto.com/attributions">CARTO</a>')
+
+
+def get_tile_path(zoom, x, y):
+    """ Return the path of a tile in the tiles folder """
+    
+    return os.path.join(sgs._tiles_folder, str(zoom), str(x), str(y) + '.png')
+
+
+def get_tile_range(zoom, location = None, size = None, margin = 1):
+    """ Return the tiles (zoom, x, y) which cover the frame centered on the location at the
+        given zoom, by default the map of the settings, plus margin tiles on each side """
+    
+    # Find the rectangle of the world which is displayed
+    viewport = get_viewport(location, zoom, size)
+    (origin_x, origin_y), (width, height) = viewport['origin'], viewport['size']
+    
+    # Find the tiles covering it. Tiles are repeated horizontally around the world
+    first_x, last_x = int(np.floor(origin_x/256)) - margin, int(np.floor((origin_x + width - 1)/256)) + margin
+    first_y, last_y = int(np.floor(origin_y/256)) - margin, int(np.floor((origin_y + height - 1)/256)) + margin
+    tiles = {(zoom, x % 2**zoom, y) for x in range(first_x, last_x + 1)
+                                    for y in range(max(first_y, 0), min(last_y, 2**zoom - 1) + 1)}
+    
+    return sorted(tiles)
+
+
+def fetch_tile(zoom, x, y, url = _tiles_source, timeout = 30):
+    """ Download a tile in the tiles folder, unless it is already there """
+    
+    # Nothing to do if the tile is already stored
+    path = get_tile_path(zoom, x, y)
+    if os.path.exists(path):
+        return False
+    
+    # Download the tile, spreading the requests over the subdomains of the server
+    request = urllib.request.Request(url.format(s = 'abcd'[(x + y) % 4], z = zoom, x = x, y = y),
+                                     headers = {'User-Agent' : 'goods-supply-visualization'})
+    with urllib.request.urlopen(request, timeout = timeout) as response:
+        content = response.read()
+    
+    # Write it in a temporary file first, so that an interrupted download leaves no broken tile
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path + '.part', 'wb') as file:
+        file.write(content)
+    os.replace(path + '.part', path)
+    
+    return True
+
+
+def prefetch_tiles(zooms = None, location = None, size = None, margin = 1, url = _tiles_source, n_threads = 8):
+    """ Download in the tiles folder all the tiles which cover the map of the settings at the
+        given zoom levels (by default, the zoom of the settings), so that the maps and the
+        frames can be created offline. Returns the number of tiles downloaded """
+    
+    # By default, only the zoom of the frames is needed
+    if zooms is None : zooms = [sgs._zoom_map]
+    
+    # List the tiles of all zoom levels
+    tiles = [tile for zoom in zooms for tile in get_tile_range(zoom, location, size, margin)]
+    
+    # Download the tiles which are missing in several threads, as most of the time is spent
+    # waiting for the server
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        fetched = list(executor.map(lambda tile: fetch_tile(*tile, url = url), tiles))
+    
+    return sum(fetched)
+
+
+def import_tiles(source):
+    """ Copy the tiles of another tiles folder ({zoom}/{x}/{y}.png) or of an MBTiles file in the
+        tiles folder, without replacing the tiles which are already there. Returns the number
+        of tiles imported """
+    
+    # Initialize variable
+    imported = 0
+    
+    # The rows of the MBTiles files are numbered from the bottom of the world
+    if os.path.isfile(source):
+        with sqlite3.connect(source) as connection:
+            for zoom, x, row, content in connection.execute(
+                    'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'):
+                path = get_tile_path(zoom, x, 2**zoom - 1 - row)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok = True)
+                    with open(path, 'wb') as file:
+                        file.write(content)
+                    imported += 1
+    
+    # Else, copy the folder tile by tile
+    else :
+        for folder, _, filenames in os.walk(source):
+            for filename in filenames:
+                if filename.endswith('.png'):
+                    path = os.path.join(sgs._tiles_folder, os.path.relpath(os.path.join(folder, filename), source))
+                    if not os.path.exists(path):
+                        os.makedirs(os.path.dirname(path), exist_ok = True)
+                        shutil.copyfile(os.path.join(folder, filename), path)
+                        imported += 1
+    
+    return imported
+
+
+class QuietTileHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serve the files of the tiles folder without printing every request """
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def start_tile_server(port = 0):
+    """ Serve the tiles folder on a local http server running in a background thread, and use
+        it for the tiles of all the maps. With port 0, a free port is chosen. Returns the
+        server, to give to stop_tile_server """
+    
+    # Start the server
+    handler = functools.partial(QuietTileHandler, directory = os.path.abspath(sgs._tiles_folder))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    
+    # Use it for the maps, and remember the former tiles
+    server.former_tiles = (sgs._tiles, sgs._tiles_attr)
+    use_local_tiles('http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png'.format(server.server_address[1]))
+    
+    return server
+
+
+def stop_tile_server(server):
+    """ Stop the local tile server and use the former tiles again """
+    
+    server.shutdown()
+    server.server_close()
+    sgs._tiles, sgs._tiles_attr = server.former_tiles
+    
+    return True
+
+
+def use_local_tiles(url = None):
+    """ Use the tiles of the tiles folder for all the maps, through the given url or directly
+        as files if no url is given (which works as long as the maps are opened from the disk) """
+    
+    if url is None :
+        url = pathlib.Path(sgs._tiles_folder).resolve().as_uri() + '/{z}/{x}/{y}.png'
+    sgs._tiles, sgs._tiles_attr = url, _tiles_source_attr
+    
+    return True
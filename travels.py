@@ -1,7 +1,15 @@
 import settings as sgs
 import numpy as np
 import pandas as pd
-from scipy import stats
+import os
+import glob
+import hashlib
+from instrumentation import stage
+
+
+# Version of the timetables stored in the cache, to increase when create_timetable_batch
+# changes, so that the former timetables are not used anymore
+_timetable_cache_version = 1
 
 
 def compute_travel_time(start_long,start_lat,arrival_long,arrival_lat):
@@ -67,10 +75,14 @@ def create_travels(travel_time, flux):
     return departure_times, arrival_times
 
 
+@stage('create_timetable')
 def create_timetable(df_flux):
     """ Create a complete timetable of boats and trains over the whole year, according to the
         importance of each flux """
     
+    # Import scipy.stats only here, as it is slow to import
+    from scipy.stats import rv_discrete
+    
     # Initialize variables
     from_city, to_city = [], []
     from_time, to_time = [], []
@@ -93,7 +105,7 @@ def create_timetable(df_flux):
         xk = np.arange(N)
         
         # Create a subclassifier in function of each different type
-        custm = stats.rv_discrete(name = 'custm', values = (xk, proba_map))
+        custm = rv_discrete(name = 'custm', values = (xk, proba_map))
         custm.rvs(size = 1)
         
         # Create the travels corresponding to the flux
@@ -137,3 +149,299 @@ def create_timetable(df_flux):
     
     return df_trains
 
+
+
+def compute_travel_times(start_long, start_lat, arrival_long, arrival_lat):
+    """ Vectorized version of compute_travel_time, which returns the rounded travel times
+        (in frames) of a whole array of routes at once """
+    
+    # Absolute horizontal and vertical distances
+    horiz = np.abs(np.asarray(start_long, dtype = float) - np.asarray(arrival_long, dtype = float))
+    verti = np.abs(np.asarray(start_lat, dtype = float) - np.asarray(arrival_lat, dtype = float))
+    
+    # Convert map distance to real kilometric distance
+    convert_to_km = 68.671
+    
+    # Compute the euclidian distance which is traveled in the hourly rate
+    euclidian_kmp_hourly_rate = sgs._euclidian_kmph / sgs._hourly_rate
+    
+    # Compute the travel times (distance in km / km per hourly rate)
+    travel_time = np.sqrt(horiz*horiz + verti*verti)*convert_to_km / euclidian_kmp_hourly_rate
+    
+    # Returns the rounded travel times
+    return np.around(travel_time, decimals = 0).astype(np.int64)
+
+
+def compute_departures_batch(flux):
+    """ Vectorized version of compute_departures, which returns the number of departing
+        trains of a whole array of routes at once """
+    
+    # Transform the yearly units in ktons, then in trains/boats
+    trains_a_year = np.asarray(flux, dtype = float) * sgs._ktons_per_unit / sgs._ktons_per_train
+    
+    # Round the result and return it
+    return np.around(trains_a_year, decimals = 0).astype(np.int64)
+
+
+def draw_trips_batch(df_flux, seed = None):
+    """ Draw the trips of all the routes at once, and return for each trip the position of
+        its route in df_flux, its departure and arrival frames in the time range, its coal 
+        type and whether it is a naval trip """
+    
+    # Initialize the random generator
+    rng = np.random.default_rng(seed)
+    
+    # If the naval mode is enabled, we have twice more types of flux
+    N = sgs._Ntypes_production
+    if sgs._enable_Naval : N *= 2
+    
+    # Compute the number of trains and the travel time of every route
+    counts = compute_departures_batch(df_flux['flux'].to_numpy())
+    travel_times = compute_travel_times(df_flux['from_longitude'].to_numpy(),
+                                        df_flux['from_latitude'].to_numpy(),
+                                        df_flux['to_longitude'].to_numpy(),
+                                        df_flux['to_latitude'].to_numpy())
+    
+    # Compute the flux types distribution of every route. Routes without flux have no
+    # train, so their distribution is irrelevant
+    flux_types = df_flux.iloc[:, 6:6+N].to_numpy(dtype = float)
+    flux_total = flux_types.sum(axis = 1, keepdims = True)
+    proba_map = np.divide(flux_types, flux_total,
+                          out = np.full_like(flux_types, 1/N), where = flux_total > 0)
+    
+    # Draw in one call the number of trains of each type on each route
+    counts_by_type = rng.multinomial(counts, proba_map)
+    
+    # Expand the types and routes to one entry per trip, sorted by route then by type
+    coal_type = np.tile(np.arange(1, N+1), len(df_flux)).repeat(counts_by_type.ravel())
+    route = np.arange(len(df_flux)).repeat(counts_by_type.sum(axis = 1))
+    
+    # Trains/boats are uniformly distributed over the time range of the simulation
+    departures = rng.integers(low = 0, high = len(sgs._time_range)-1, size = len(route))
+    
+    # Deduce the arrival from the departure and reajust the ones overpassing the time range
+    arrivals = departures + travel_times[route]
+    arrivals[arrivals >= len(sgs._time_range)] -= len(sgs._time_range)
+    
+    # If the naval mode is enabled, the upper half of the types are naval trips
+    if sgs._enable_Naval :
+        isnaval = (coal_type > N/2).astype(np.int64)
+    else :
+        isnaval = np.zeros(len(route), dtype = np.int64)
+    
+    return route, departures, arrivals, coal_type, isnaval
+
+
+@stage('create_timetable_batch')
+def create_timetable_batch(df_flux, seed = None):
+    """ Create the same timetable as create_timetable, but computes the departures of all
+        the routes at once instead of iterating over every single train. The seed makes 
+        the result reproducible """
+    
+    # Draw the trips of all the routes
+    route, departures, arrivals, coal_type, isnaval = draw_trips_batch(df_flux, seed)
+    
+    # Prepare the columns of the dataframe
+    dict_trains = {
+        'from_city' : df_flux['from_city'].to_numpy()[route],
+        'to_city' : df_flux['to_city'].to_numpy()[route],
+        'departure_time' : sgs._time_range[departures],
+        'arrival_time' : sgs._time_range[arrivals],
+        'coal_type' : coal_type,
+        'is_naval' : isnaval
+    }
+    
+    # Convert the dictionary to a pandas dataframe
+    df_trains = pd.DataFrame.from_dict(dict_trains)
+    
+    return df_trains
+
+
+def get_timetable_key(df_flux, seed):
+    """ Return a hash identifying the timetable created by create_timetable_batch from the
+        given flux data, settings and seed """
+    
+    # Hash the values of the flux data, as well as the names of the columns
+    key = hashlib.sha1(pd.util.hash_pandas_object(df_flux, index = True).to_numpy().tobytes())
+    key.update(repr(list(df_flux.columns)).encode())
+    
+    # Add the settings which the timetable depends on, and the seed
+    settings = (sgs._Ntypes_production, sgs._enable_Naval, sgs._ktons_per_unit, sgs._ktons_per_train,
+                sgs._euclidian_kmph, sgs._hourly_rate, str(sgs._time_range[0]), len(sgs._time_range),
+                sgs._time_range.freqstr, seed, _timetable_cache_version)
+    key.update(repr(settings).encode())
+    
+    return key.hexdigest()
+
+
+def save_timetable(df_trains, path):
+    """ Save a timetable in a binary npz file """
+    
+    # Store the cities as codes of a list of names, and the times as integers
+    cities, codes = np.unique(np.concatenate([df_trains['from_city'].to_numpy(dtype = str),
+                                              df_trains['to_city'].to_numpy(dtype = str)]),
+                              return_inverse = True)
+    
+    # Write in a temporary file, which replaces the cache entry once it is complete
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file,
+                 cities = cities,
+                 from_city = codes[:len(df_trains)].astype(np.int32),
+                 to_city = codes[len(df_trains):].astype(np.int32),
+                 departure_time = df_trains['departure_time'].to_numpy(dtype = 'datetime64[ns]').view(np.int64),
+                 arrival_time = df_trains['arrival_time'].to_numpy(dtype = 'datetime64[ns]').view(np.int64),
+                 coal_type = df_trains['coal_type'].to_numpy(dtype = np.int8),
+                 is_naval = df_trains['is_naval'].to_numpy(dtype = np.int8))
+    os.replace(path + '.tmp', path)
+    
+    return True
+
+
+def load_timetable(path):
+    """ Load a timetable saved by save_timetable """
+    
+    # Read the arrays of the file
+    with np.load(path) as data :
+        
+        # Prepare the columns of the dataframe
+        dict_trains = {
+            'from_city' : data['cities'].astype(object)[data['from_city']],
+            'to_city' : data['cities'].astype(object)[data['to_city']],
+            'departure_time' : data['departure_time'].view('datetime64[ns]'),
+            'arrival_time' : data['arrival_time'].view('datetime64[ns]'),
+            'coal_type' : data['coal_type'].astype(np.int64),
+            'is_naval' : data['is_naval'].astype(np.int64)
+        }
+    
+    # Convert the dictionary to a pandas dataframe
+    df_trains = pd.DataFrame.from_dict(dict_trains)
+    
+    return df_trains
+
+
+@stage('create_timetable_cached')
+def create_timetable_cached(df_flux, seed = 0, max_entries = 16):
+    """ Same as create_timetable_batch, but the timetable is stored in the cache folder and 
+        loaded from it as long as the flux data, the settings and the seed do not change. 
+        Only the max_entries most recently used timetables are kept """
+    
+    # Without seed, the timetable is different every time and cannot be cached
+    if seed is None :
+        return create_timetable_batch(df_flux)
+    
+    # Find the cache entry of this timetable
+    os.makedirs(sgs._cache_folder, exist_ok = True)
+    path = os.path.join(sgs._cache_folder, 'timetable_' + get_timetable_key(df_flux, seed) + '.npz')
+    
+    # Load the timetable if it is in the cache, and mark it as recently used
+    if os.path.exists(path):
+        os.utime(path)
+        return load_timetable(path)
+    
+    # Else, create the timetable and store it
+    df_trains = create_timetable_batch(df_flux, seed)
+    save_timetable(df_trains, path)
+    
+    # Remove the least recently used timetables if there are too many of them
+    entries = sorted(glob.glob(os.path.join(sgs._cache_folder, 'timetable_*.npz')), key = os.path.getmtime)
+    for entry in entries[:max(0, len(entries) - max_entries)]:
+        os.remove(entry)
+    
+    return df_trains
+
+
+def iter_trip_events(df_flux, seed = None, chunk_size = 100000, window = 2016):
+    """ Yield the departures and arrivals of the trains and boats in time order, by chunks
+        of chunk_size events, as dataframes with the columns frame, time, event ('departure'
+        or 'arrival'), trip, from_city, to_city, coal_type and is_naval. The time range is 
+        drawn window by window (by default a week of 5-minute frames): the number of trains
+        of each route departing in a window follows the binomial law of uniformly distributed
+        departures, and the streams of departures of all routes are merged with the pending
+        arrivals of the window. Only one window and the trips in progress are in memory at 
+        once. Unlike create_timetable, arrivals overpassing the time range are not wrapped to
+        the beginning of the simulation, and come last """
+    
+    # Initialize the random generator
+    rng = np.random.default_rng(seed)
+    
+    # If the naval mode is enabled, we have twice more types of flux
+    N = sgs._Ntypes_production
+    if sgs._enable_Naval : N *= 2
+    
+    # Compute the number of trains, the travel time and the types distribution of every route
+    remaining = compute_departures_batch(df_flux['flux'].to_numpy())
+    travel_times = compute_travel_times(df_flux['from_longitude'].to_numpy(),
+                                        df_flux['from_latitude'].to_numpy(),
+                                        df_flux['to_longitude'].to_numpy(),
+                                        df_flux['to_latitude'].to_numpy())
+    flux_types = df_flux.iloc[:, 6:6+N].to_numpy(dtype = float)
+    flux_total = flux_types.sum(axis = 1, keepdims = True)
+    proba_map = np.divide(flux_types, flux_total,
+                          out = np.full_like(flux_types, 1/N), where = flux_total > 0)
+    from_city, to_city = df_flux['from_city'].to_numpy(), df_flux['to_city'].to_numpy()
+    
+    # Initialize variables
+    n_frames = len(sgs._time_range) - 1
+    step = sgs._time_range[1] - sgs._time_range[0]
+    columns = ['frame', 'is_arrival', 'trip', 'route', 'coal_type']
+    pending = {name : np.zeros(0, dtype = np.int64) for name in columns}
+    buffered, n_buffered, n_trips = [], 0, 0
+    
+    def to_dataframe(events):
+        """ Convert the arrays describing events to a dataframe """
+        dict_events = {
+            'frame' : events['frame'],
+            'time' : sgs._time_range[0] + events['frame'] * step,
+            'event' : np.where(events['is_arrival'] == 1, 'arrival', 'departure'),
+            'trip' : events['trip'],
+            'from_city' : from_city[events['route']],
+            'to_city' : to_city[events['route']],
+            'coal_type' : events['coal_type'],
+            'is_naval' : (events['coal_type'] > N/2).astype(np.int64) * int(sgs._enable_Naval)
+        }
+        return pd.DataFrame.from_dict(dict_events)
+    
+    # Iterate over the windows, and over a last virtual one which empties the pending arrivals
+    for start in list(range(0, n_frames, window)) + [n_frames]:
+        
+        # Draw the number of departures of each type of each route in the window
+        width = min(window, n_frames - start)
+        if width > 0 :
+            k = rng.binomial(remaining, width / (n_frames - start))
+            remaining -= k
+            counts_by_type = rng.multinomial(k, proba_map)
+        else :
+            counts_by_type = np.zeros((len(df_flux), N), dtype = np.int64)
+        
+        # Create the departures of the window, and their arrivals which are pending
+        route = np.arange(len(df_flux)).repeat(counts_by_type.sum(axis = 1))
+        departures = {
+            'frame' : rng.integers(start, start + max(width, 1), size = len(route)),
+            'is_arrival' : np.zeros(len(route), dtype = np.int64),
+            'trip' : np.arange(n_trips, n_trips + len(route)),
+            'route' : route,
+            'coal_type' : np.tile(np.arange(1, N+1), len(df_flux)).repeat(counts_by_type.ravel())
+        }
+        n_trips += len(route)
+        arrivals = dict(departures, frame = departures['frame'] + travel_times[route],
+                        is_arrival = np.ones(len(route), dtype = np.int64))
+        pending = {name : np.concatenate([pending[name], arrivals[name]]) for name in columns}
+        
+        # Select the arrivals of the window (all of them at the end)
+        due = pending['frame'] < start + window if width > 0 else np.ones(len(pending['frame']), dtype = bool)
+        events = {name : np.concatenate([departures[name], pending[name][due]]) for name in columns}
+        pending = {name : pending[name][~due] for name in columns}
+        
+        # Merge the events in time order, the departures coming before the arrivals of the same frame
+        order = np.lexsort((events['trip'], events['is_arrival'], events['frame']))
+        buffered.append({name : events[name][order] for name in columns})
+        n_buffered += len(order)
+        
+        # Yield the chunks as soon as they are full
+        if n_buffered >= chunk_size or width == 0 :
+            events = {name : np.concatenate([b[name] for b in buffered]) for name in columns}
+            full = n_buffered - n_buffered % chunk_size if width > 0 else n_buffered
+            for first in range(0, full, chunk_size):
+                yield to_dataframe({name : events[name][first:min(first + chunk_size, full)] for name in columns})
+            buffered = [{name : events[name][full:] for name in columns}]
+            n_buffered -= full
@@ -0,0 +1,144 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+
+
+def to_frame(time):
+    """ Convert a time (or an array of times) to a frame number, relative to the beginning
+        of the time range of the simulation """
+    
+    # Duration of one frame of the simulation
+    step = sgs._time_range[1] - sgs._time_range[0]
+    
+    # Count the number of frames elapsed since the beginning of the simulation
+    return (pd.to_datetime(time) - sgs._time_range[0]) / step
+
+
+def build_trip_index(df_trips, wrap = True):
+    """ Create an index of the trips sorted by departure frame, in order to find the trips
+        which are active at a given time without scanning the whole timetable.
+        Trips whose arrival overpass the time range were wrapped to the beginning of the
+        simulation by create_travels (their arrival is before their departure). If wrap is
+        True, such a trip is split in two intervals: one which departs at its departure and
+        ends after the time range, and one which departs before the time range and arrives
+        at its arrival. If wrap is False, they are ignored, as in get_active_trips """
+    
+    # Convert the times to frame numbers
+    departure = np.around(to_frame(df_trips["departure_time"]).to_numpy()).astype(np.int64)
+    arrival = np.around(to_frame(df_trips["arrival_time"]).to_numpy()).astype(np.int64)
+    rows = np.arange(len(df_trips))
+    
+    # Find the trips which were wrapped around the end of the time range
+    wrapped = arrival < departure
+    
+    # Split the wrapped trips in two intervals of the same duration
+    if wrap :
+        N = len(sgs._time_range)
+        rows = np.concatenate([rows, rows[wrapped]])
+        departure, arrival = (np.concatenate([departure, departure[wrapped] - N]),
+                              np.concatenate([arrival + N*wrapped, arrival[wrapped]]))
+    
+    # Or remove them from the index
+    else :
+        rows, departure, arrival = rows[~wrapped], departure[~wrapped], arrival[~wrapped]
+    
+    # Sort the intervals by departure
+    order = np.argsort(departure, kind = 'stable')
+    rows, departure, arrival = rows[order], departure[order], arrival[order]
+    
+    # Store the sorted intervals, along with the information needed to draw the trips
+    trip_index = {
+        'rows' : rows,
+        'departure' : departure,
+        'arrival' : arrival,
+        'max_duration' : int((arrival - departure).max()) if len(rows) else 0,
+        'from_latitude' : df_trips["from_latitude"].to_numpy()[rows],
+        'from_longitude' : df_trips["from_longitude"].to_numpy()[rows],
+        'to_latitude' : df_trips["to_latitude"].to_numpy()[rows],
+        'to_longitude' : df_trips["to_longitude"].to_numpy()[rows],
+        'coal_type' : df_trips["coal_type"].to_numpy()[rows],
+        'is_naval' : df_trips["is_naval"].to_numpy()[rows]
+    }
+    
+    return trip_index
+
+
+def get_indexed_positions(trip_index, active, frame):
+    """ Return the current position, coal type and naval flag of the given entries of the
+        trip index, in the same format as get_active_trips_vectorized """
+    
+    # Compute the percentage of completion of the active trips. Trips without duration
+    # are considered as just departed
+    duration = (trip_index['arrival'][active] - trip_index['departure'][active]).astype(np.float64)
+    progress = np.divide(frame - trip_index['departure'][active], duration,
+                         out = np.zeros(len(active)), where = duration > 0)
+    
+    # Match this percentage of completion to extrapolate the current positions
+    current_latitude = trip_index['from_latitude'][active]*(1-progress) + \
+                       trip_index['to_latitude'][active]*progress
+    current_longitude = trip_index['from_longitude'][active]*(1-progress) + \
+                        trip_index['to_longitude'][active]*progress
+    
+    # Return all the information about the active trips
+    if (sgs._enable_Naval):
+        return (current_latitude, current_longitude,
+                trip_index['coal_type'][active], trip_index['is_naval'][active])
+    else :
+        return current_latitude, current_longitude, trip_index['coal_type'][active]
+
+
+def get_active_entries(trip_index, frame):
+    """ Return the entries of the trip index which are active at the given frame """
+    
+    # Only the trips that departed during the longest travel time before the frame can
+    # still be active, and they are contiguous in the index
+    lower = np.searchsorted(trip_index['departure'], frame - trip_index['max_duration'], side = 'left')
+    upper = np.searchsorted(trip_index['departure'], frame, side = 'right')
+    
+    # Among them, keep those which have not yet arrived
+    candidates = np.arange(lower, upper)
+    
+    return candidates[trip_index['arrival'][candidates] >= frame]
+
+
+def get_active_trips_indexed(image_time, trip_index):
+    """ Same as get_active_trips_vectorized, but uses the trip index to only look at the
+        trips which may be active at the given time """
+    
+    # Convert the image time to a frame number
+    frame = to_frame(image_time)
+    
+    return get_indexed_positions(trip_index, get_active_entries(trip_index, frame), frame)
+
+
+def new_sweep_cursor(trip_index):
+    """ Create a cursor which follows the active trips while the frame time increases """
+    
+    return {'index' : trip_index, 'frame' : None, 'next' : 0, 'active' : np.zeros(0, dtype = np.int64)}
+
+
+def advance_sweep_cursor(cursor, image_time):
+    """ Move the cursor to the given time, by adding the trips which departed and removing
+        the trips which arrived since the previous time, and return the active trips in the
+        same format as get_active_trips_vectorized """
+    
+    # Initialize variables
+    trip_index = cursor['index']
+    frame = to_frame(image_time)
+    
+    # If the time goes backwards, the cursor is repositioned with a binary search
+    if (cursor['frame'] is None) or (frame < cursor['frame']):
+        cursor['active'] = get_active_entries(trip_index, frame)
+        cursor['next'] = np.searchsorted(trip_index['departure'], frame, side = 'right')
+    
+    # Else, only the departures and arrivals since the previous time are processed
+    else :
+        upper = np.searchsorted(trip_index['departure'], frame, side = 'right')
+        departing = np.arange(cursor['next'], upper)
+        active = np.concatenate([cursor['active'], departing])
+        cursor['active'] = active[trip_index['arrival'][active] >= frame]
+        cursor['next'] = upper
+    
+    cursor['frame'] = frame
+    
+    return get_indexed_positions(trip_index, cursor['active'], frame)
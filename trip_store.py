@@ -0,0 +1,166 @@
+import settings as sgs
+import numpy as np
+import pandas as pd
+from travels import draw_trips_batch
+
+
+def get_frame_step():
+    """ Return the duration of one frame of the simulation """
+    
+    return sgs._time_range[1] - sgs._time_range[0]
+
+
+def build_route_table(df_flux):
+    """ Create the geometry of the routes: the names and coordinates of the cities are stored
+        once, and each route (in the order of df_flux) refers to its departure and arrival 
+        cities by their integer ids """
+    
+    # Gather the cities of all routes with their coordinates
+    df_cities = pd.concat([
+        df_flux[['from_city','from_latitude','from_longitude']].set_axis(['city','latitude','longitude'], axis = 1),
+        df_flux[['to_city','to_latitude','to_longitude']].set_axis(['city','latitude','longitude'], axis = 1)
+    ]).drop_duplicates('city').sort_values('city')
+    cities = df_cities['city'].to_numpy()
+    
+    # Store the geometry of the routes
+    route_table = {
+        'cities' : cities,
+        'city_latitude' : df_cities['latitude'].to_numpy(dtype = np.float64),
+        'city_longitude' : df_cities['longitude'].to_numpy(dtype = np.float64),
+        'from_city' : np.searchsorted(cities, df_flux['from_city'].to_numpy()).astype(np.int32),
+        'to_city' : np.searchsorted(cities, df_flux['to_city'].to_numpy()).astype(np.int32)
+    }
+    
+    return route_table
+
+
+def create_compact_timetable(df_flux, seed = None):
+    """ Same as travels.create_timetable_batch, but returns a compact trip store: the routes
+        are integer ids into a single route table (see build_route_table), the departure and 
+        arrival times are integer frames relative to the start time of the simulation, and the
+        coal types and naval flags are small integers """
+    
+    # Draw the trips of all the routes
+    route, departures, arrivals, coal_type, isnaval = draw_trips_batch(df_flux, seed)
+    
+    # Frames of the time range are shifted if it does not begin at the start time
+    shift = int((sgs._time_range[0] - sgs._start_time) / get_frame_step())
+    
+    # Store the trips with the smallest types
+    trip_store = {
+        'routes' : build_route_table(df_flux),
+        'route' : route.astype(np.int32),
+        'departure' : (departures + shift).astype(np.int32),
+        'arrival' : (arrivals + shift).astype(np.int32),
+        'coal_type' : coal_type.astype(np.int8),
+        'is_naval' : isnaval.astype(np.int8)
+    }
+    
+    return trip_store
+
+
+def compact_trips(df_trips, df_flux):
+    """ Convert a timetable (as created by travels.py) into a compact trip store. The routes
+        of the trips are looked up in df_flux """
+    
+    # Find the id of the route of every trip
+    df_routes = df_flux[['from_city','to_city']].reset_index(drop = True).drop_duplicates()
+    df_routes['route'] = df_routes.index
+    route = df_trips[['from_city','to_city']].merge(df_routes, how = 'left', on = ['from_city','to_city'])['route']
+    if route.isna().any():
+        raise ValueError("some trips follow routes which are not in df_flux")
+    
+    # Convert the times to frames relative to the start time of the simulation
+    departure = (df_trips['departure_time'] - sgs._start_time) / get_frame_step()
+    arrival = (df_trips['arrival_time'] - sgs._start_time) / get_frame_step()
+    
+    # Store the trips with the smallest types
+    trip_store = {
+        'routes' : build_route_table(df_flux),
+        'route' : route.to_numpy(dtype = np.int32),
+        'departure' : np.around(departure.to_numpy()).astype(np.int32),
+        'arrival' : np.around(arrival.to_numpy()).astype(np.int32),
+        'coal_type' : df_trips['coal_type'].to_numpy(dtype = np.int8),
+        'is_naval' : df_trips['is_naval'].to_numpy(dtype = np.int8)
+    }
+    
+    return trip_store
+
+
+def get_trip_coordinates(trip_store, trips = None):
+    """ Return the departure and arrival latitudes and longitudes of the given trips (all of 
+        them by default), looked up in the route table """
+    
+    # Find the departure and arrival cities of the trips
+    routes = trip_store['routes']
+    route = trip_store['route'] if trips is None else trip_store['route'][trips]
+    from_city, to_city = routes['from_city'][route], routes['to_city'][route]
+    
+    return (routes['city_latitude'][from_city], routes['city_longitude'][from_city],
+            routes['city_latitude'][to_city], routes['city_longitude'][to_city])
+
+
+def expand_trips(trip_store, coordinates = True):
+    """ Convert a compact trip store back to a timetable dataframe, with the coordinates of
+        the cities if coordinates is True, as expected by framer.py """
+    
+    # Find the names of the departure and arrival cities
+    routes = trip_store['routes']
+    from_city = routes['from_city'][trip_store['route']]
+    to_city = routes['to_city'][trip_store['route']]
+    
+    # Prepare the columns of the dataframe
+    dict_trains = {
+        'from_city' : routes['cities'][from_city],
+        'to_city' : routes['cities'][to_city],
+        'departure_time' : sgs._start_time + trip_store['departure'].astype(np.int64) * get_frame_step(),
+        'arrival_time' : sgs._start_time + trip_store['arrival'].astype(np.int64) * get_frame_step(),
+        'coal_type' : trip_store['coal_type'].astype(np.int64),
+        'is_naval' : trip_store['is_naval'].astype(np.int64)
+    }
+    
+    # Add the coordinates of the cities
+    if coordinates :
+        (dict_trains['from_latitude'], dict_trains['from_longitude'],
+         dict_trains['to_latitude'], dict_trains['to_longitude']) = get_trip_coordinates(trip_store)
+    
+    # Convert the dictionary to a pandas dataframe
+    df_trains = pd.DataFrame.from_dict(dict_trains)
+    
+    return df_trains
+
+
+def get_active_trips_compact(frame, trip_store):
+    """ Same as framer.get_active_trips_vectorized, given a frame number (relative to the start
+        time of the simulation) and a compact trip store """
+    
+    # Active trips are those whose departure frame is already passed but whose arrival
+    # frame has not yet passed
+    active = np.flatnonzero((trip_store['departure'] <= frame) & (trip_store['arrival'] >= frame))
+    
+    # Compute the percentage of completion of all active trips. Trips without duration
+    # are considered as just departed
+    duration = (trip_store['arrival'][active] - trip_store['departure'][active]).astype(np.float64)
+    progress = np.divide(frame - trip_store['departure'][active], duration,
+                         out = np.zeros(len(active)), where = duration > 0)
+    
+    # Match this percentage of completion to extrapolate the current positions
+    from_latitude, from_longitude, to_latitude, to_longitude = get_trip_coordinates(trip_store, active)
+    current_latitude = from_latitude*(1-progress) + to_latitude*progress
+    current_longitude = from_longitude*(1-progress) + to_longitude*progress
+    
+    # Return all the information about the active trips
+    if (sgs._enable_Naval):
+        return current_latitude, current_longitude, trip_store['coal_type'][active], trip_store['is_naval'][active]
+    else :
+        return current_latitude, current_longitude, trip_store['coal_type'][active]
+
+
+def get_trip_store_memory(trip_store):
+    """ Return the number of bytes used by the arrays of a trip store """
+    
+    # Sum the sizes of the arrays of the trips and of the route table
+    arrays = [value for value in trip_store.values() if isinstance(value, np.ndarray)]
+    arrays += [value for value in trip_store['routes'].values()]
+    
+    return sum(array.nbytes for array in arrays)